@@ -0,0 +1,191 @@
+""" Benchmark of the single-pass tree walk in parse_latex_tralics against
+    the original implementation with one XPath query per processing step.
+
+    Runs both on Tralics XML files (or, without an input directory, on
+    generated papers with many formulas, figures and citations), checks
+    that they produce byte-identical JSON and reports their run times.
+"""
+
+import io
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from collections import OrderedDict
+from lxml import etree
+import parse_latex_tralics
+
+
+def _synthetic_paper(rnd, num_sections=12, pars_per_section=15):
+    """ Tralics-like XML of a paper with nested sections, figures, tables,
+        floats, formulas, references and a bibliography, including some of
+        the odd structures found in real output.
+    """
+
+    def formula(inline=True):
+        return (
+            '<formula type="{}"><texmath>x_{{{}}} + \\alpha^{}</texmath>'
+            '</formula>'.format(
+                'inline' if inline else 'display',
+                rnd.randrange(100), rnd.randrange(9)
+            )
+        )
+
+    def cit():
+        return '<cit><ref target="bid{}"/></cit>'.format(rnd.randrange(45))
+
+    def sentence():
+        parts = ['Some text']
+        for _ in range(rnd.randrange(1, 8)):
+            parts.append(rnd.choice([
+                formula(), formula(), formula(), cit(),
+                ' see <ref target="uid{}"/> '.format(rnd.randrange(50)),
+                '<hi rend="it">emph {}</hi>'.format(formula()),
+                ' more words ',
+                '<hi rend="bold">bold <hi rend="it">words</hi></hi>',
+                '<xref url="https://example.org">link</xref>',
+                '<unexpected/>',
+                '<unexpected>{}</unexpected>'.format(formula())
+            ]))
+            parts.append(' and then ')
+        return ''.join(parts) + '.'
+
+    def tabular():
+        rows = []
+        for _ in range(rnd.randrange(3, 15)):
+            rows.append('<row>{}</row>'.format(''.join(
+                '<cell halign="center"><hi rend="bold">{}</hi></cell>'.format(
+                    rnd.randrange(1000)
+                ) for _ in range(rnd.randrange(2, 8))
+            )))
+        return '<table rend="inline">{}</table>'.format(''.join(rows))
+
+    def float_elem():
+        kind = rnd.choice(['figure', 'table', 'float'])
+        caption = '<caption>Caption with {} and {}</caption>{}'.format(
+            formula(), cit(), tabular() if kind != 'figure' else
+            '<figure file="fig{}" width="8cm"/>'.format(rnd.randrange(9))
+        )
+        if kind == 'float':
+            return '<float type="{}">{}</float>'.format(
+                rnd.choice(['figure', 'table', 'algorithm']), caption
+            )
+        if rnd.random() < 0.1:
+            # nested
+            return '<{0}><head>Outer</head><{0}>{1}</{0}></{0}>'.format(
+                kind, caption
+            )
+        return '<{0}>{1}</{0}>'.format(kind, caption)
+
+    body = []
+    body.append(
+        '<title>Title {}</title><author>A. Author<thanks>{}</thanks>'
+        '</author><date>2020</date>'.format(formula(), cit())
+    )
+    for sec in range(num_sections):
+        section = ['<div0 id-text="{}"><head>Section {}</head>'.format(
+            sec + 1, sec
+        )]
+        for par in range(pars_per_section):
+            if par % 5 == 4:
+                section.append(
+                    '<div1 id-text="{}.{}"><head>Sub</head><p>{}</p>'
+                    '</div1>'.format(sec + 1, par, sentence())
+                )
+            elif par % 7 == 6:
+                section.append(float_elem())
+            elif par % 11 == 10:
+                section.append(
+                    '<p>{}</p><formula type="display"><Texmath>y</Texmath>'
+                    '</formula><list><item><p>{}</p></item></list>'.format(
+                        sentence(), sentence()
+                    )
+                )
+            else:
+                section.append('<p>{}</p>'.format(sentence()))
+        section.append('</div0><!-- comment -->')
+        body.append(''.join(section))
+    bib = ['<div0><head>References</head><Bibliography>']
+    for bid in range(40):
+        bib.append(
+            '<p noindent="true"><bibitem id="bid{0}"/>A. Author, Title {0} '
+            '{1}, <xref url="https://arxiv.org/abs/1206.{0:04d}">'
+            'arXiv:1206.{0:04d}</xref> <xref url="https://doi.org/10.1/{0}">'
+            'doi</xref></p>'.format(bid, formula())
+        )
+    bib.append('</Bibliography></div0>')
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><unknown><std>{}{}</std>'
+        '</unknown>'.format(''.join(body), ''.join(bib))
+    ).encode('utf-8')
+
+
+def _run(xml_docs, single_pass):
+    """ Returns (JSON lines, seconds spent in _process_tree()).
+    """
+
+    parse_latex_tralics.SINGLE_PASS_TREE_WALK = single_pass
+    # deterministic UUIDs (with REF_ENTRY_IDS = 'uuid'), so the outputs are
+    # comparable
+    rnd = random.Random(0)
+    uuid.uuid4 = lambda: uuid.UUID(int=rnd.getrandbits(128), version=4)
+    lines = []
+    seconds = 0
+    for aid, xml in xml_docs:
+        tree = etree.parse(io.BytesIO(xml), etree.XMLParser())
+        paper_dict = OrderedDict({'paper_id': aid})
+        start = time.perf_counter()
+        counts = parse_latex_tralics._process_tree(
+            tree, aid, paper_dict, lambda msg: None
+        )
+        seconds += time.perf_counter() - start
+        lines.append(json.dumps([paper_dict, counts]))
+    return lines, seconds
+
+
+def benchmark(xml_docs, repeat=3):
+    uuid4 = uuid.uuid4
+    try:
+        results = {}
+        for single_pass in [False, True]:
+            runs = [_run(xml_docs, single_pass) for _ in range(repeat)]
+            results[single_pass] = (runs[0][0], min(s for _, s in runs))
+    finally:
+        uuid.uuid4 = uuid4
+        parse_latex_tralics.SINGLE_PASS_TREE_WALK = True
+    xpath_lines, xpath_seconds = results[False]
+    walk_lines, walk_seconds = results[True]
+    num_different = sum(a != b for a, b in zip(xpath_lines, walk_lines))
+    print('{} papers, {} with different output'.format(
+        len(xml_docs), num_different
+    ))
+    print('XPath per step: {:.3f}s, single pass: {:.3f}s ({:.2f}x)'.format(
+        xpath_seconds, walk_seconds, xpath_seconds / max(walk_seconds, 1e-9)
+    ))
+    return num_different == 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [1, 2] or \
+            (len(sys.argv) == 2 and sys.argv[1] in ['-h', '--help']):
+        print((
+            'Usage: python3 benchmark_tree_walk.py [<tralics_xml_dir>]\n'
+            '       (without a directory, 50 generated papers are used)'
+        ))
+        sys.exit()
+    if len(sys.argv) == 2:
+        xml_docs = []
+        for fn in sorted(os.listdir(sys.argv[1])):
+            if fn.endswith('.xml'):
+                with open(os.path.join(sys.argv[1], fn), 'rb') as f:
+                    xml_docs.append((os.path.splitext(fn)[0], f.read()))
+    else:
+        rnd = random.Random(42)
+        xml_docs = [
+            ('synthetic{}'.format(i), _synthetic_paper(rnd))
+            for i in range(50)
+        ]
+    if not benchmark(xml_docs):
+        sys.exit(1)
@@ -0,0 +1,331 @@
+""" Sidecar index of the JSONL corpus: per paper, the file, byte offset and
+    length of its line and its key metadata fields, stored in SQLite.
+
+    Tables:
+
+        info(key, value)    'root': directory the file paths are relative to
+        file(file_id, path, size, mtime_ns)
+        paper(paper_id, file_id, offset, length, license, categories,
+              discipline, update_date, language)
+                            clustered on paper_id (WITHOUT ROWID), with
+                            indices on license, discipline and update_date
+
+    Papers are read with a single os.pread() each (seek_paper()), and
+    metadata queries (papers()) only touch the index. Rebuilding an index
+    only rescans files whose size or modification time changed (e.g.
+    after filter_license.py rewrote them).
+"""
+
+import json
+import os
+import sqlite3
+import sys
+from jsonl_io import lazy_fields
+from multiprocessing import Pool
+from tqdm import tqdm
+
+INDEX_FIELDS = [
+    'license', 'categories', 'discipline', 'update_date', 'language'
+]
+# subset written into the dataset directory by filter_license.py
+SKIP_DIRS = ['permissive_subset']
+
+
+def _index_rows(params):
+    """ (paper_id, offset, length, *INDEX_FIELDS) for each line of a JSONL
+        file.
+    """
+
+    path, rel_path = params
+    rows = []
+    offset = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            length = len(line)
+            if len(line.strip()) > 0:
+                try:
+                    # (decodes paper_id and metadata only)
+                    fields = lazy_fields(
+                        line.decode('utf-8'), ['paper_id', 'metadata']
+                    )
+                except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                    print('skipping malformed line in {}: {}'.format(
+                        rel_path, e
+                    ))
+                    fields = {}
+                paper_id = fields.get('paper_id', (None,))[0]
+                if paper_id:
+                    metadata = fields.get('metadata', (None,))[0] or {}
+                    rows.append(
+                        (paper_id, offset, length) +
+                        tuple(metadata.get(field) for field in INDEX_FIELDS)
+                    )
+            offset += length
+    return rel_path, rows
+
+
+def _create_tables(db_cur):
+    db_cur.execute("""
+        create table if not exists info(
+            'key' text primary key,
+            'value' text
+        )
+    """)
+    db_cur.execute("""
+        create table if not exists file(
+            'file_id' integer primary key,
+            'path' text unique,
+            'size' integer,
+            'mtime_ns' integer
+        )
+    """)
+    db_cur.execute("""
+        create table if not exists paper(
+            'paper_id' text primary key,
+            'file_id' integer,
+            'offset' integer,
+            'length' integer,
+            'license' text,
+            'categories' text,
+            'discipline' text,
+            'update_date' text,
+            'language' text
+        ) without rowid
+    """)
+    db_cur.execute(
+        "create index if not exists paper_file on paper('file_id')"
+    )
+    for field in ['license', 'discipline', 'update_date']:
+        db_cur.execute(
+            "create index if not exists paper_{0} on paper('{0}')".format(
+                field
+            )
+        )
+
+
+def build_index(dataset_dir, index_fp, num_workers=None):
+    """ Create or update the index of all JSONL files in dataset_dir (and
+        its subdirectories, except for SKIP_DIRS).
+    """
+
+    conn = sqlite3.connect(index_fp)
+    db_cur = conn.cursor()
+    _create_tables(db_cur)
+    db_cur.execute(
+        "insert or replace into info values('root', ?)",
+        (os.path.abspath(dataset_dir),)
+    )
+    indexed = {
+        path: (file_id, size, mtime_ns)
+        for file_id, path, size, mtime_ns in db_cur.execute(
+            'select file_id, path, size, mtime_ns from file'
+        )
+    }
+    index_fp_abs = os.path.abspath(index_fp)
+    files = {}
+    for root, dirs, fns in os.walk(dataset_dir):
+        dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS)
+        for fn in sorted(fns):
+            path = os.path.join(root, fn)
+            if fn.endswith('.jsonl') and \
+                    os.path.abspath(path) != index_fp_abs:
+                stat = os.stat(path)
+                files[os.path.relpath(path, dataset_dir)] = (
+                    path, stat.st_size, stat.st_mtime_ns
+                )
+
+    # drop files that are gone or changed
+    todo = []
+    for rel_path, (file_id, size, mtime_ns) in indexed.items():
+        if rel_path in files and \
+                files[rel_path][1:] == (size, mtime_ns):
+            continue
+        db_cur.execute('delete from paper where file_id=?', (file_id,))
+        db_cur.execute('delete from file where file_id=?', (file_id,))
+    for rel_path, (path, size, mtime_ns) in files.items():
+        if rel_path in indexed and indexed[rel_path][1:] == (size, mtime_ns):
+            continue
+        todo.append((path, rel_path))
+    conn.commit()
+    print('{} files, {} to (re)index'.format(len(files), len(todo)))
+    # largest first
+    todo.sort(key=lambda task: files[task[1]][1], reverse=True)
+
+    num_papers = 0
+    num_duplicates = 0
+    with Pool(num_workers or os.cpu_count()) as pool:
+        for rel_path, rows in tqdm(
+                pool.imap_unordered(_index_rows, todo, chunksize=1),
+                total=len(todo), unit='files'
+        ):
+            _, size, mtime_ns = files[rel_path]
+            db_cur.execute(
+                'insert into file (path, size, mtime_ns) values(?,?,?)',
+                (rel_path, size, mtime_ns)
+            )
+            file_id = db_cur.lastrowid
+            before = conn.total_changes
+            db_cur.executemany(
+                (
+                    "insert or ignore into paper ('paper_id', 'file_id', "
+                    "'offset', 'length', 'license', 'categories', "
+                    "'discipline', 'update_date', 'language') "
+                    "values(?,?,?,?,?,?,?,?,?)"
+                ),
+                (row[:1] + (file_id,) + row[1:] for row in rows)
+            )
+            inserted = conn.total_changes - before
+            num_papers += inserted
+            num_duplicates += len(rows) - inserted
+            conn.commit()
+    conn.close()
+    print('{} papers indexed'.format(num_papers))
+    if num_duplicates > 0:
+        print('{} papers skipped (paper ID already indexed)'.format(
+            num_duplicates
+        ))
+
+
+class CorpusIndex:
+    """ Random access to papers and metadata queries via an index built
+        with build_index().
+
+        Usage:
+            with CorpusIndex('corpus_index.sqlite') as index:
+                paper = index.seek_paper('2310.00826')
+                for paper_id, *fields in index.papers(
+                        discipline='Physics', updated_from='2023-01-01'
+                ):
+                    ...
+
+        root overrides the dataset directory stored in the index (e.g.
+        when the corpus was moved).
+    """
+
+    def __init__(self, index_fp, root=None):
+        self.conn = sqlite3.connect(
+            'file:{}?mode=ro'.format(index_fp), uri=True
+        )
+        self.cur = self.conn.cursor()
+        if root is None:
+            root = self.cur.execute(
+                "select value from info where key='root'"
+            ).fetchone()[0]
+        self.root = root
+        self._files = {}  # file_id -> file descriptor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for fd in self._files.values():
+            os.close(fd)
+        self._files = {}
+        self.conn.close()
+
+    def _fd(self, file_id):
+        fd = self._files.get(file_id)
+        if fd is not None:
+            return fd
+        path, size, mtime_ns = self.cur.execute(
+            'select path, size, mtime_ns from file where file_id=?',
+            (file_id,)
+        ).fetchone()
+        fd = os.open(os.path.join(self.root, path), os.O_RDONLY)
+        stat = os.fstat(fd)
+        if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            os.close(fd)
+            raise ValueError(
+                '{} changed since it was indexed, rebuild the index'.format(
+                    path
+                )
+            )
+        self._files[file_id] = fd
+        return fd
+
+    def location(self, paper_id):
+        """ (path relative to the root, offset, length) of a paper's line,
+            or None if the paper isn't indexed.
+        """
+
+        return self.cur.execute(
+            (
+                'select file.path, paper.offset, paper.length '
+                'from paper join file using (file_id) where paper_id=?'
+            ),
+            (paper_id,)
+        ).fetchone()
+
+    def seek_paper_raw(self, paper_id):
+        """ JSON line of a paper as bytes, or None if the paper isn't
+            indexed.
+        """
+
+        row = self.cur.execute(
+            'select file_id, offset, length from paper where paper_id=?',
+            (paper_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        file_id, offset, length = row
+        return os.pread(self._fd(file_id), length, offset)
+
+    def seek_paper(self, paper_id):
+        """ Paper dict, or None if the paper isn't indexed.
+        """
+
+        line = self.seek_paper_raw(paper_id)
+        if line is None:
+            return None
+        return json.loads(line)
+
+    def papers(self, license=None, category=None, discipline=None,
+               language=None, updated_from=None, updated_to=None):
+        """ Yield (paper_id, *INDEX_FIELDS) of the papers matching all
+            given criteria. category matches any of a paper's arXiv
+            categories, updated_from/updated_to are inclusive ISO dates.
+        """
+
+        conditions = []
+        params = []
+        for field, value in [
+                ('license', license),
+                ('discipline', discipline),
+                ('language', language)
+        ]:
+            if value is not None:
+                conditions.append('{}=?'.format(field))
+                params.append(value)
+        if category is not None:
+            conditions.append("instr(' ' || categories || ' ', ?) > 0")
+            params.append(' {} '.format(category))
+        if updated_from is not None:
+            conditions.append('update_date>=?')
+            params.append(updated_from)
+        if updated_to is not None:
+            conditions.append('update_date<=?')
+            params.append(updated_to)
+        query = 'select paper_id, {} from paper'.format(
+            ', '.join(INDEX_FIELDS)
+        )
+        if len(conditions) > 0:
+            query += ' where ' + ' and '.join(conditions)
+        # (separate cursor, so seek_paper() can be used while iterating)
+        yield from self.conn.execute(query, params)
+
+    def __len__(self):
+        return self.cur.execute('select count(*) from paper').fetchone()[0]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [3, 4]:
+        print((
+            'Usage: python3 corpus_index.py <dataset_dir> <index_file> '
+            '[<num_workers>]'
+        ))
+        sys.exit()
+    num_workers = int(sys.argv[3]) if len(sys.argv) == 4 else None
+    build_index(sys.argv[1], sys.argv[2], num_workers)
@@ -0,0 +1,138 @@
+""" Asynchronous lookup of work titles by DOI in the Crossref API.
+"""
+
+import asyncio
+from urllib.parse import quote
+import aiohttp
+from rate_limit import AsyncTokenBucket
+
+CROSSREF_API_URL = 'https://api.crossref.org'
+CROSSREF_MAILTO = ''  # Add your e-mail here (Crossref "polite" pool)
+# Crossref's documented limit for the polite pool
+CROSSREF_REQUESTS_PER_SECOND = 10
+CROSSREF_CONCURRENCY = 5
+# attempts per DOI when Crossref answers 429 (too many requests)
+CROSSREF_ATTEMPTS = 3
+
+
+class CrossrefFetcher:
+    """ Fetches titles for sets of DOIs from Crossref with a shared
+        connection pool, at most `concurrency` requests in flight and at
+        most `requests_per_second` requests started per second.
+
+        Usable from synchronous code: every fetch_titles() call runs the
+        requests on an event loop owned by the fetcher. base_url can point
+        to a local stand-in for testing.
+
+        If a rate_limit.FileTokenBucket is given as rate_limiter, it
+        replaces the per-fetcher limit of requests_per_second, so that
+        several processes share one limit that also follows Crossref's
+        rate limit and Retry-After headers.
+
+        If a LookupCache is given, titles (and DOIs unknown to Crossref)
+        are cached in it under the namespace 'crossref'.
+    """
+
+    def __init__(self, base_url=CROSSREF_API_URL, mailto=CROSSREF_MAILTO,
+                 concurrency=CROSSREF_CONCURRENCY,
+                 requests_per_second=CROSSREF_REQUESTS_PER_SECOND,
+                 timeout=60, cache=None, rate_limiter=None):
+        self.base_url = base_url.rstrip('/')
+        self.mailto = mailto
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.cache = cache
+        self._loop = asyncio.new_event_loop()
+        self.rate_limiter = rate_limiter
+        self._local_rate_limiter = AsyncTokenBucket(requests_per_second)
+        self._semaphore = None
+        self._session = None
+
+    def close(self):
+        if self._session is not None:
+            self._loop.run_until_complete(self._session.close())
+        self._loop.close()
+
+    async def _fetch_title(self, doi):
+        """ Returns the title, False if Crossref has no title for the
+            DOI, or None if the request failed.
+        """
+
+        params = {'mailto': self.mailto} if self.mailto else None
+        async with self._semaphore:
+            for attempt in range(CROSSREF_ATTEMPTS):
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.acquire_async()
+                else:
+                    await self._local_rate_limiter.acquire()
+                try:
+                    async with self._session.get(
+                            '{}/works/{}'.format(self.base_url, quote(doi)),
+                            params=params
+                    ) as response:
+                        if self.rate_limiter is not None:
+                            self.rate_limiter.update_from_response(
+                                response.status, response.headers
+                            )
+                        if response.status == 429:
+                            continue
+                        if response.status == 404:
+                            # probably a faulty DOI
+                            return False
+                        if response.status != 200:
+                            print('Crossref status {} for DOI {}'.format(
+                                response.status, doi
+                            ))
+                            return None
+                        data = await response.json(content_type=None)
+                        break
+                except (aiohttp.ClientError, asyncio.TimeoutError,
+                        ValueError) as e:
+                    print('Error querying Crossref for DOI {}: {}'.format(
+                        doi, e
+                    ))
+                    return None
+            else:
+                print('Crossref rate limit exceeded for DOI {}'.format(doi))
+                return None
+        titles = (data.get('message') or {}).get('title') or []
+        if titles and titles[0]:
+            return titles[0]
+        return False
+
+    async def _fetch_titles(self, dois):
+        if self._session is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return await asyncio.gather(*[self._fetch_title(doi) for doi in dois])
+
+    def fetch_titles(self, dois):
+        """ Fetch the titles of a collection of DOIs.
+
+            Returns a dict mapping DOIs to their title, or False if
+            Crossref has none. DOIs whose request failed are missing.
+        """
+
+        titles = {}
+        todo = []
+        for doi in dict.fromkeys(dois):
+            if self.cache is not None:
+                hit, title = self.cache.get('crossref', doi)
+                if hit:
+                    titles[doi] = title
+                    continue
+            todo.append(doi)
+        if not todo:
+            return titles
+        results = self._loop.run_until_complete(self._fetch_titles(todo))
+        new_titles = [
+            (doi, title) for doi, title in zip(todo, results)
+            if title is not None
+        ]
+        titles.update(new_titles)
+        if self.cache is not None:
+            self.cache.set_many('crossref', new_titles)
+        return titles
@@ -1,8 +1,23 @@
+import asyncio
 import json
 import re
 from urllib.parse import quote
+import aiohttp
 import requests
 from langdetect import detect
+from normalization import normalize_title
+from rate_limit import AsyncTokenBucket, retry_after_seconds
+
+OPENALEX_API_URL = 'https://api.openalex.org'
+# DOIs per OpenAlex filter=doi:a|b|c request (the API allows up to 100
+# values per filter)
+DOI_BATCH_SIZE = 50
+# attempts per request while OpenAlex answers 429 Too Many Requests, and
+# the initial back-off in seconds (doubled per attempt) if the response
+# has no Retry-After header
+OPENALEX_ATTEMPTS = 4
+OPENALEX_BACKOFF = 1.0
+OPENALEX_MAX_BACKOFF = 60.0
 
 
 def clean_title(title):
@@ -47,10 +62,249 @@ def fetch_citation_count_and_language(doi, title):
 
     return None, None
 
-def enrich_metadata(paper,paper_info):
-    doi = paper_info["metadata"].get("doi")
-    title = paper_info["metadata"].get("title")
-    citation_count, language = fetch_citation_count_and_language(doi, title)
+
+def _batchable_doi(doi):
+    # "|" and "," are the value and filter separators of the OpenAlex API
+    return '|' not in doi and ',' not in doi
+
+
+def normalize_doi(doi):
+    doi = doi.strip().lower()
+    if doi.startswith('https://doi.org/'):
+        doi = doi[len('https://doi.org/'):]
+    return doi
+
+
+class AsyncEnricher:
+    """ Looks up cited_by_count and language of papers in OpenAlex with
+        a shared connection pool, at most `concurrency` requests in flight
+        and at most `requests_per_second` requests started per second
+        (None for no limit).
+
+        DOIs are resolved in batches via filter=doi:a|b|c queries. Papers
+        without a DOI or whose DOI result doesn't match their title fall
+        back to a title search, as in fetch_citation_count_and_language().
+
+        If a LookupCache is given, responses are cached in it and only
+        looked up in OpenAlex if not cached.
+
+        Usage:
+            async with AsyncEnricher(concurrency=8) as enricher:
+                results = await enricher.lookup_many([(doi, title), ...])
+    """
+
+    def __init__(self, base_url=OPENALEX_API_URL, concurrency=8,
+                 requests_per_second=10, timeout=10, cache=None):
+        self.base_url = base_url.rstrip('/')
+        self.cache = cache
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._rate_limiter = AsyncTokenBucket(requests_per_second)
+        self._semaphore = None
+        self._session = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(total=self.timeout)
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._session.close()
+
+    async def _get_json(self, url, params):
+        """ Returns a tuple (HTTP status, JSON response or None). Requests
+            answered with 429 are retried with back-off.
+        """
+
+        for attempt in range(OPENALEX_ATTEMPTS):
+            async with self._semaphore:
+                await self._rate_limiter.acquire()
+                async with self._session.get(url, params=params) as response:
+                    status = response.status
+                    if status == 200:
+                        try:
+                            return status, await response.json()
+                        except ValueError:
+                            # invalid JSON body
+                            return status, None
+                    if status != 429 or attempt == OPENALEX_ATTEMPTS - 1:
+                        return status, None
+                    wait = retry_after_seconds(
+                        response.headers.get('Retry-After', '')
+                    )
+            if wait is None:
+                wait = OPENALEX_BACKOFF * 2 ** attempt
+            # (sleeping outside of the semaphore frees the slot)
+            await asyncio.sleep(min(wait, OPENALEX_MAX_BACKOFF))
+
+    def _cache_set(self, namespace, query, value):
+        if self.cache is not None:
+            self.cache.set(namespace, query, value)
+
+    async def _lookup_dois(self, dois):
+        """ Map of DOI keys to OpenAlex work dicts (None if there is no
+            work) for a batch of DOIs, or None if the request failed.
+
+            A batch rejected with a 4xx status (e.g. because of a DOI
+            OpenAlex can't parse) is split in halves down to single DOIs,
+            so that only the offending DOIs are left out.
+        """
+
+        params = {
+            'filter': 'doi:{}'.format('|'.join(dois)),
+            'per-page': str(len(dois)),
+            'select': 'doi,title,cited_by_count,language'
+        }
+        try:
+            status, data = await self._get_json(
+                '{}/works'.format(self.base_url), params
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Error querying DOI batch of size {len(dois)}: {e}")
+            return None
+        if data is None:
+            if 400 <= status < 500 and status != 429:
+                if len(dois) == 1:
+                    return await self._lookup_single_doi(dois[0])
+                half = len(dois) // 2
+                works = {}
+                for part in await asyncio.gather(
+                        self._lookup_dois(dois[:half]),
+                        self._lookup_dois(dois[half:])
+                ):
+                    works.update(part or {})
+                return works
+            return None
+        works = dict.fromkeys(dois)
+        for work in data.get('results', []):
+            if work.get('doi'):
+                works[normalize_doi(work['doi'])] = work
+        return works
+
+    async def _lookup_single_doi(self, doi):
+        encoded_doi = quote(f"https://doi.org/{doi}")
+        try:
+            status, data = await self._get_json(
+                '{}/works/{}'.format(self.base_url, encoded_doi), None
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Error querying DOI {doi}: {e}")
+            return None
+        if status == 404:
+            return {doi: None}
+        if data is None:
+            return None
+        return {doi: data}
+
+    async def _lookup_title(self, title):
+        title = title.strip()
+        # (titles differing only in case, whitespace or punctuation share
+        # a cache entry)
+        cache_key = normalize_title(title)
+        if self.cache is not None:
+            hit, result = self.cache.get('openalex_title', cache_key)
+            if hit:
+                return result
+        quoted_title = quote(f'"{title}"')
+        try:
+            status, data = await self._get_json(
+                '{}/works?filter=title.search:{}'.format(
+                    self.base_url, quoted_title
+                ),
+                None
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Error querying title: {e}")
+            return None
+        if data is None:
+            return None
+        results = data.get("results", [])
+        result = None
+        if results:
+            result = {
+                key: results[0].get(key)
+                for key in ['title', 'cited_by_count', 'language']
+            }
+        self._cache_set('openalex_title', cache_key, result)
+        return result
+
+    async def lookup_many(self, items):
+        """ Look up a list of (doi, title) tuples.
+
+            Returns a list of (cited_by_count, language) tuples in the
+            order of items.
+        """
+
+        results = [(None, None)] * len(items)
+        dois = sorted({
+            normalize_doi(doi) for doi, title in items if doi and title
+        })
+        works = {}
+        if self.cache is not None:
+            uncached_dois = []
+            for doi in dois:
+                hit, work = self.cache.get('openalex_doi', doi)
+                if hit:
+                    works[doi] = work
+                else:
+                    uncached_dois.append(doi)
+            dois = uncached_dois
+        batchable = [doi for doi in dois if _batchable_doi(doi)]
+        doi_tasks = [
+            self._lookup_dois(batchable[i:i+DOI_BATCH_SIZE])
+            for i in range(0, len(batchable), DOI_BATCH_SIZE)
+        ] + [
+            self._lookup_single_doi(doi)
+            for doi in dois if not _batchable_doi(doi)
+        ]
+        for batch_works in await asyncio.gather(*doi_tasks):
+            if batch_works is None:
+                continue
+            for doi, work in batch_works.items():
+                self._cache_set('openalex_doi', doi, work)
+            works.update(batch_works)
+
+        fallback_idxs = []
+        for idx, (doi, title) in enumerate(items):
+            if not doi and not title:
+                continue
+            work = works.get(normalize_doi(doi)) if doi else None
+            if work is not None and \
+                    clean_title(work.get("title", "")) == clean_title(title):
+                results[idx] = (
+                    work.get("cited_by_count"), work.get("language")
+                )
+            elif title:
+                fallback_idxs.append(idx)
+        title_results = await asyncio.gather(*[
+            self._lookup_title(items[idx][1]) for idx in fallback_idxs
+        ])
+        for idx, result in zip(fallback_idxs, title_results):
+            if result is not None and \
+                    clean_title(result.get("title", "")) == \
+                    clean_title(items[idx][1]):
+                results[idx] = (
+                    result.get("cited_by_count"), result.get("language")
+                )
+        return results
+
+
+def enrich_metadata(paper, paper_info, citation_info=None):
+    """ Add language and cited_by_count to paper_info["metadata"].
+
+        citation_info is a (cited_by_count, language) tuple looked up
+        beforehand (e.g. by AsyncEnricher). If not given, it is fetched
+        with blocking requests.
+    """
+
+    if citation_info is None:
+        doi = paper_info["metadata"].get("doi")
+        title = paper_info["metadata"].get("title")
+        citation_info = fetch_citation_count_and_language(doi, title)
+    citation_count, language = citation_info
 
     if language is None:
         abstract_text = paper.get("abstract", {}).get("text", "")
@@ -0,0 +1,453 @@
+""" Export of the JSONL corpus to Parquet.
+
+    Papers are split into four datasets of their own, so that e.g.
+    metadata-only jobs don't read sections or bib entries:
+
+        <out_dir>/metadata/     one row per paper
+        <out_dir>/sections/     one row per section (or body_text paragraph)
+        <out_dir>/bib_entries/  one row per bib entry
+        <out_dir>/ref_entries/  one row per formula, figure and table
+
+    Each dataset is Hive partitioned by the year and month of the arXiv ID
+    and by discipline, e.g. metadata/yymm=2310/discipline=Physics/, and
+    can be read with open_dataset(), e.g.
+        open_dataset(out_dir, 'metadata').to_table(
+            columns=['paper_id', 'license'],
+            filter=pyarrow.dataset.field('discipline') == 'Physics'
+        )
+    Rows are linked by paper_id. Fields without a column of their own are
+    kept as JSON in the 'extra' column of each dataset.
+"""
+
+import json
+import os
+import re
+import sys
+from multiprocessing import Pool
+from urllib.parse import quote
+import pyarrow as pa
+import pyarrow.dataset as pa_ds
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+ARXIV_ID_PATT = re.compile(r'^(?:[a-zA-Z-\.]+\/)?(\d\d)(\d\d)')
+# partition value for missing yymm/discipline (pyarrow reads it as null)
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+# rows buffered per table and partition before a row group is written
+ROW_GROUP_SIZE = 10000
+PARQUET_COMPRESSION = 'zstd'
+# subset written into the dataset directory by filter_license.py
+SKIP_DIRS = ['permissive_subset']
+
+# (yymm as string, so that e.g. 0704 keeps its leading zero)
+PARTITION_SCHEMA = pa.schema([
+    ('yymm', pa.string()),
+    ('discipline', pa.string())
+])
+SPAN = pa.struct([
+    ('start', pa.int64()),
+    ('end', pa.int64()),
+    ('text', pa.string()),
+    ('ref_id', pa.string())
+])
+METADATA_COLUMNS = [
+    # (column, metadata key, type)
+    ('id', 'id', pa.string()),
+    ('submitter', 'submitter', pa.string()),
+    ('authors', 'authors', pa.string()),
+    ('title', 'title', pa.string()),
+    ('comments', 'comments', pa.string()),
+    ('journal_ref', 'journal-ref', pa.string()),
+    ('doi', 'doi', pa.string()),
+    ('report_no', 'report-no', pa.string()),
+    ('categories', 'categories', pa.string()),
+    ('license', 'license', pa.string()),
+    ('abstract', 'abstract', pa.string()),
+    ('versions', 'versions', pa.list_(pa.struct([
+        ('version', pa.string()),
+        ('created', pa.string())
+    ]))),
+    ('update_date', 'update_date', pa.string()),
+    ('authors_parsed', 'authors_parsed', pa.list_(pa.list_(pa.string()))),
+    ('language', 'language', pa.string()),
+    ('cited_by_count', 'cited_by_count', pa.int64())
+]
+SCHEMAS = {
+    'metadata': pa.schema(
+        [('paper_id', pa.string())] +
+        [(column, pa_type) for column, _, pa_type in METADATA_COLUMNS] +
+        [('extra', pa.string())]
+    ),
+    'sections': pa.schema([
+        ('paper_id', pa.string()),
+        ('position', pa.int32()),
+        ('section', pa.string()),
+        ('text', pa.string()),
+        ('cite_spans', pa.list_(SPAN)),
+        ('ref_spans', pa.list_(SPAN)),
+        ('extra', pa.string())
+    ]),
+    'bib_entries': pa.schema([
+        ('paper_id', pa.string()),
+        ('bib_entry_id', pa.string()),
+        ('bib_entry_raw', pa.string()),
+        ('contained_arXiv_ids', pa.list_(pa.struct([
+            ('id', pa.string()),
+            ('text', pa.string()),
+            ('start', pa.int64()),
+            ('end', pa.int64())
+        ]))),
+        ('contained_links', pa.list_(pa.struct([
+            ('url', pa.string()),
+            ('text', pa.string()),
+            ('start', pa.int64()),
+            ('end', pa.int64())
+        ]))),
+        ('ids', pa.struct([
+            ('open_alex_id', pa.string()),
+            ('sem_open_alex_id', pa.string()),
+            ('pubmed_id', pa.string()),
+            ('pmc_id', pa.string()),
+            ('doi', pa.string()),
+            ('arxiv_id', pa.string())
+        ])),
+        ('extra', pa.string())
+    ]),
+    'ref_entries': pa.schema([
+        ('paper_id', pa.string()),
+        ('ref_id', pa.string()),
+        ('type', pa.string()),
+        ('caption', pa.string()),
+        ('latex', pa.string()),
+        ('extra', pa.string())
+    ])
+}
+
+
+def _extra(dct, known_keys):
+    """ JSON of the items of a dict that have no column, or None.
+    """
+
+    extra = {k: v for k, v in dct.items() if k not in known_keys}
+    if len(extra) == 0:
+        return None
+    return json.dumps(extra, ensure_ascii=False)
+
+
+def _str(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _int(value):
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _spans(spans, fields):
+    """ List of span dicts reduced to the given fields, given as dict
+        {field: True if integer}.
+    """
+
+    return [
+        {
+            field: (_int if to_int else _str)(span.get(field))
+            for field, to_int in fields.items()
+        }
+        for span in spans or [] if isinstance(span, dict)
+    ]
+
+
+def partition_key(paper):
+    """ (yymm, discipline) of a paper.
+    """
+
+    yymm = None
+    yymm_m = ARXIV_ID_PATT.match(paper.get('paper_id') or '')
+    if yymm_m is not None:
+        yymm = yymm_m.group(1) + yymm_m.group(2)
+    discipline = (paper.get('metadata') or {}).get('discipline')
+    return yymm, discipline
+
+
+def paper_rows(paper):
+    """ Rows of a paper per dataset, as a dict {dataset: list of rows}.
+    """
+
+    paper_id = paper.get('paper_id')
+    metadata = paper.get('metadata') or {}
+    # metadata
+    metadata_row = {'paper_id': paper_id}
+    for column, key, pa_type in METADATA_COLUMNS:
+        value = metadata.get(key)
+        if pa_type == pa.int64():
+            value = _int(value)
+        elif pa_type == pa.string():
+            value = _str(value)
+        metadata_row[column] = value
+    # (fields derived from the metadata and top level fields other than
+    # the ones exported to separate datasets)
+    extra = {
+        k: v for k, v in metadata.items()
+        if k not in [key for _, key, _ in METADATA_COLUMNS] and
+        k != 'discipline'
+    }
+    if len(extra) > 0:
+        extra = {'metadata': extra}
+    extra.update({
+        k: v for k, v in paper.items() if k not in [
+            'paper_id', 'metadata', 'sections', 'body_text', 'bib_entries',
+            'ref_entries'
+        ]
+    })
+    metadata_row['extra'] = json.dumps(extra, ensure_ascii=False) \
+        if len(extra) > 0 else None
+    # valid versions/authors_parsed or none
+    if not isinstance(metadata_row['versions'], list) or not all(
+            isinstance(v, dict) for v in metadata_row['versions']
+    ):
+        metadata_row['versions'] = None
+    else:
+        metadata_row['versions'] = [
+            {'version': _str(v.get('version')),
+             'created': _str(v.get('created'))}
+            for v in metadata_row['versions']
+        ]
+    if not isinstance(metadata_row['authors_parsed'], list) or not all(
+            isinstance(a, list) for a in metadata_row['authors_parsed']
+    ):
+        metadata_row['authors_parsed'] = None
+    else:
+        metadata_row['authors_parsed'] = [
+            [_str(name_part) for name_part in author]
+            for author in metadata_row['authors_parsed']
+        ]
+
+    # sections (grouped) or paragraphs (not grouped yet)
+    span_fields = {'start': True, 'end': True, 'text': False, 'ref_id': False}
+    if isinstance(paper.get('sections'), dict):
+        blocks = [
+            dict(block, section=section)
+            for section, block in paper['sections'].items()
+        ]
+    else:
+        blocks = paper.get('body_text') or []
+    section_rows = []
+    for position, block in enumerate(blocks):
+        section_rows.append({
+            'paper_id': paper_id,
+            'position': position,
+            'section': _str(block.get('section')),
+            'text': _str(block.get('text')),
+            'cite_spans': _spans(block.get('cite_spans'), span_fields),
+            'ref_spans': _spans(block.get('ref_spans'), span_fields),
+            'extra': _extra(
+                block, ['section', 'text', 'cite_spans', 'ref_spans']
+            )
+        })
+
+    bib_entry_rows = []
+    for bib_entry_id, bib_entry in (paper.get('bib_entries') or {}).items():
+        ids = bib_entry.get('ids')
+        bib_entry_rows.append({
+            'paper_id': paper_id,
+            'bib_entry_id': bib_entry_id,
+            'bib_entry_raw': _str(bib_entry.get('bib_entry_raw')),
+            'contained_arXiv_ids': _spans(
+                bib_entry.get('contained_arXiv_ids'),
+                {'id': False, 'text': False, 'start': True, 'end': True}
+            ),
+            'contained_links': _spans(
+                bib_entry.get('contained_links'),
+                {'url': False, 'text': False, 'start': True, 'end': True}
+            ),
+            'ids': {
+                k: _str(ids.get(k)) for k in [
+                    'open_alex_id', 'sem_open_alex_id', 'pubmed_id',
+                    'pmc_id', 'doi', 'arxiv_id'
+                ]
+            } if isinstance(ids, dict) else None,
+            'extra': _extra(bib_entry, [
+                'bib_entry_raw', 'contained_arXiv_ids', 'contained_links',
+                'ids'
+            ])
+        })
+
+    ref_entry_rows = []
+    for ref_id, ref_entry in (paper.get('ref_entries') or {}).items():
+        ref_entry_rows.append({
+            'paper_id': paper_id,
+            'ref_id': ref_id,
+            'type': _str(ref_entry.get('type')),
+            'caption': _str(ref_entry.get('caption')),
+            'latex': _str(ref_entry.get('latex')),
+            'extra': _extra(ref_entry, ['type', 'caption', 'latex'])
+        })
+
+    return {
+        'metadata': [metadata_row],
+        'sections': section_rows,
+        'bib_entries': bib_entry_rows,
+        'ref_entries': ref_entry_rows
+    }
+
+
+class PartitionedParquetWriter:
+    """ Writes the rows of the four datasets into one Parquet file per
+        dataset and partition,
+            <out_dir>/<dataset>/yymm=<yymm>/discipline=<discipline>/<name>
+        buffering ROW_GROUP_SIZE rows per file. Files are written as .part
+        files and renamed on close().
+    """
+
+    def __init__(self, out_dir, name):
+        self.out_dir = out_dir
+        self.name = name
+        self.buffers = {}  # (dataset, yymm, discipline) -> rows
+        self.writers = {}  # (dataset, yymm, discipline) -> (writer, path)
+        self.row_counts = {dataset: 0 for dataset in SCHEMAS}
+
+    def _path(self, dataset, yymm, discipline):
+        return os.path.join(
+            self.out_dir,
+            dataset,
+            'yymm={}'.format(yymm if yymm is not None else NULL_PARTITION),
+            'discipline={}'.format(
+                quote(discipline, safe='')
+                if discipline is not None else NULL_PARTITION
+            ),
+            '{}.parquet'.format(self.name)
+        )
+
+    def write(self, paper):
+        yymm, discipline = partition_key(paper)
+        for dataset, rows in paper_rows(paper).items():
+            if len(rows) == 0:
+                continue
+            key = (dataset, yymm, discipline)
+            buffer = self.buffers.setdefault(key, [])
+            buffer.extend(rows)
+            if len(buffer) >= ROW_GROUP_SIZE:
+                self._flush(key)
+
+    def _flush(self, key):
+        rows = self.buffers.pop(key, [])
+        if len(rows) == 0:
+            return
+        dataset = key[0]
+        if key not in self.writers:
+            path = self._path(*key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            writer = pq.ParquetWriter(
+                path + '.part',
+                SCHEMAS[dataset],
+                compression=PARQUET_COMPRESSION
+            )
+            self.writers[key] = (writer, path)
+        self.writers[key][0].write_table(
+            pa.Table.from_pylist(rows, schema=SCHEMAS[dataset])
+        )
+        self.row_counts[dataset] += len(rows)
+
+    def close(self):
+        for key in list(self.buffers):
+            self._flush(key)
+        for writer, path in self.writers.values():
+            writer.close()
+            os.replace(path + '.part', path)
+        self.writers = {}
+
+
+def open_dataset(out_dir, dataset):
+    """ pyarrow Dataset of an export, with columns yymm and discipline
+        from the partitioning.
+    """
+
+    return pa_ds.dataset(
+        os.path.join(out_dir, dataset),
+        format='parquet',
+        partitioning=pa_ds.partitioning(PARTITION_SCHEMA, flavor='hive')
+    )
+
+
+def export_file(params):
+    """ Export a JSONL file. Returns (path, number of papers, rows per
+        dataset).
+    """
+
+    in_fp, name, out_dir = params
+    writer = PartitionedParquetWriter(out_dir, name)
+    num_papers = 0
+    with open(in_fp, encoding='utf-8') as f:
+        for line in f:
+            if len(line.strip()) == 0:
+                continue
+            try:
+                paper = json.loads(line)
+            except json.JSONDecodeError as e:
+                print('skipping malformed line in {}: {}'.format(in_fp, e))
+                continue
+            writer.write(paper)
+            num_papers += 1
+    writer.close()
+    return in_fp, num_papers, writer.row_counts
+
+
+def export(in_dir, out_dir, num_workers=None):
+    """ Export all JSONL files in in_dir (and its subdirectories, except
+        for SKIP_DIRS and out_dir) to Parquet datasets in out_dir.
+    """
+
+    out_dir_abs = os.path.abspath(out_dir)
+    tasks = []
+    for root, dirs, files in os.walk(in_dir):
+        dirs[:] = sorted(
+            d for d in dirs if d not in SKIP_DIRS and
+            os.path.abspath(os.path.join(root, d)) != out_dir_abs
+        )
+        for fn in sorted(files):
+            if not fn.endswith('.jsonl'):
+                continue
+            in_fp = os.path.join(root, fn)
+            # unique per input file, so workers never write the same file
+            name = os.path.splitext(
+                os.path.relpath(in_fp, in_dir)
+            )[0].replace(os.sep, '__')
+            tasks.append((in_fp, name, out_dir))
+    # largest first
+    tasks.sort(key=lambda task: os.path.getsize(task[0]), reverse=True)
+
+    num_papers = 0
+    row_counts = {dataset: 0 for dataset in SCHEMAS}
+    with Pool(num_workers) as pool:
+        for in_fp, file_papers, file_row_counts in tqdm(
+                pool.imap_unordered(export_file, tasks, chunksize=1),
+                total=len(tasks), unit='files'
+        ):
+            num_papers += file_papers
+            for dataset, n in file_row_counts.items():
+                row_counts[dataset] += n
+    print('{} papers exported: {}'.format(num_papers, ', '.join(
+        '{} {} rows'.format(n, dataset) for dataset, n in row_counts.items()
+    )))
+    for dataset in SCHEMAS:
+        size = 0
+        for root, _, files in os.walk(os.path.join(out_dir, dataset)):
+            size += sum(
+                os.path.getsize(os.path.join(root, fn)) for fn in files
+            )
+        print('{}: {:.1f} MB'.format(dataset, size / 1024**2))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [3, 4]:
+        print((
+            'Usage: python3 export_parquet.py <dataset_dir> <out_dir> '
+            '[<num_workers>]'
+        ))
+        sys.exit()
+    num_workers = int(sys.argv[3]) if len(sys.argv) == 4 else None
+    export(sys.argv[1], sys.argv[2], num_workers)
@@ -1,6 +1,5 @@
 import os
 import json
-from arxive_taxonomy/arxiv_taxonomy import GROUPS, ARCHIVES, CATEGORIES, ARCHIVES_SUBSUMED, CATEGORY_ALIASES
 import sys
 from pathlib import Path
 
@@ -9,6 +8,9 @@ from pathlib import Path
 _TAXONOMY_DIR = Path(__file__).resolve().parent / "arxive_taxonomy"
 sys.path.insert(0, str(_TAXONOMY_DIR))
 
+from arxiv_taxonomy import GROUPS, ARCHIVES, CATEGORIES, ARCHIVES_SUBSUMED, CATEGORY_ALIASES
+from jsonl_io import lazy_fields, replace_field
+
 def get_discipline(categories: str | None):
     if categories:
         categories = categories.split()
@@ -32,12 +34,19 @@ def process_jsonl_file(filepath: str):
     temp_path = filepath + ".tmp"
     with open(filepath, "r", encoding="utf-8") as infile, open(temp_path, "w", encoding="utf-8") as outfile:
         for line in infile:
-            data = json.loads(line)
-            metadata = data.get("metadata", {})
+            # only the metadata is decoded and re-encoded, the rest of the
+            # line is copied as is
+            fields = lazy_fields(line, ["metadata"])
+            if "metadata" not in fields:
+                data = json.loads(line)
+                data["metadata"] = {"discipline": None}
+                outfile.write(json.dumps(data) + "\n")
+                continue
+            metadata = fields["metadata"][0]
             categories = metadata.get("categories", "")
             metadata["discipline"] = get_discipline(categories)
-            data["metadata"] = metadata
-            outfile.write(json.dumps(data) + "\n")
+            line = replace_field(line, fields["metadata"], metadata)
+            outfile.write(line if line.endswith("\n") else line + "\n")
     os.replace(temp_path, filepath)
 
 
@@ -2,6 +2,11 @@ import json
 import os
 from collections import defaultdict
 from multiprocessing import Pool, cpu_count
+from jsonl_io import lazy_metadata
+
+# decode and validate the whole of each line instead of only the metadata
+# (slower; by default a line is only checked to be complete)
+VALIDATE_LINES = False
 
 def is_permissive(license_url):
     if license_url is None or license_url not in [
@@ -25,38 +30,36 @@ def is_permissive(license_url):
 def tag_and_save_parallel(args):
     fp_full, out_dir_subset = args
     license_counts = defaultdict(int)
-    updated_papers = []
-    permissive_papers = []
+    num_papers = 0
+    num_permissive = 0
 
     try:
-        with open(fp_full, 'r', encoding='utf-8') as infile:
+        # only the metadata of each paper is decoded; permissive papers are
+        # copied line by line
+        os.makedirs(out_dir_subset, exist_ok=True)
+        subset_path = os.path.join(out_dir_subset, os.path.basename(fp_full))
+        with open(fp_full, 'r', encoding='utf-8') as infile, \
+                open(subset_path, 'w', encoding='utf-8') as f:
             for line in infile:
                 try:
-                    ppr = json.loads(line.strip())
+                    metadata = lazy_metadata(line, validate=VALIDATE_LINES)
+                    if not line.rstrip().endswith('}'):
+                        # e.g. cut off by an interrupted write
+                        raise json.JSONDecodeError(
+                            'Truncated line', line, len(line.rstrip())
+                        )
                 except json.JSONDecodeError as e:
                     print(f"[ERROR] Skipping malformed line in {fp_full}: {e}")
                     continue
 
-                metadata = ppr.get("metadata", {})
-                license_url = metadata.get("license")
+                license_url = (metadata or {}).get("license")
                 license_counts[license_url] += 1
-                updated_papers.append(ppr)
+                num_papers += 1
                 if is_permissive(license_url):
-                    permissive_papers.append(ppr)
-
-        # Overwrite original file
-        with open(fp_full, 'w', encoding='utf-8') as f:
-            for ppr in updated_papers:
-                f.write(json.dumps(ppr) + '\n')
-
-        # Write permissive papers
-        os.makedirs(out_dir_subset, exist_ok=True)
-        subset_path = os.path.join(out_dir_subset, os.path.basename(fp_full))
-        with open(subset_path, 'w', encoding='utf-8') as f:
-            for ppr in permissive_papers:
-                f.write(json.dumps(ppr) + '\n')
+                    num_permissive += 1
+                    f.write(line if line.endswith('\n') else line + '\n')
 
-        print(f'[ {os.path.basename(fp_full)} ] Total: {len(updated_papers)}, Permissive: {len(permissive_papers)}')
+        print(f'[ {os.path.basename(fp_full)} ] Total: {num_papers}, Permissive: {num_permissive}')
         return dict(license_counts)
     
     except Exception as e:
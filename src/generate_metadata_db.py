@@ -1,17 +1,164 @@
 """ From an arXiv metadata snapshot as provided by
         https://www.kaggle.com/Cornell-University/arxiv
     generate an SQLite database with indices for performant access.
+
+    See meta_db.py for the supported schema versions.
 """
 
 import json
 import os
+import random
 import re
 import sqlite3
 import sys
+import time
+from jsonl_io import iter_line_batches
+from meta_db import (
+    MetadataDB, SCHEMA_V1, SCHEMA_V2, compress_json, schema_version
+)
+from normalization import normalize_title
+from collections import deque
+from multiprocessing import Pool
 from tqdm import tqdm
 
+AID_PATT = re.compile(r'^(.*\/)?(\d\d)(\d\d).*$')
+# snapshot lines handed to a bulk load worker at once
+BULK_BATCH_SIZE = 5000
+# SQLite page cache used during bulk loads
+BULK_CACHE_SIZE_KIB = 1024 * 1024
+
+
+def _create_table(db_cur, schema):
+    if schema == SCHEMA_V2:
+        db_cur.execute("""
+            create table paper(
+                'aid' text primary key,
+                'year' integer,
+                'month' integer,
+                'title' text,
+                'title_norm' text,
+                'json' blob
+            ) without rowid
+        """)
+        db_cur.execute('pragma user_version = {}'.format(SCHEMA_V2))
+    else:
+        db_cur.execute("""
+            create table paper(
+                'year' integer,
+                'month' integer,
+                'aid' text,
+                'title' text,
+                'json' text
+            )
+        """)
+
+
+def _create_indices(db_cur, schema):
+    db_cur.execute(
+          "create index ym  on paper('year', 'month')"
+      )
+    if schema == SCHEMA_V2:
+        db_cur.execute(
+            "create index title_norm on paper('title_norm')"
+        )
+
+
+def _metadata_row(line, schema):
+    """ Row to insert for a line of the metadata snapshot, in the column
+        order of _bulk_insert_rows().
+    """
+
+    ppr_meta = json.loads(line)['metadata']  # Access only 'metadata' part
+    aid_m = AID_PATT.match(ppr_meta['id'])
+    assert aid_m is not None
+    aid = aid_m.group(0)
+    y = int(aid_m.group(2))
+    m = int(aid_m.group(3))
+    title = ppr_meta['title']
+    if schema == SCHEMA_V2:
+        return (
+            aid, y, m, title, normalize_title(title), compress_json(line)
+        )
+    return (y, m, aid, title, line)
+
+
+def _metadata_rows(lines, schema):
+    """ Rows and error messages for a batch of lines (bytes) of the
+        metadata snapshot.
+    """
+
+    rows = []
+    errors = []
+    for line in lines:
+        try:
+            rows.append(_metadata_row(line.decode('utf-8').strip(), schema))
+        except (UnicodeDecodeError, json.JSONDecodeError, KeyError,
+                AssertionError) as e:
+            errors.append(str(e))
+    return rows, errors
+
+
+def _bulk_insert_rows(db_cur, schema, rows):
+    if schema == SCHEMA_V2:
+        db_cur.executemany(
+            (
+                "insert or replace into paper "
+                "('aid','year','month','title','title_norm','json')"
+                "values(?,?,?,?,?,?)"
+            ),
+            rows
+        )
+    else:
+        db_cur.executemany(
+            (
+                "insert into paper "
+                "('year','month','aid','title','json')"
+                "values(?,?,?,?,?)"
+            ),
+            rows
+        )
 
-def gen_meta_db(in_fp, output_dir):
+
+def _bulk_load(in_fp, conn, schema, num_workers):
+    """ Fill the paper table in a single pass over the snapshot. Lines are
+        parsed in worker processes and inserted in batches.
+    """
+
+    db_cur = conn.cursor()
+    # the DB is built from scratch, so there is nothing to protect while
+    # loading; a failed load is simply rerun
+    db_cur.execute('pragma journal_mode = OFF')
+    db_cur.execute('pragma synchronous = OFF')
+    db_cur.execute('pragma cache_size = {}'.format(-BULK_CACHE_SIZE_KIB))
+    db_cur.execute('pragma temp_store = MEMORY')
+
+    def insert(result):
+        rows, errors = result
+        for error in errors:
+            print(f"Skipping malformed entry in {in_fp}: {error}")
+        _bulk_insert_rows(db_cur, schema, rows)
+
+    print('filling table')
+    # (lines are read as bytes and decoded by the workers, so the progress
+    # bar counts bytes like its total)
+    with open(in_fp, 'rb') as f, \
+            tqdm(total=os.path.getsize(in_fp), unit='B', unit_scale=True) as pbar, \
+            Pool(num_workers) as pool:
+        # keep the number of batches in flight bounded
+        pending = deque()
+        for batch in iter_line_batches(f, BULK_BATCH_SIZE):
+            pending.append(
+                pool.apply_async(_metadata_rows, (batch, schema))
+            )
+            pbar.update(sum(len(line) for line in batch))
+            if len(pending) > 2 * num_workers:
+                insert(pending.popleft().get())
+        while pending:
+            insert(pending.popleft().get())
+
+
+def gen_meta_db(in_fp, output_dir, schema=SCHEMA_V1, bulk=False,
+                num_workers=None):
     # input prep
     in_path, in_fn = os.path.split(in_fp)
     in_fn_base, ext = os.path.splitext(in_fn)
@@ -19,7 +166,7 @@ def gen_meta_db(in_fp, output_dir):
     # output prep
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-        
+
     # Before processing, check if the SQLite file already exists and skip if it does.
     out_fp = os.path.join(output_dir, '{}.sqlite'.format(in_fn_base))
     if os.path.exists(out_fp):
@@ -28,59 +175,160 @@ def gen_meta_db(in_fp, output_dir):
 
     conn = sqlite3.connect(out_fp)
     db_cur = conn.cursor()
-    db_cur.execute("""
-        create table paper(
-            'year' integer,
-            'month' integer,
-            'aid' text,
-            'title' text,
-            'json' text
-        )
-    """)
+    _create_table(db_cur, schema)
 
-    aid_patt = re.compile(r'^(.*\/)?(\d\d)(\d\d).*$')
+    if bulk:
+        _bulk_load(in_fp, conn, schema, num_workers or os.cpu_count())
+        print('generating index')
+        _create_indices(db_cur, schema)
+        conn.commit()
+        return
 
     num_lines = sum(1 for i in open(in_fp, 'rb'))
     print('filling table')
     with open(in_fp) as f:
         for line in tqdm(f, total=num_lines):
             try:
-                ppr_meta = json.loads(line.strip())['metadata']  # Access only 'metadata' part
-                aid_m = aid_patt.match(ppr_meta['id'])
-                assert aid_m is not None
-                aid = aid_m.group(0)
-                y = int(aid_m.group(2))
-                m = int(aid_m.group(3))
-                title = ppr_meta['title']
-                db_cur.execute(
-                    (
-                        "insert into paper "
-                        "('year','month','aid','title','json')"
-                        "values(?,?,?,?,?)"
-                    ),
-                    (y, m, aid, title, line.strip())
-                )
+                row = _metadata_row(line.strip(), schema)
             except (json.JSONDecodeError, KeyError, AssertionError) as e:
                 print(f"Skipping malformed entry in {in_fp}: {e}")
                 continue
+            _bulk_insert_rows(db_cur, schema, [row])
 
     print('generating index')
-    db_cur.execute(
-          "create index ym  on paper('year', 'month')"
-      )
+    _create_indices(db_cur, schema)
     conn.commit()
 
-def process_json_folder(input_folder, output_dir):
+
+def migrate_meta_db(db_fp, batch_size=10000):
+    """ Upgrade an existing schema v1 metadata DB to schema v2 in place.
+
+        The migration runs in a single transaction, so an interrupted
+        migration leaves the v1 DB untouched.
+    """
+
+    # (autocommit, so that the explicit transaction below also covers the
+    # DDL statements and the user_version pragma)
+    conn = sqlite3.connect(db_fp, isolation_level=None)
+    db_cur = conn.cursor()
+    if schema_version(db_cur) == SCHEMA_V2:
+        print('{} already uses schema v2'.format(db_fp))
+        conn.close()
+        return
+    db_cur.execute('begin')
+    try:
+        db_cur.execute("alter table paper rename to paper_v1")
+        _create_table(db_cur, SCHEMA_V2)
+        num_rows = db_cur.execute(
+            "select count(*) from paper_v1"
+        ).fetchone()[0]
+        read_cur = conn.cursor()
+        read_cur.execute(
+            "select year, month, aid, title, json from paper_v1"
+        )
+        print('migrating rows')
+        with tqdm(total=num_rows) as pbar:
+            while True:
+                rows = read_cur.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+                db_cur.executemany(
+                    (
+                        "insert or replace into paper "
+                        "('aid','year','month','title','title_norm','json')"
+                        "values(?,?,?,?,?,?)"
+                    ),
+                    [
+                        (
+                            aid, y, m, title, normalize_title(title or ''),
+                            compress_json(json_line)
+                        )
+                        for y, m, aid, title, json_line in rows
+                    ]
+                )
+                pbar.update(len(rows))
+        db_cur.execute("drop table paper_v1")
+        print('generating index')
+        _create_indices(db_cur, SCHEMA_V2)
+        db_cur.execute('commit')
+    except BaseException:
+        db_cur.execute('rollback')
+        conn.close()
+        raise
+    print('reclaiming space')
+    db_cur.execute("vacuum")
+    conn.close()
+
+
+def benchmark_meta_db(db_fp, num_lookups=10000, seed=0):
+    """ Measure metadata lookups (query + JSON decode) per second for a
+        random sample of papers.
+    """
+
+    meta_db = MetadataDB(db_fp)
+    keys = meta_db.cur.execute(
+        "select aid, year, month from paper"
+    ).fetchall()
+    random.Random(seed).shuffle(keys)
+    keys = keys[:num_lookups]
+    start = time.perf_counter()
+    for aid, y, m in keys:
+        json.loads(meta_db.get_json(aid, y, m))
+    duration = time.perf_counter() - start
+    version = meta_db.schema_version
+    meta_db.close()
+    lookups_per_second = len(keys) / duration if duration > 0 else 0
+    print('schema v{}: {} lookups in {:.2f}s ({:.0f} lookups/s)'.format(
+        version, len(keys), duration, lookups_per_second
+    ))
+    return lookups_per_second
+
+
+def process_json_folder(input_folder, output_dir, schema=SCHEMA_V1, bulk=False,
+                        num_workers=None):
     # Iterate through all JSON files in the input folder
     for json_fn in os.listdir(input_folder):
         if json_fn.endswith('.jsonl'):
             json_fp = os.path.join(input_folder, json_fn)
             print(f"Processing {json_fn}")
-            gen_meta_db(json_fp, output_dir)
+            gen_meta_db(json_fp, output_dir, schema=schema, bulk=bulk,
+                        num_workers=num_workers)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print('Usage: generate_metadata_db.py <arXiv_metadata_snapshot.json> <output_sqlite_directory>')
+    usage = (
+        'Usage: generate_metadata_db.py [--schema-v2] [--bulk [--workers <N>]] <arXiv_metadata_snapshot.json> <output_sqlite_directory>\n'
+        '       generate_metadata_db.py --migrate <metadata.sqlite>\n'
+        '       generate_metadata_db.py --benchmark <metadata.sqlite>'
+    )
+    args = sys.argv[1:]
+    schema = SCHEMA_V1
+    bulk = False
+    num_workers = None
+    if '--schema-v2' in args:
+        schema = SCHEMA_V2
+        args.remove('--schema-v2')
+    if '--bulk' in args:
+        bulk = True
+        args.remove('--bulk')
+    if '--workers' in args:
+        workers_idx = args.index('--workers')
+        try:
+            num_workers = int(args[workers_idx+1])
+        except (IndexError, ValueError):
+            args = []
+        else:
+            del args[workers_idx:workers_idx+2]
+    if len(args) == 2 and args[0] == '--migrate':
+        before = benchmark_meta_db(args[1])
+        migrate_meta_db(args[1])
+        after = benchmark_meta_db(args[1])
+        print('speedup: {:.1f}x'.format(after / before if before > 0 else 0))
+    elif len(args) == 2 and args[0] == '--benchmark':
+        benchmark_meta_db(args[1])
+    elif len(args) == 2:
+        process_json_folder(args[0], args[1], schema=schema, bulk=bulk,
+                            num_workers=num_workers)
+    else:
+        print(usage)
         sys.exit()
-    process_json_folder(sys.argv[1],sys.argv[2])
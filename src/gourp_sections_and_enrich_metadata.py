@@ -1,31 +1,101 @@
+import asyncio
 import os
 import json
 from multiprocessing import Pool
 import sys
-from enrich_metadata import enrich_metadata
+from enrich_metadata import AsyncEnricher, enrich_metadata
 from group_sections import process_sections
+from jsonl_io import iter_line_batches
+from lookup_cache import LookupCache
+from openalex_snapshot import SnapshotEnricher
+
+# papers whose OpenAlex lookups are run concurrently
+ENRICH_BATCH_SIZE = 200
+
+
+def _make_enricher(enrich_options, cache):
+    enrich_options = dict(enrich_options)
+    backend = enrich_options.pop('backend')
+    if backend == 'snapshot':
+        return SnapshotEnricher(enrich_options['snapshot_fp'])
+    enrich_options.pop('snapshot_fp')
+    return AsyncEnricher(cache=cache, **enrich_options)
+
+
+async def _process_file_async(in_path, out_path, enrich_options, cache):
+    async with _make_enricher(enrich_options, cache) as enricher:
+        with open(in_path, "r", encoding="utf-8") as f, \
+             open(out_path, "w", encoding="utf-8") as wf:
+            for lines in iter_line_batches(f, ENRICH_BATCH_SIZE):
+                papers = [json.loads(line) for line in lines]
+                paper_infos = []
+                for paper in papers:
+                    paper_info = {k: v for k, v in paper.items() if k != "body_text"}
+                    paper_info.setdefault("metadata", {})
+                    paper_infos.append(paper_info)
+                citation_infos = await enricher.lookup_many([
+                    (
+                        paper_info["metadata"].get("doi"),
+                        paper_info["metadata"].get("title")
+                    )
+                    for paper_info in paper_infos
+                ])
+                for paper, paper_info, citation_info in zip(
+                        papers, paper_infos, citation_infos
+                ):
+                    paper_info = enrich_metadata(paper, paper_info, citation_info)
+                    paper_info = process_sections(paper,paper_info)
+                    if paper_info.get("paper_id"):
+                        wf.write(json.dumps(paper_info, ensure_ascii=False) + "\n")
+
 
 def _process_file(args):
-    in_path, out_path = args
+    in_path, out_path, enrich_options, cache_fp = args
 
     os.makedirs(os.path.dirname(out_path), exist_ok=True)
 
-    with open(in_path, "r", encoding="utf-8") as f, \
-         open(out_path, "w", encoding="utf-8") as wf:
-        for line in f:
-            paper = json.loads(line)
-            paper_info = {k: v for k, v in paper.items() if k != "body_text"}
-            paper_info.setdefault("metadata", {})
-            paper_info = enrich_metadata(paper,paper_info)
-            paper_info = process_sections(paper,paper_info)
-            if paper_info.get("paper_id"):
-                wf.write(json.dumps(paper_info, ensure_ascii=False) + "\n")
+    cache = LookupCache(cache_fp) if cache_fp is not None else None
+    try:
+        asyncio.run(
+            _process_file_async(in_path, out_path, enrich_options, cache)
+        )
+    finally:
+        if cache is not None:
+            print(f"Lookup cache for {in_path}: {json.dumps(cache.stats())}")
+            cache.close()
 
     return in_path, out_path
 
-def process_directory(input_dir, output_dir, num_workers=None):
+def process_directory(input_dir, output_dir, num_workers=None, concurrency=8,
+                      requests_per_second=10, openalex_url=None,
+                      backend='api', snapshot_fp=None, cache_fp=None):
+    """ Group sections and enrich metadata of all JSONL files in input_dir.
+
+        With backend 'api', each worker process runs up to `concurrency`
+        OpenAlex requests at a time; requests_per_second is the limit for
+        all workers together. With backend 'snapshot', cited_by_count and
+        language are looked up offline in the snapshot DB at snapshot_fp
+        (see openalex_snapshot.py).
+
+        If cache_fp is given, API responses are cached in a LookupCache at
+        that path and reused in later runs.
+    """
+
     if num_workers is None:
         num_workers = os.cpu_count()
+    if backend == 'snapshot' and snapshot_fp is None:
+        raise ValueError('the snapshot backend requires a snapshot DB')
+    enrich_options = {
+        'backend': backend,
+        'snapshot_fp': snapshot_fp,
+        'concurrency': concurrency
+    }
+    if requests_per_second is not None:
+        enrich_options['requests_per_second'] = requests_per_second / num_workers
+    else:
+        enrich_options['requests_per_second'] = None
+    if openalex_url is not None:
+        enrich_options['base_url'] = openalex_url
 
     tasks = []
     for root, _, files in os.walk(input_dir):
@@ -42,7 +112,7 @@ def process_directory(input_dir, output_dir, num_workers=None):
                 print(f"Skipping existing file: {out_path}")
                 continue
 
-            tasks.append((in_path, out_path))
+            tasks.append((in_path, out_path, enrich_options, cache_fp))
 
     with Pool(processes=num_workers) as pool:
         for in_path, out_path in pool.map(_process_file, tasks):
@@ -50,12 +120,54 @@ def process_directory(input_dir, output_dir, num_workers=None):
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: python process_json.py <input_dir> <output_dir> [<num_workers>]")
+    args = sys.argv[1:]
+    concurrency = 8
+    requests_per_second = 10
+    openalex_url = None
+    backend = 'api'
+    snapshot_fp = None
+    cache_fp = None
+    for flag in [
+            '--concurrency', '--rate', '--openalex-url', '--backend',
+            '--snapshot', '--cache'
+    ]:
+        if flag not in args:
+            continue
+        flag_idx = args.index(flag)
+        try:
+            value = args[flag_idx+1]
+            if flag == '--concurrency':
+                concurrency = int(value)
+            elif flag == '--rate':
+                requests_per_second = float(value)
+                if requests_per_second <= 0:
+                    requests_per_second = None
+            elif flag == '--openalex-url':
+                openalex_url = value
+            elif flag == '--backend':
+                if value not in ['api', 'snapshot']:
+                    raise ValueError(value)
+                backend = value
+            elif flag == '--snapshot':
+                snapshot_fp = value
+            else:
+                cache_fp = value
+        except (IndexError, ValueError):
+            args = []
+            break
+        del args[flag_idx:flag_idx+2]
+    if len(args) < 2 or (backend == 'snapshot' and snapshot_fp is None):
+        print("Usage: python process_json.py <input_dir> <output_dir> [<num_workers>] [--backend api|snapshot] [--snapshot <snapshot.sqlite>] [--cache <cache.sqlite>] [--concurrency <N>] [--rate <requests_per_second>] [--openalex-url <url>]")
         sys.exit(1)
 
-    input_dir = sys.argv[1]
-    output_dir = sys.argv[2]
-    num_workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    input_dir = args[0]
+    output_dir = args[1]
+    num_workers = int(args[2]) if len(args) > 2 else os.cpu_count()
     print(f"Using {num_workers} workers")
-    process_directory(input_dir, output_dir, num_workers)
+    process_directory(input_dir, output_dir, num_workers,
+                      concurrency=concurrency,
+                      requests_per_second=requests_per_second,
+                      openalex_url=openalex_url,
+                      backend=backend,
+                      snapshot_fp=snapshot_fp,
+                      cache_fp=cache_fp)
@@ -0,0 +1,139 @@
+""" Batched access to the GROBID citation parsing API.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from lxml import etree
+from requests.adapters import HTTPAdapter
+
+# reference strings per processCitationList request
+GROBID_BATCH_SIZE = 100
+# processCitationList requests in flight
+GROBID_CONCURRENCY = 4
+
+
+class GrobidClient:
+    """ Parses reference strings with GROBID over a pooled HTTP session.
+
+        Reference strings are deduplicated, sent in batches of batch_size
+        to /api/processCitationList, with at most max_workers requests in
+        flight, and the returned biblStruct elements are mapped back to the
+        reference strings by their order. If GROBID returns a different
+        number of elements than it was sent, the batch is parsed string by
+        string via /api/processCitation instead.
+
+        The result for a reference string is the biblStruct XML as str, or
+        False if GROBID couldn't parse it.
+    """
+
+    def __init__(self, grobid_host, batch_size=GROBID_BATCH_SIZE,
+                 max_workers=GROBID_CONCURRENCY, cache=None, timeout=360):
+        self.base_url = 'http://' + grobid_host + ':8070/api'
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.cache = cache
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=max_workers
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+    def _process_citation(self, ref_string):
+        response = self.session.post(
+            self.base_url + '/processCitation',
+            data={'citations': ref_string},
+            timeout=self.timeout
+        )
+        if response.status_code == 200:
+            return response.text
+        elif response.status_code == 204:
+            # no content could be extracted and structured
+            return False
+        print('GROBID non 200 response:')
+        print('\tstatus_code: {}'.format(response.status_code))
+        print('\ttext: {}'.format(response.text))
+        return None
+
+    def _process_citation_list(self, ref_strings):
+        """ Returns a list of results aligned with ref_strings. Failed
+            lookups are None.
+        """
+
+        try:
+            response = self.session.post(
+                self.base_url + '/processCitationList',
+                data={'citations': ref_strings},
+                timeout=self.timeout
+            )
+        except requests.RequestException as e:
+            print('GROBID request exception: {}'.format(e))
+            return [None] * len(ref_strings)
+        bibl_structs = None
+        if response.status_code == 200:
+            try:
+                root = etree.fromstring(response.content)
+            except etree.XMLSyntaxError:
+                root = None
+            if root is not None:
+                list_bibl = next(root.iter('{*}listBibl'), None)
+                if list_bibl is not None:
+                    bibl_structs = list(list_bibl.iterchildren('{*}biblStruct'))
+                else:
+                    bibl_structs = list(root.iter('{*}biblStruct'))
+        elif response.status_code == 204:
+            return [False] * len(ref_strings)
+        if bibl_structs is None or len(bibl_structs) != len(ref_strings):
+            # can't map results back by order
+            results = []
+            for ref_string in ref_strings:
+                try:
+                    results.append(self._process_citation(ref_string))
+                except requests.RequestException as e:
+                    print('GROBID request exception: {}'.format(e))
+                    results.append(None)
+            return results
+        return [
+            etree.tostring(bibl_struct, encoding='unicode')
+            for bibl_struct in bibl_structs
+        ]
+
+    def parse_citations(self, ref_strings):
+        """ Parse a list of reference strings.
+
+            Returns a dict mapping each reference string to its biblStruct
+            XML as str, or False. Reference strings whose request failed
+            are missing from the dict.
+        """
+
+        results = {}
+        todo = []
+        for ref_string in dict.fromkeys(ref_strings):
+            if self.cache is not None:
+                hit, result = self.cache.get('grobid', ref_string)
+                if hit:
+                    results[ref_string] = result
+                    continue
+            todo.append(ref_string)
+        batches = [
+            todo[i:i+self.batch_size]
+            for i in range(0, len(todo), self.batch_size)
+        ]
+        for batch, batch_results in zip(
+                batches,
+                self._executor.map(self._process_citation_list, batches)
+        ):
+            new_results = [
+                (ref_string, result)
+                for ref_string, result in zip(batch, batch_results)
+                if result is not None
+            ]
+            results.update(new_results)
+            if self.cache is not None:
+                self.cache.set_many('grobid', new_results)
+        return results
@@ -0,0 +1,202 @@
+""" Helpers for reading and writing JSONL files.
+"""
+
+import json
+import os
+import re
+
+WHITESPACE_PATT = re.compile(r'[ \t\n\r]*')
+
+_decoder = json.JSONDecoder()
+
+
+def lazy_fields(line, keys, validate=False):
+    """ Decode only the given top level fields of a JSON object line.
+
+        Returns a dict mapping each found key to a tuple (value, start, end)
+        with line[start:end] being the value's JSON. Members are decoded in
+        order only until all keys are found, so fields that come first in
+        paper lines (paper_id, metadata) are read without decoding the
+        large body_text/sections, bib_entries and ref_entries values.
+        Raises json.JSONDecodeError if the line is malformed up to there.
+
+        With validate=True the remaining members are decoded as well (and
+        discarded), so that truncated or otherwise malformed lines raise
+        json.JSONDecodeError as with json.loads().
+    """
+
+    def end_of_object(idx):
+        # idx is the position of the object's closing brace
+        if validate:
+            rest = WHITESPACE_PATT.match(line, idx + 1).end()
+            if rest != len(line):
+                raise json.JSONDecodeError('Extra data', line, rest)
+        return fields
+
+    keys = set(keys)
+    fields = {}
+    idx = WHITESPACE_PATT.match(line, 0).end()
+    if line[idx:idx + 1] != '{':
+        raise json.JSONDecodeError('Expecting object', line, idx)
+    idx = WHITESPACE_PATT.match(line, idx + 1).end()
+    if line[idx:idx + 1] == '}':
+        return end_of_object(idx)
+    while True:
+        if line[idx:idx + 1] != '"':
+            raise json.JSONDecodeError(
+                'Expecting property name enclosed in double quotes', line, idx
+            )
+        key, idx = _decoder.raw_decode(line, idx)
+        idx = WHITESPACE_PATT.match(line, idx).end()
+        if line[idx:idx + 1] != ':':
+            raise json.JSONDecodeError("Expecting ':' delimiter", line, idx)
+        start = WHITESPACE_PATT.match(line, idx + 1).end()
+        value, end = _decoder.raw_decode(line, start)
+        if key in keys:
+            fields[key] = (value, start, end)
+            if len(fields) == len(keys) and not validate:
+                return fields
+        idx = WHITESPACE_PATT.match(line, end).end()
+        if line[idx:idx + 1] == ',':
+            idx = WHITESPACE_PATT.match(line, idx + 1).end()
+        elif line[idx:idx + 1] == '}':
+            return end_of_object(idx)
+        else:
+            raise json.JSONDecodeError("Expecting ',' delimiter", line, idx)
+
+
+def lazy_metadata(line, validate=False):
+    """ Metadata dict of a paper line (None if it has none), decoded with
+        lazy_fields().
+    """
+
+    value, _, _ = lazy_fields(line, ['metadata'], validate).get(
+        'metadata', (None, None, None)
+    )
+    return value
+
+
+def replace_field(line, field, value):
+    """ Line with the JSON of a value replaced, given a field as returned
+        by lazy_fields(). All other fields are kept as they are.
+    """
+
+    _, start, end = field
+    return line[:start] + json.dumps(value) + line[end:]
+
+
+def iter_line_batches(f, batch_size):
+    """ Lists of up to batch_size consecutive lines of a file.
+    """
+
+    batch = []
+    for line in f:
+        batch.append(line)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def _truncate_to_last_line(path):
+    """ Cut off a trailing incomplete line (e.g. left by a crash) and
+        return the resulting file size.
+    """
+
+    block_size = 1 << 16
+    with open(path, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        pos = end
+        while pos > 0:
+            read_from = max(0, pos - block_size)
+            f.seek(read_from)
+            block = f.read(pos - read_from)
+            newline_idx = block.rfind(b'\n')
+            if newline_idx != -1:
+                size = read_from + newline_idx + 1
+                break
+            pos = read_from
+        else:
+            size = 0
+        if size != end:
+            f.truncate(size)
+    return size
+
+
+class JsonlWriter:
+    """ Streams JSON lines into <path>.part and atomically renames the file
+        to <path> when closed, so that <path> only ever exists complete.
+
+        The file is fsynced every fsync_every lines. With resume=True, an
+        existing <path>.part is cut back to its last complete line and
+        appended to; resumed_lines() yields the lines already written.
+        If the writer is left through an exception, <path>.part is kept for
+        a later resume.
+    """
+
+    def __init__(self, path, resume=False, fsync_every=100, **dumps_kwargs):
+        self.path = path
+        self.part_path = '{}.part'.format(path)
+        self.fsync_every = fsync_every
+        self.dumps_kwargs = dumps_kwargs
+        self.num_written = 0
+        self.closed = False
+        self._resumed_size = 0
+        if resume and os.path.isfile(self.part_path):
+            self._resumed_size = _truncate_to_last_line(self.part_path)
+            self._f = open(self.part_path, 'a', encoding='utf-8')
+        else:
+            self._f = open(self.part_path, 'w', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.closed:
+            return
+        if exc_type is None:
+            self.close()
+        else:
+            self._sync()
+            self._f.close()
+
+    def resumed_lines(self):
+        """ Yield the lines that were already present when resuming.
+        """
+
+        if self._resumed_size == 0:
+            return
+        with open(self.part_path, 'rb') as f:
+            while f.tell() < self._resumed_size:
+                line = f.readline()
+                if not line:
+                    break
+                yield line.decode('utf-8')
+
+    def write(self, obj):
+        self.write_line(json.dumps(obj, **self.dumps_kwargs))
+
+    def write_line(self, line):
+        """ Write a single already serialized JSON line.
+        """
+
+        if not line.endswith('\n'):
+            line = '{}\n'.format(line)
+        self._f.write(line)
+        self.num_written += 1
+        if self.num_written % self.fsync_every == 0:
+            self._sync()
+
+    def close(self):
+        if self.closed:
+            return
+        self._sync()
+        self._f.close()
+        os.replace(self.part_path, self.path)
+        self.closed = True
+
+    def _sync(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
@@ -0,0 +1,176 @@
+""" Persistent cache for external lookups (OpenAlex, Crossref, GROBID).
+
+    Entries live in an SQLite DB that can be shared by several processes
+    and runs. They are addressed by the SHA1 hash of a namespace and the
+    normalized query, and store the JSON encoded response together with the
+    time it was cached.
+
+    Every write is committed right away (set()) or per batch (set_many()),
+    so no write lock is held while the caller waits for the network. The
+    number of entries is kept up to date by triggers, so checking the size
+    limit doesn't need to count them.
+"""
+
+import json
+import sqlite3
+import time
+from hashlib import sha1
+
+# entries older than this are treated as missing and evicted
+DEFAULT_TTL_SECONDS = 90 * 24 * 60 * 60
+# when exceeded, the oldest entries are evicted
+DEFAULT_MAX_ENTRIES = 10000000
+
+
+class LookupCache:
+    """ Content-addressed on-disk cache with TTL and size-bounded eviction.
+
+        Usage:
+            cache = LookupCache('lookups.sqlite')
+            hit, value = cache.get('crossref', doi)
+            if not hit:
+                value = ...
+                cache.set('crossref', doi, value)
+            cache.close()
+
+        Hits and misses are counted per namespace, see stats().
+    """
+
+    def __init__(self, db_fp, ttl=DEFAULT_TTL_SECONDS,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        self.db_fp = db_fp
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # (autocommit, transactions are started explicitly)
+        self.conn = sqlite3.connect(db_fp, timeout=60, isolation_level=None)
+        self.cur = self.conn.cursor()
+        self.cur.execute('pragma journal_mode = WAL')
+        self.cur.execute('pragma synchronous = NORMAL')
+        self.cur.execute('begin immediate')
+        self.cur.execute("""
+            create table if not exists entry(
+                'key' text primary key,
+                'value' text,
+                'created' real
+            ) without rowid
+        """)
+        self.cur.execute(
+            "create index if not exists created on entry('created')"
+        )
+        self.cur.execute(
+            "create table if not exists entry_count('n' integer)"
+        )
+        if self.cur.execute(
+                'select count(*) from entry_count'
+        ).fetchone()[0] == 0:
+            # new cache, or one created before the count was kept
+            self.cur.execute(
+                'insert into entry_count select count(*) from entry'
+            )
+        self.cur.execute("""
+            create trigger if not exists entry_insert after insert on entry
+            begin update entry_count set n = n + 1; end
+        """)
+        self.cur.execute("""
+            create trigger if not exists entry_delete after delete on entry
+            begin update entry_count set n = n - 1; end
+        """)
+        self.cur.execute('commit')
+        self.hits = {}
+        self.misses = {}
+
+    @staticmethod
+    def key(namespace, query):
+        return sha1(
+            '{}\0{}'.format(
+                namespace, json.dumps(query, sort_keys=True)
+            ).encode('utf-8')
+        ).hexdigest()
+
+    def get(self, namespace, query):
+        """ Returns a tuple (hit, value).
+        """
+
+        self.cur.execute(
+            'select value, created from entry where key=?',
+            (self.key(namespace, query),)
+        )
+        entry = self.cur.fetchone()
+        if entry is None or \
+                (self.ttl is not None and entry[1] < time.time() - self.ttl):
+            self.misses[namespace] = self.misses.get(namespace, 0) + 1
+            return False, None
+        self.hits[namespace] = self.hits.get(namespace, 0) + 1
+        return True, json.loads(entry[0])
+
+    def _upsert(self, rows):
+        # (an upsert instead of "insert or replace", which would delete the
+        # old entry without firing the delete trigger)
+        self.cur.executemany(
+            'insert into entry (key, value, created) values(?,?,?) '
+            'on conflict(key) do update set '
+            'value=excluded.value, created=excluded.created',
+            rows
+        )
+
+    def set(self, namespace, query, value):
+        self._upsert([
+            (self.key(namespace, query), json.dumps(value), time.time())
+        ])
+
+    def set_many(self, namespace, items):
+        """ Cache (query, value) pairs in a single transaction.
+        """
+
+        now = time.time()
+        rows = [
+            (self.key(namespace, query), json.dumps(value), now)
+            for query, value in items
+        ]
+        if len(rows) == 0:
+            return
+        self.cur.execute('begin immediate')
+        try:
+            self._upsert(rows)
+        except BaseException:
+            self.cur.execute('rollback')
+            raise
+        self.cur.execute('commit')
+
+    def __len__(self):
+        return self.cur.execute('select n from entry_count').fetchone()[0]
+
+    def evict(self):
+        """ Remove expired entries and, if there are more than
+            max_entries, the oldest ones.
+        """
+
+        if self.ttl is not None:
+            self.cur.execute(
+                'delete from entry where created < ?',
+                (time.time() - self.ttl,)
+            )
+        if self.max_entries is not None:
+            num_entries = len(self)
+            if num_entries > self.max_entries:
+                self.cur.execute(
+                    'delete from entry where key in ('
+                    'select key from entry order by created limit ?)',
+                    (num_entries - self.max_entries,)
+                )
+
+    def stats(self):
+        """ Hit and miss counts per namespace as a dict.
+        """
+
+        return {
+            namespace: {
+                'hits': self.hits.get(namespace, 0),
+                'misses': self.misses.get(namespace, 0)
+            }
+            for namespace in sorted(set(self.hits) | set(self.misses))
+        }
+
+    def close(self):
+        self.evict()
+        self.conn.close()
@@ -4,20 +4,33 @@ against OpenAlex data in local DB and against an arXiv metadata table
 """
 
 import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
 import json
+import multiprocessing
 import os
 import glob
+import queue
 import re
-import unidecode
-import unicodedata
-import sqlite3
-import requests
 import sys
+import threading
 import traceback
-from bs4 import BeautifulSoup
-from datetime import datetime, time
+import time
+from datetime import datetime
 from multiprocessing import Pool
 from collections import OrderedDict
+from crossref_client import (
+    CROSSREF_API_URL, CROSSREF_REQUESTS_PER_SECOND, CrossrefFetcher
+)
+from grobid_client import GrobidClient
+from jsonl_io import JsonlWriter
+from lookup_cache import LookupCache
+from meta_db import MetadataDB
+from normalization import normalize_title, ref_string_tokens
+from rate_limit import FileTokenBucket
+from stage_metrics import StageMetrics
+import tei
+from title_index import TitleIndex
 
 ARXIV_URL_PATT = re.compile(
     r'arxiv\.org\/[a-z0-9-]{1,10}\/(([a-z0-9-]{1,15}\/)?[\d\.]{4,9}\d)',
@@ -36,8 +49,9 @@ DOI_PATT = re.compile(
     r'10.\d{4,9}/[-._;()/:A-Z0-9]+$',
     re.I
 )
+# formula markers with short IDs ('<hash>-<n>') or UUIDs (older parses)
 FORMULA_PATT = re.compile(
-    r'\{\{formula:.{36}\}\}',
+    r'\{\{formula:([0-9a-z-]+)\}\}',
     re.I
 )
 APS_DOI_PATT = re.compile(
@@ -54,6 +68,22 @@ APS_DOI_PATT = re.compile(
     r'([a-z]?\d+)',  # paper identifier (can contain a leading letter)  -> g8
     re.I
 )
+# papers whose unresolved references are sent to GROBID together
+PAPER_BATCH_SIZE = 20
+# look up the titles of all bib entries of a paper batch in OpenAlex with a
+# single query instead of one (or three) per bib entry
+BULK_TITLE_MATCHING = True
+# <match_db_host> value for running without PostgreSQL (requires a title
+# index, and Crossref titles are then not stored in the crossref table)
+NO_MATCH_DB = '-'
+# seconds between throughput reports while matching
+PROGRESS_INTERVAL_SECONDS = 60
+# suffix of the summary written next to the output of a chunk's paper range
+RANGE_SUMMARY_SUFFIX = '.summary.json'
+# stage metrics of a run, aggregated over all workers (in <out_dir>/logs)
+METRICS_FN = 'matching-metrics.json'
+PROMETHEUS_METRIC_PREFIX = 'unarxive_matching'
+
 
 
 def find_arxiv_id(text):
@@ -133,110 +163,21 @@ def identify_implicit_aps_journal_doi(bibstr):
     return doi
 
 
-def title_lookup_in_arxiv_metadata_db(arxiv_id, cursor_arxiv, ppr_year, ppr_month):
+def title_lookup_in_arxiv_metadata_db(arxiv_id, meta_db, ppr_year, ppr_month):
     # columns in table named paper:
-    # year, month, aid, title, json
-
-    query_aid_string = "SELECT  json from paper where year=? and month=? and aid=?"
-    # query_aid_string = "SELECT title from paper WHERE aid= ?"
-    metadata_tup = cursor_arxiv.execute(query_aid_string, (ppr_year, ppr_month, str(arxiv_id),)).fetchone()
-    try:
-        metadata = json.loads(metadata_tup[0])
-    except (TypeError, IndexError) as e:
-        return {}
-    return metadata.get('title', '')
-
-
-def find_title_in_crossref_by_doi(given_doi):
-    """ Given a DOI, try to get a work's title using crossref.org
-    """
-
-    doi_base_url = "https://api.crossref.org/works/"
-    mail = ''  # Add your e-mail here
-    assert (len(mail)) > 0  # check if e-mail is present
-    req = '{}{}?mailto={}'.format(
-        doi_base_url,
-        given_doi,
-        mail
-    )
-    try:
-        resp = requests.get(
-            req,
-            timeout=360
-        )
-
-        rate_lim_lim = resp.headers.get('X-Rate-Limit-Limit', '9001')
-        rate_lim_int = resp.headers.get(
-            'X-Rate-Limit-Interval',
-            '1s'
-        ).replace('s', '')
-    except requests.RequestException:
-        print("Request Exception")
-        return False
-    try:
-        wait = float(rate_lim_int) / float(rate_lim_lim)
-        if resp.elapsed.total_seconds() < wait:
-            delta = wait - resp.elapsed.total_seconds()
-            delta = max(delta, 3600)
-            time.sleep(delta)
-    except ValueError:
-        pass
-    if resp.status_code == 404:
-        # probably a faulty DOI
-        return False
-    try:
-        title = resp.json()['message']['title'][0]
-        # print(doi_metadata)
-        if title and len(title) > 0:
-            return title
-    except json.decoder.JSONDecodeError:
-        print("JSON decode error in Crossref response")
-        sys.exit()
-        return False
-
-
-def find_title_with_grobid_in_string(grobid_host, bib_ref_string):
-    grobid_url = 'http://' + grobid_host + ':8070/api/processCitation'
-    response = requests.post(grobid_url, data={'citations': bib_ref_string})
-
-    if response.status_code == 200:
-        return response.text
-    elif response.status_code == 204:
-        # no content could be extracted and structured
-        return False
-    else:
-        print('GROBID non 200 response:')
-        print('\tstatus_code: {}'.format(response.status_code))
-        print('\ttext: {}'.format(response.response.text))
-        return False
-
-
-def normalize_title(title_string):
-    title_string_norm = re.sub(r'[^\w]', ' ', title_string)
-    title_string_norm = re.sub(r'\s+', ' ', title_string_norm)
-    title_string_norm = unicodedata.normalize('NFD', title_string_norm)
-    title_string_norm = unidecode.unidecode(title_string_norm)
-    return title_string_norm.strip().lower()
-
-
-def normalize_author_name(author_string):
-    author_string_norm = re.sub(r'[^\w]', ' ', author_string)
-    author_string_norm = re.sub(r'\s+', ' ', author_string_norm)
-    author_string_norm = unicodedata.normalize('NFD', author_string_norm)
-    author_string_norm = unidecode.unidecode(author_string_norm)
-    return author_string_norm.strip().lower()
+    # year, month, aid, title, json (+ title_norm in schema v2)
+    return meta_db.get_title(str(arxiv_id), ppr_year, ppr_month)
 
 
 def item_authors_in_ref_string(openalex_item_authors_list, ref_string):
-    any_author_in_ref_string = False
-    ref_string_normalized = normalize_author_name(ref_string)
+    # tokens of the normalized ref string, computed once per ref string
+    ref_string_token_set = ref_string_tokens(ref_string)
     for openalex_item_author in openalex_item_authors_list:
-        if openalex_item_author.split(" ")[-1] in ref_string_normalized.split(
-                " "):  # check occurence of author in token-wise ref string
+        if openalex_item_author.split(" ")[-1] in ref_string_token_set:  # check occurence of author in token-wise ref string
             # print(openalex_item_author.split(" ")[-1])  # last name
-            any_author_in_ref_string = True
+            return True
 
-    return any_author_in_ref_string
+    return False
 
 
 def vary_title_window(normalized_title_string):
@@ -248,16 +189,18 @@ def vary_title_window(normalized_title_string):
     return title_omit_first_token, title_omit_last_token
 
 
-def match_title_in_openalexdb(query_string, bib_entry_title_norm, bib_entry_ref_string, cursor,
-                              try_title_windows_flag):
-    cursor.execute(query_string, (bib_entry_title_norm,))
-    matching_openalex_pubs = cursor.fetchall()
+def select_openalex_match(matching_openalex_pubs, bib_entry_ref_string,
+                          authors_idx=2, cited_by_count_idx=3):
+    """ Pick the match for a bib entry among the OpenAlex rows with its
+        title: of the rows with an author present in the ref string, the
+        most cited one. Returns None if there is none.
+    """
 
     # if only one result is found, proceed to handover IDs from openalexdb
     if len(matching_openalex_pubs) == 1:
 
         # look for authors in bib_entry_ref_string
-        openalex_item_authors_list = matching_openalex_pubs[0][2]
+        openalex_item_authors_list = matching_openalex_pubs[0][authors_idx]
         if item_authors_in_ref_string(openalex_item_authors_list, bib_entry_ref_string):
             return matching_openalex_pubs[0]
 
@@ -269,7 +212,7 @@ def match_title_in_openalexdb(query_string, bib_entry_title_norm, bib_entry_ref_
     elif len(matching_openalex_pubs) > 1:
         matching_openalex_pubs_with_author_present = []
         for match in matching_openalex_pubs:
-            openalex_item_authors_list = match[2]
+            openalex_item_authors_list = match[authors_idx]
 
             # consider only the title matched pubs that have an author match with the ref string
             if item_authors_in_ref_string(openalex_item_authors_list, bib_entry_ref_string):
@@ -279,7 +222,7 @@ def match_title_in_openalexdb(query_string, bib_entry_title_norm, bib_entry_ref_
         if len(matching_openalex_pubs_with_author_present) != 0:
             citation_counts_of_matches = []
             for match in matching_openalex_pubs_with_author_present:
-                citation_counts_of_matches.append(match[3])
+                citation_counts_of_matches.append(match[cited_by_count_idx])
 
             index_of_most_cited_in_match_list = citation_counts_of_matches.index(max(citation_counts_of_matches))
             matched_openalex_pub = matching_openalex_pubs_with_author_present[index_of_most_cited_in_match_list]
@@ -289,8 +232,17 @@ def match_title_in_openalexdb(query_string, bib_entry_title_norm, bib_entry_ref_
             # Authors in OpenAlex for matched items all not present in ref string: no matches - skipped
             return
 
+
+def match_title_in_openalexdb(query_string, bib_entry_title_norm, bib_entry_ref_string, cursor,
+                              try_title_windows_flag):
+    cursor.execute(query_string, (bib_entry_title_norm,))
+    matching_openalex_pubs = cursor.fetchall()
+
+    if len(matching_openalex_pubs) > 0:
+        return select_openalex_match(matching_openalex_pubs, bib_entry_ref_string)
+
     # no match found -> try alternate title substrings and redo search
-    elif len(matching_openalex_pubs) == 0:
+    else:
         if try_title_windows_flag:
             bib_entry_title_norm_omit_first, bib_entry_title_norm_omit_last = vary_title_window(bib_entry_title_norm)
 
@@ -310,14 +262,72 @@ def match_title_in_openalexdb(query_string, bib_entry_title_norm, bib_entry_ref_
             # occurs when calling in 1st recursive call of 'match_title_in_openalexdb' function
             return
 
-    else:
-        print(f"Unhandled matching scenario occurred. Bib ref string: {bib_entry_ref_string}")
+
+def openalex_match_columns(cursor):
+    """ Names of the columns of the openalex table needed for matching:
+        (normalized title, authors, cited_by_count, ids). The latter three
+        are identified by their position, as in match_title_in_openalexdb().
+    """
+
+    cursor.execute('SELECT * from openalex LIMIT 0')
+    column_names = [column[0] for column in cursor.description]
+    return (
+        'normalized_title', column_names[2], column_names[3], column_names[7]
+    )
+
+
+def fetch_openalex_candidates(cursor, columns, bib_entry_title_norms):
+    """ Look up all given normalized titles in the openalex table with a
+        single query.
+
+        Returns a dict mapping each title found to a list of
+        (authors, cited_by_count, ids) tuples.
+    """
+
+    title_column, authors_column, cited_by_count_column, ids_column = columns
+    query = sql.SQL(
+        'SELECT "left"({title}::text, 1000), {authors}, {cited_by_count}, {ids} '
+        'from openalex WHERE ("left"({title}::text, 1000)) = ANY(%s)'
+    ).format(
+        title=sql.Identifier(title_column),
+        authors=sql.Identifier(authors_column),
+        cited_by_count=sql.Identifier(cited_by_count_column),
+        ids=sql.Identifier(ids_column)
+    )
+    cursor.execute(query, (list(bib_entry_title_norms),))
+    candidates = {}
+    for title_norm, authors, cited_by_count, ids in cursor.fetchall():
+        candidates.setdefault(title_norm, []).append(
+            (authors, cited_by_count, ids)
+        )
+    return candidates
+
+
+def match_title_in_candidates(candidates, bib_entry_title_norm, bib_entry_ref_string,
+                              try_title_windows_flag):
+    """ Same as match_title_in_openalexdb(), but on rows prefetched with
+        fetch_openalex_candidates().
+    """
+
+    matching_openalex_pubs = candidates.get(bib_entry_title_norm, [])
+    if len(matching_openalex_pubs) > 0:
+        return select_openalex_match(
+            matching_openalex_pubs, bib_entry_ref_string,
+            authors_idx=0, cited_by_count_idx=1
+        )
+    if not try_title_windows_flag:
         return
+    for bib_entry_title_norm_window in vary_title_window(bib_entry_title_norm):
+        matched_openalex_pub = match_title_in_candidates(
+            candidates, bib_entry_title_norm_window, bib_entry_ref_string, False
+        )
+        if matched_openalex_pub is not None:
+            return matched_openalex_pub
 
 
-def map_ids_from_openalexdb_match_to_dict(matched_pub_from_db):
+def map_ids_from_openalexdb_match_to_dict(matched_pub_from_db, ids_idx=7):
     id_keys_in_output = ['open_alex_id', 'sem_open_alex_id', 'pubmed_id', 'pmc_id', 'doi']
-    openalexdb_match_ids = matched_pub_from_db[7]  # ids are in column [7] of the returned data from OpenAlex table
+    openalexdb_match_ids = matched_pub_from_db[ids_idx]  # ids are in column [7] of the returned data from OpenAlex table
     bib_entry_ids_dict = {}
 
     # go through all ID types in openalexdb and add to temporary bib_entry_ids_dict
@@ -339,336 +349,833 @@ def map_ids_from_openalexdb_match_to_dict(matched_pub_from_db):
     return bib_entry_ids_dict
 
 
-def extend_parsed_arxiv_chunk(params):
-    jsonl_file_path, output_root_dir, match_db_host, meta_db_uri, grobid_host = params
-    i = 0
-    bib_item_counter = 0
-    bib_item_no_title_error_counter = 0
-    bib_item_title_not_in_openalex_error_counter = 0
+def _init_bib_entry_ids(bib_entry_dict):
+    bib_entry_dict['ids'] = OrderedDict()
+    bib_entry_dict['ids']['open_alex_id'] = ""
+    bib_entry_dict['ids']['sem_open_alex_id'] = ""
+    bib_entry_dict['ids']['pubmed_id'] = ""
+    bib_entry_dict['ids']['pmc_id'] = ""
+    bib_entry_dict['ids']['doi'] = ""
+    bib_entry_dict['ids']['arxiv_id'] = ""
+
+
+def find_title_by_arxiv_id(bib_entry_dict, meta_db):
+    """ Try to determine the title of a bib entry via a contained arXiv ID
+        (arXiv metadata DB). Returns None if there is none.
+    """
+
+    bib_entry_aid = None
+    title = None
+
+    # look for arxiv ID in parsed bib entry data
+    if len(bib_entry_dict['contained_arXiv_ids']) != 0:
+        bib_entry_aid = bib_entry_dict['contained_arXiv_ids']
+
+    # look for arxiv ID in full ref string of bib item
+    else:
+        bib_entry_regex_test = find_arxiv_id(bib_entry_dict['bib_entry_raw'])
+        if bib_entry_regex_test is not False:
+            bib_entry_aid = bib_entry_regex_test
+
+    # if arxiv ID is determined either way, check metadata arxiv db to get clean title
+    if bib_entry_aid is not None:
+
+        try:
+            # if multiple arxiv ids or dict in parsed data of current bib item, choose first
+            if type(bib_entry_aid) is list:
+                if len(bib_entry_aid) != 0:
+                    aid = str(bib_entry_aid[0]['id'])
+                    aid_m = ARXIV_ID_PATT_DATE.match(aid)
+                    aid_year = aid_m.group(2)
+                    aid_month = aid_m.group(3)
+
+                    title_from_arxive_meta_db = title_lookup_in_arxiv_metadata_db(
+                        aid, meta_db, aid_year, aid_month)
+            else:
+                aid_m = ARXIV_ID_PATT_DATE.match(str(bib_entry_aid))
+                aid_year = aid_m.group(2)
+                aid_month = aid_m.group(3)
+                title_from_arxive_meta_db = title_lookup_in_arxiv_metadata_db(
+                    str(bib_entry_aid),
+                    meta_db, aid_year, aid_month)
+
+            if title_from_arxive_meta_db is not None:
+                if len(title_from_arxive_meta_db) != 0:
+                    title = title_from_arxive_meta_db
+
+        except IndexError as indexerror:
+            # indexerror encountered
+            pass
+
+        except Exception as e:
+            print(e)
+            pass
+
+    return title
+
+
+def doi_candidates_of_bib_entry(bib_entry_dict):
+    """ DOIs of a bib entry, found in its contained links or determined for
+        APS journals, in the order in which they should be tried.
+    """
+
+    doi_candidates = []
+    # check contained links
+    if len(bib_entry_dict['contained_links']) != 0:
+        # multiple urls possible in list
+        bib_item_urls = bib_entry_dict['contained_links']
+        for link in bib_item_urls:
+            bib_item_doi_m = DOI_PATT.search(link['url'])
+            if bib_item_doi_m:
+                bib_item_doi = bib_item_doi_m.group(0)
+                if bib_item_doi[-1] == '/':
+                    bib_item_doi = bib_item_doi[:-1]
+                doi_candidates.append(
+                    bib_item_doi
+                )
+    # look for APS references
+    aps_doi = identify_implicit_aps_journal_doi(
+        bib_entry_dict['bib_entry_raw']
+    )
+    if aps_doi is not None:
+        doi_candidates = [aps_doi] + doi_candidates
+    return doi_candidates
+
+
+def resolve_doi_titles(doi_candidate_lists, cursor, conn, crossref_fetcher, metrics=None):
+    """ Determine titles for a list of bib entries via their DOI candidates
+        (see doi_candidates_of_bib_entry()).
+
+        All DOIs are first looked up in the local crossref table with a
+        single query. DOIs not in there are fetched from Crossref, in
+        rounds, such that for each bib entry later candidates are only
+        fetched if the earlier ones yield no title. New titles are written
+        back to the crossref table with one batched upsert.
+
+        Returns a tuple (list of titles or None aligned with
+        doi_candidate_lists, list of the DOIs the titles were found for,
+        number of titles found in the crossref table). Stage latencies are
+        recorded in metrics (a StageMetrics), if given.
+    """
+
+    if metrics is None:
+        metrics = StageMetrics()
+    all_dois = {doi for doi_candidates in doi_candidate_lists for doi in doi_candidates}
+    known_titles = {}  # titles from the crossref table
+    if cursor is not None and len(all_dois) > 0:
+        try:
+            with metrics.timer('crossref_db_read', items=len(all_dois)):
+                cursor.execute(
+                    "SELECT doi, title from crossref WHERE doi = ANY(%s)",
+                    (list(all_dois),)
+                )
+                for doi, title in cursor.fetchall():
+                    known_titles.setdefault(doi, title)
+        except psycopg2.Error as e:
+            print(e)
+            conn.rollback()
+
+    fetched_titles = {}  # titles from the Crossref API
+    failed_dois = set()
+    while True:
+        to_fetch = set()
+        for doi_candidates in doi_candidate_lists:
+            for doi in doi_candidates:
+                if doi in known_titles or doi in fetched_titles:
+                    break
+                if doi in failed_dois:
+                    continue
+                to_fetch.add(doi)
+                break
+        if len(to_fetch) == 0:
+            break
+        with metrics.timer('crossref_api', items=len(to_fetch)):
+            titles = crossref_fetcher.fetch_titles(to_fetch)
+        for doi in to_fetch:
+            title = titles.get(doi, False)
+            if title:
+                fetched_titles[doi] = title
+            else:
+                failed_dois.add(doi)
+
+    if cursor is not None and len(fetched_titles) > 0:
+        # for the unprobable case that two workers look up the title for
+        # the same DOI at the same time (DOI is primary key)
+        try:
+            with metrics.timer('crossref_db_write', items=len(fetched_titles)):
+                execute_values(
+                    cursor,
+                    "INSERT INTO crossref (doi, title) VALUES %s ON CONFLICT DO NOTHING",
+                    list(fetched_titles.items())
+                )
+                conn.commit()
+        except psycopg2.Error as e:
+            print(e)
+            conn.rollback()
+
+    titles = []
+    title_dois = []
     saved_requests_counter = 0
+    for doi_candidates in doi_candidate_lists:
+        title = None
+        title_doi = None
+        for doi in doi_candidates:
+            if doi in known_titles:
+                title = known_titles[doi]
+                saved_requests_counter += 1
+            elif doi in fetched_titles:
+                title = fetched_titles[doi]
+            else:
+                continue
+            title_doi = doi
+            break
+        titles.append(title)
+        title_dois.append(title_doi)
+    return titles, title_dois, saved_requests_counter
+
+
+def grobid_ref_string(bib_item_ref_string, ref_entries):
+    """ Prepare a reference string for GROBID.
+    """
+
+    # remove quote characters from bib ref string (they disturb curl API call)
+    bib_item_ref_string_clean = bib_item_ref_string.replace('"', '').replace("'",
+                                                                             "").replace(
+        '„', '').replace('“', '').replace('‟', '').replace('”', '').replace('`', '')
+
+    # check for formula entries and replace with actual (latex) content
+    match = FORMULA_PATT.search(bib_item_ref_string_clean)
+
+    if match is not None:
+        # at least one formula in title
+        match = FORMULA_PATT.finditer(bib_item_ref_string_clean)
+        for m in match:
+            formula_ref_string = m.group(0)
+            formula_ref_key = m.group(1)
+            bib_item_ref_string_clean = bib_item_ref_string_clean.replace(
+                formula_ref_string,
+                ref_entries[
+                    formula_ref_key][
+                    'latex'])
+    return bib_item_ref_string_clean
+
+
+def title_from_grobid_xml(grobid_bibstruct_xml):
+    """ Title in a biblStruct returned by GROBID, or None.
+
+        The first title marked as main title (or an untyped, non-empty one
+        before it) is used, e.g. for
+            <title level="a" type="main">The spectral radius of ...</title>
+            <title level="j">Math. Ann</title>
+        See tei.extract() for the authors, year and venue.
+    """
+
+    root = tei.parse_bibl_struct(grobid_bibstruct_xml)
+    if root is None:
+        return None
+    return tei.title(root)
+
+
+def match_bib_entry_in_openalexdb(bib_entry_dict, title, grobid_flag, cursor, candidates=None):
+    """ Match a bib entry with a determined title against the local
+        OpenAlex DB and set its ids accordingly. If given, candidates
+        prefetched with fetch_openalex_candidates() are used instead of
+        querying the DB.
+
+        Returns True if a match was found.
+    """
+
+    bib_item_title_norm = normalize_title(title)
+    bib_item_ref_string = bib_entry_dict['bib_entry_raw']
+
+    if candidates is not None:
+        matching_openalex_pub = match_title_in_candidates(candidates,
+                                                          bib_item_title_norm,
+                                                          bib_item_ref_string,
+                                                          grobid_flag)
+        ids_idx = 2
+    else:
+        # look at "left" 1000 characters in normalized title for lookup using index
+        openalexdb_title_query = 'SELECT * from openalex WHERE ("left"(normalized_title::text, 1000)) = %s'
+
+        matching_openalex_pub = match_title_in_openalexdb(openalexdb_title_query,
+                                                          bib_item_title_norm,
+                                                          bib_item_ref_string, cursor,
+                                                          grobid_flag)
+        ids_idx = 7
+
+    if matching_openalex_pub is None:
+        # append empty ids dict.
+        bib_entry_dict['ids'] = {}
+        bib_entry_dict['ids']['open_alex_id'] = ""
+        bib_entry_dict['ids']['sem_open_alex_id'] = ""
+        bib_entry_dict['ids']['pubmed_id'] = ""
+        bib_entry_dict['ids']['pmc_id'] = ""
+        bib_entry_dict['ids']['doi'] = ""
+        return False
+
+    bib_entry_ids_dict = map_ids_from_openalexdb_match_to_dict(matching_openalex_pub, ids_idx)
+
+    # add data from OpenAlex to JSON object of current publication
+    bib_entry_dict['ids']['open_alex_id'] = bib_entry_ids_dict[
+        'open_alex_id']
+    bib_entry_dict['ids']['sem_open_alex_id'] = bib_entry_ids_dict[
+        'sem_open_alex_id']
+    bib_entry_dict['ids']['pubmed_id'] = bib_entry_ids_dict[
+        'pubmed_id']
+    bib_entry_dict['ids']['pmc_id'] = bib_entry_ids_dict['pmc_id']
+    bib_entry_dict['ids']['doi'] = bib_entry_ids_dict[
+        'doi'].replace(
+        "https://doi.org/", "").replace("http://doi.org/", "")
+    return True
+
+
+def match_paper_batch(papers, cursor, conn, meta_db, grobid_client, crossref_fetcher, counts,
+                      openalex_columns=None, title_index=None, metrics=None):
+    """ Extend the bib entries of a batch of papers (JSON dicts, modified
+        in place) with identifiers.
+
+        Titles are first determined via arXiv IDs and DOIs (the latter
+        resolved for the whole batch with resolve_doi_titles()). The reference
+        strings of all remaining bib entries of the batch are then parsed
+        with GROBID at once, before all titles are matched against the
+        local OpenAlex DB. Counts are added to the dict counts.
+
+        If openalex_columns (see openalex_match_columns()) are given, the
+        titles of the whole batch are looked up with a single query. If a
+        TitleIndex is given, titles are looked up in it instead of the DB
+        (cursor and conn may then be None).
+
+        If a StageMetrics is given as metrics, the latencies of the lookup
+        stages are recorded in it, and bib entries are counted by the way
+        their title was determined ('resolved_arxiv_id', 'resolved_doi',
+        'resolved_aps_doi', 'resolved_grobid', 'no_title') and by the
+        outcome of matching ('matched', 'not_in_openalex').
+    """
+
+    if metrics is None:
+        metrics = StageMetrics()
+
+    # entries have form:
+    # {'bib_entry_raw': 'N. Doroud, J. Gomis, B. Le Floch, and S. Lee,
+    # “Exact Results in D=2 Supersymmetric Gauge Theories,” JHEP 05 (2013) 093, arXiv:1206.2606 [hep-th].',
+    # 'contained_arXiv_ids': ['1206.2606'], 'contained_links': ['http://dx.doi.org/10.1007/JHEP05(2013)093']}
+    arxiv_todo = []  # (bib entry dict, title, DOI candidates, ref entries) tuples
+    for json_data in papers:
+        try:
+            # iterate through all bib_entries of current paper
+            for bib_entry in json_data['bib_entries']:
+                try:
+                    counts['bib_items'] += 1
+                    bib_entry_dict = json_data['bib_entries'][bib_entry]
+                    _init_bib_entry_ids(bib_entry_dict)
+                    with metrics.timer('arxiv_lookup'):
+                        title = find_title_by_arxiv_id(bib_entry_dict, meta_db)
+                    if title is not None:
+                        metrics.count('resolved_arxiv_id')
+                    doi_candidates = []
+                    if title is None:
+                        doi_candidates = doi_candidates_of_bib_entry(bib_entry_dict)
+                    arxiv_todo.append(
+                        (bib_entry_dict, title, doi_candidates, json_data['ref_entries'])
+                    )
+                except Exception as be:
+                    # print(f"## Exception {be} in bib entry \n{bib_entry} \nof current pub. ##")
+                    pass
+        except Exception as ge:
+            print("## General error: " + str(ge) + " ##")
+            pass
+
+    # retrieve titles from crossref for the DOIs of all bib entries at once
+    doi_titles, doi_title_dois, saved_requests = resolve_doi_titles(
+        [doi_candidates for _, _, doi_candidates, _ in arxiv_todo],
+        cursor, conn, crossref_fetcher, metrics
+    )
+    counts['crossref_requests_saved'] += saved_requests
+
+    todo = []  # (bib entry dict, title, GROBID ref string) tuples
+    for (bib_entry_dict, title, _, ref_entries), doi_title, doi in zip(
+            arxiv_todo, doi_titles, doi_title_dois
+    ):
+        try:
+            if title is None and doi_title is not None:
+                title = doi_title
+                # DOIs not in the contained links are derived from APS
+                # journal references
+                if any(doi in link['url'] for link in bib_entry_dict['contained_links']):
+                    metrics.count('resolved_doi')
+                else:
+                    metrics.count('resolved_aps_doi')
+            ref_string = None
+            if title is None:
+                ref_string = grobid_ref_string(
+                    bib_entry_dict['bib_entry_raw'],
+                    ref_entries
+                )
+            todo.append((bib_entry_dict, title, ref_string))
+        except Exception as be:
+            pass
+
+    # find titles with GROBID in ref strings
+    grobid_ref_strings = [
+        ref_string for _, _, ref_string in todo if ref_string is not None
+    ]
+    with metrics.timer('grobid', items=len(grobid_ref_strings)):
+        grobid_results = grobid_client.parse_citations(grobid_ref_strings)
+
+    titled = []  # (bib entry dict, title, GROBID flag) tuples
+    for bib_entry_dict, title, ref_string in todo:
+        try:
+            grobid_flag = False
+            if title is None:
+                grobid_bibstruct_xml = grobid_results.get(ref_string, False)
+                if grobid_bibstruct_xml:
+                    with metrics.timer('grobid_xml_parse'):
+                        title = title_from_grobid_xml(grobid_bibstruct_xml)
+                    grobid_flag = title is not None
+                    if grobid_flag:
+                        metrics.count('resolved_grobid')
+
+            # no title identifiable for this ref string (is skipped)
+            if title is None:
+                counts['no_title'] += 1
+                metrics.count('no_title')
+                continue
+            titled.append((bib_entry_dict, title, grobid_flag))
+        except Exception as be:
+            pass
+
+    candidates = None
+    if openalex_columns is not None or title_index is not None:
+        title_norms = set()
+        for bib_entry_dict, title, grobid_flag in titled:
+            try:
+                title_norm = normalize_title(title)
+            except Exception as be:
+                continue
+            title_norms.add(title_norm)
+            if grobid_flag:
+                title_norms.update(vary_title_window(title_norm))
+        if title_index is not None:
+            with metrics.timer('title_index', items=len(title_norms)):
+                candidates = title_index.candidates(title_norms)
+        else:
+            try:
+                with metrics.timer('openalex_db_candidates', items=len(title_norms)):
+                    candidates = fetch_openalex_candidates(cursor, openalex_columns, title_norms)
+            except psycopg2.Error as e:
+                # fall back to one query per bib entry
+                print(e)
+                conn.rollback()
+
+    # matching against prefetched candidates, otherwise one (or three) DB
+    # queries per bib entry
+    match_stage = 'openalex_db_match' if candidates is None else 'openalex_match'
+    for bib_entry_dict, title, grobid_flag in titled:
+        try:
+            # title is found and now used to check (local) OpenAlex database
+            with metrics.timer(match_stage):
+                matched = match_bib_entry_in_openalexdb(
+                    bib_entry_dict, title, grobid_flag, cursor, candidates
+                )
+            if matched:
+                metrics.count('matched')
+            else:
+                counts['not_in_openalex'] += 1
+                metrics.count('not_in_openalex')
+        except Exception as be:
+            pass
+
+
+def _enriched_chunk_fp(jsonl_file_path, output_root_dir):
+    """ Output path of a chunk: <output_root_dir>/<name of the current
+        working directory>/<chunk file name>
+    """
+
+    chunk_fn = os.path.basename(jsonl_file_path)
+    year_dir = os.path.split(os.getcwd())[1]
+    return os.path.join(output_root_dir, year_dir, chunk_fn)
+
+
+# queue for throughput reports of matching workers to match()
+_progress_queue = None
+
+
+def _init_matching_worker(progress_queue):
+    global _progress_queue
+    _progress_queue = progress_queue
+
+
+def _report_progress(num_papers, seconds):
+    if _progress_queue is not None:
+        _progress_queue.put((os.getpid(), num_papers, seconds))
+
+
+def write_matching_log(output_root_dir, jsonl_file_path, counts, start_time,
+                       end_time, lookup_cache=None, crossref_rate_limit=None,
+                       stage_metrics=None, papers_resumed=0):
+    """ Print the matching quotas of a chunk and write its log, which marks
+        the chunk as done.
+
+        The counts only cover the papers matched in this run, not the
+        papers_resumed ones already written by an interrupted earlier run.
+    """
+
+    bib_item_counter = counts['bib_items']
+    bib_item_no_title_error_counter = counts['no_title']
+    bib_item_title_not_in_openalex_error_counter = counts['not_in_openalex']
+    saved_requests_counter = counts['crossref_requests_saved']
+
+    if bib_item_counter != 0:
+        print(f"Worker done with chunk file {jsonl_file_path}. \nErrors in title determination in bibitems:",
+              bib_item_no_title_error_counter, "/",
+              bib_item_counter)
+        print("Success quota (fraction of titles successfully determined) = {:.2f}".format(
+            100 * ((bib_item_counter - bib_item_no_title_error_counter) / bib_item_counter)))
+
+        print("Error rate for title matching with OpenAlex for bibitems with determined title:",
+              bib_item_title_not_in_openalex_error_counter, "/",
+              (bib_item_counter - bib_item_no_title_error_counter),
+              "\t | Success = {:.2f}".format(
+                  100 * ((bib_item_counter - bib_item_title_not_in_openalex_error_counter -
+                          bib_item_no_title_error_counter) / (
+                                 bib_item_counter - bib_item_no_title_error_counter))))
+        print("Overall bib_item_matching_success_quota = {:.2f}".format((bib_item_counter -
+                                                                         bib_item_no_title_error_counter -
+                                                                         bib_item_title_not_in_openalex_error_counter) / bib_item_counter))
+    else:
+        print("Bib item count is 0! No bibliography items in current publications?")
+    if papers_resumed > 0:
+        print(f"(counts cover only this run; {papers_resumed} papers were matched by an earlier run)")
+
+        # write log
+    if not os.path.exists(output_root_dir + "logs"):
+        os.makedirs(output_root_dir + "logs")
+
+    with open(
+            output_root_dir + "logs/" + jsonl_file_path.split("/")[-1] + "-matching-log.json",
+            "w") as log_file:
+
+        if bib_item_counter != 0:
+            bib_item_matching_success_quota = (bib_item_counter - bib_item_no_title_error_counter -
+                                               bib_item_title_not_in_openalex_error_counter) / bib_item_counter
+        else:
+            bib_item_matching_success_quota = 0
+
+        d = {'start_time': start_time.ctime(),
+             'end_time': end_time.ctime(),
+             'runtime_seconds': (end_time - start_time).total_seconds(),
+             'papers_resumed': papers_resumed,
+             'bib_items_processed': bib_item_counter,
+             'bib_items_error_no_title': bib_item_no_title_error_counter,
+             'bib_items_error_no_match_in_openalex': bib_item_title_not_in_openalex_error_counter,
+             'bib_item_matching_success_quota': bib_item_matching_success_quota,
+             'crossref_requests_saved': saved_requests_counter,
+             'lookup_cache': lookup_cache,
+             'crossref_rate_limit': crossref_rate_limit,
+             'stage_metrics': stage_metrics}
+
+        json.dump(d, log_file)
+        log_file.close()
+
+
+def extend_parsed_arxiv_chunk(params):
+    """ Match the references of the papers in a chunk (or, if paper_range is
+        given, of the input lines start to end-1 of the chunk).
+
+        Returns a summary dict of the processed papers and counts. For a
+        whole chunk the matching log is written; for a paper range the
+        summary is written next to the range output instead, so that
+        match() can merge the ranges of a chunk later.
+    """
+
+    (jsonl_file_path, output_root_dir, match_db_host, meta_db_uri, grobid_host, cache_fp,
+     title_index_fp, crossref_url, crossref_rate_limit_fp, paper_range) = params
+    counts = {
+        'bib_items': 0,
+        'no_title': 0,
+        'not_in_openalex': 0,
+        'crossref_requests_saved': 0
+    }
     start_time = datetime.now()
+    metrics = StageMetrics()
 
     # create connection to local openalex database (with openalex and crossref tables)
-    conn = psycopg2.connect(
-        host=match_db_host,
-        database='openalex',
-        user='postgres',
-        password=None
-    )
-    cursor = conn.cursor()
+    conn = None
+    cursor = None
+    if match_db_host != NO_MATCH_DB:
+        conn = psycopg2.connect(
+            host=match_db_host,
+            database='openalex',
+            user='postgres',
+            password=None
+        )
+        cursor = conn.cursor()
+
+    # embedded title index replacing the openalex table
+    title_index = None
+    openalex_columns = None
+    if title_index_fp is not None:
+        title_index = TitleIndex(title_index_fp)
+    elif BULK_TITLE_MATCHING:
+        openalex_columns = openalex_match_columns(cursor)
 
     # connection to local arxiv db for lookup using arxiv ID
-    connection_arxiv_db = sqlite3.connect(meta_db_uri)
-    cursor_arxiv = connection_arxiv_db.cursor()
+    meta_db = MetadataDB(meta_db_uri)
+
+    # persistent cache for Crossref and GROBID lookups
+    cache = LookupCache(cache_fp) if cache_fp is not None else None
+
+    grobid_client = GrobidClient(grobid_host, cache=cache)
+    # Crossref rate limit shared by all workers
+    crossref_rate_limiter = FileTokenBucket(
+        crossref_rate_limit_fp, CROSSREF_REQUESTS_PER_SECOND
+    )
+    crossref_fetcher = CrossrefFetcher(
+        base_url=crossref_url, cache=cache, rate_limiter=crossref_rate_limiter
+    )
 
     # check if folder exists
-    chunk_fn = os.path.basename(jsonl_file_path)
-    year_dir = os.path.split(os.getcwd())[1]
-    year_dir_path = os.path.join(output_root_dir, year_dir)
-    enriched_chunk_fp = os.path.join(year_dir_path, chunk_fn)
+    enriched_chunk_fp = _enriched_chunk_fp(jsonl_file_path, output_root_dir)
+    year_dir_path = os.path.dirname(enriched_chunk_fp)
     if not os.path.exists(year_dir_path):
         os.makedirs(year_dir_path)
-
-    with open(enriched_chunk_fp, "w", encoding="utf-8") as output_chunk:
+    if paper_range is None:
+        first_line, end_line = 0, None
+        output_fp = enriched_chunk_fp
+    else:
+        first_line, end_line = paper_range
+        output_fp = _range_fp(enriched_chunk_fp, paper_range)
+
+    # papers are streamed to <chunk>.part, which is renamed when the chunk
+    # is done. A .part left by a killed worker is resumed after the papers
+    # it already contains (output lines are in input order).
+    num_papers = 0
+    with JsonlWriter(output_fp, resume=True) as output_chunk:
         with open(jsonl_file_path, 'r', encoding='utf-8') as chunk:
             print("Worker reading file ", jsonl_file_path, "..")
-            output_chunk_temp = ""
-            for publication in chunk:
+            num_done = sum(1 for _ in output_chunk.resumed_lines())
+            # (their matches were counted by the earlier run, see
+            # write_matching_log())
+            papers_resumed = num_done
+            if num_done > 0:
+                print(f"Resuming {output_fp} after {num_done} papers")
+            papers = []
+
+            def match_and_write():
+                batch_start = time.perf_counter()
+                match_paper_batch(papers, cursor, conn, meta_db, grobid_client, crossref_fetcher, counts,
+                                  openalex_columns, title_index, metrics)
+                with metrics.timer('write_output', items=len(papers)):
+                    for json_data in papers:
+                        output_chunk.write(json_data)
+                _report_progress(len(papers), time.perf_counter() - batch_start)
+
+            for line_idx, publication in enumerate(chunk):
+                if line_idx < first_line:
+                    continue
+                if end_line is not None and line_idx >= end_line:
+                    break
                 try:
                     json_data = json.loads(publication)
-
-                    # iterate through all bib_entries of current paper
-                    # entries have form:
-                    # {'bib_entry_raw': 'N. Doroud, J. Gomis, B. Le Floch, and S. Lee,
-                    # “Exact Results in D=2 Supersymmetric Gauge Theories,” JHEP 05 (2013) 093, arXiv:1206.2606 [hep-th].',
-                    # 'contained_arXiv_ids': ['1206.2606'], 'contained_links': ['http://dx.doi.org/10.1007/JHEP05(2013)093']}
-
-                    for bib_entry in json_data['bib_entries']:
-                        try:
-                            bib_item_counter += 1
-                            bib_entry_aid = None
-                            title = None
-                            grobid_flag = False
-
-                            json_data['bib_entries'][bib_entry]['ids'] = OrderedDict()
-                            json_data['bib_entries'][bib_entry]['ids']['open_alex_id'] = ""
-                            json_data['bib_entries'][bib_entry]['ids']['sem_open_alex_id'] = ""
-                            json_data['bib_entries'][bib_entry]['ids']['pubmed_id'] = ""
-                            json_data['bib_entries'][bib_entry]['ids']['pmc_id'] = ""
-                            json_data['bib_entries'][bib_entry]['ids']['doi'] = ""
-                            json_data['bib_entries'][bib_entry]['ids']['arxiv_id'] = ""
-
-                            # look for arxiv ID in parsed bib entry data
-                            if len(json_data['bib_entries'][bib_entry]['contained_arXiv_ids']) != 0:
-                                bib_entry_aid = json_data['bib_entries'][bib_entry]['contained_arXiv_ids']
-
-                            # look for arxiv ID in full ref string of bib item
-                            else:
-                                bib_entry_regex_test = find_arxiv_id(
-                                    json_data['bib_entries'][bib_entry]['bib_entry_raw'])
-                                if bib_entry_regex_test is not False:
-                                    bib_entry_aid = bib_entry_regex_test
-
-                            # if arxiv ID is determined either way, check metadata arxiv db to get clean title
-                            if bib_entry_aid is not None:
-
-                                try:
-                                    # if multiple arxiv ids or dict in parsed data of current bib item, choose first
-                                    if type(bib_entry_aid) is list:
-                                        if len(bib_entry_aid) != 0:
-                                            aid = str(bib_entry_aid[0]['id'])
-                                            aid_m = ARXIV_ID_PATT_DATE.match(aid)
-                                            aid_year = aid_m.group(2)
-                                            aid_month = aid_m.group(3)
-
-                                            title_from_arxive_meta_db = title_lookup_in_arxiv_metadata_db(
-                                                aid, cursor_arxiv, aid_year, aid_month)
-                                    else:
-                                        aid_m = ARXIV_ID_PATT_DATE.match(str(bib_entry_aid))
-                                        aid_year = aid_m.group(2)
-                                        aid_month = aid_m.group(3)
-                                        title_from_arxive_meta_db = title_lookup_in_arxiv_metadata_db(
-                                            str(bib_entry_aid),
-                                            cursor_arxiv, aid_year, aid_month)
-
-                                    if title_from_arxive_meta_db is not None:
-                                        if len(title_from_arxive_meta_db) != 0:
-                                            title = title_from_arxive_meta_db
-
-                                except IndexError as indexerror:
-                                    # indexerror encountered
-                                    pass
-
-                                except Exception as e:
-                                    print(e)
-                                    pass
-
-                            # retrieve title from crossref
-                            # (look for DOI in contained links and try
-                            #  to determine DOI for APS journals)
-                            doi_candidates = []
-                            if title is None:
-                                # check contained links
-                                if len(json_data['bib_entries'][bib_entry]['contained_links']) != 0:
-                                    # multiple urls possible in list
-                                    bib_item_urls = json_data['bib_entries'][bib_entry]['contained_links']
-                                    for url in bib_item_urls:
-                                        bib_item_doi_m = DOI_PATT.search(url)
-                                        if bib_item_doi_m:
-                                            bib_item_doi = bib_item_doi_m.group(0)
-                                            if bib_item_doi[-1] == '/':
-                                                bib_item_doi = bib_item_doi[:-1]
-                                            doi_candidates.append(
-                                                bib_item_doi
-                                            )
-                                # look for APS references
-                                aps_doi = identify_implicit_aps_journal_doi(
-                                    json_data['bib_entries'][bib_entry]['bib_entry_raw']
-                                )
-                                if aps_doi is not None:
-                                    doi_candidates = [aps_doi] + doi_candidates
-                                # work with DOIs found
-                                try:
-                                    for doi_candi in doi_candidates:
-                                        if title is not None:
-                                            break
-                                        # check whether there's already a title for this DOI in local crossref table
-                                        crossrefdb_title_query = "SELECT * from crossref WHERE doi=%s"
-                                        cursor.execute(crossrefdb_title_query, (doi_candi,))
-                                        crossref_matching_pub = cursor.fetchall()
-
-                                        if len(crossref_matching_pub) == 1:
-                                            title = crossref_matching_pub[0][1]
-                                            saved_requests_counter += 1
-
-                                        elif len(crossref_matching_pub) > 1:
-                                            title = crossref_matching_pub[0][1]
-                                            saved_requests_counter += 1
-
-                                        elif len(crossref_matching_pub) == 0:
-                                            crossref_api_result = find_title_in_crossref_by_doi(
-                                                doi_candi)
-                                            if crossref_api_result is not False:
-                                                title = crossref_api_result
-
-                                                # write title to db
-                                                cursor.execute(
-                                                    "INSERT INTO crossref (doi, title) VALUES (%s,%s)",
-                                                    (doi_candi, title))
-                                                conn.commit()
-
-
-                                except TypeError as te:  # FIXME: where would that occurr in the large block above?
-                                    pass
-
-                                # for the unprobable case that two threads look up the title for same DOI
-                                # at the same time and try to write to table (DOI is primary key)
-                                except psycopg2.IntegrityError as ie:
-                                    print(ie)
-                                    pass
-
-                            # find title with GROBID in ref string
-                            if title is None:
-                                bib_item_ref_string = json_data['bib_entries'][bib_entry]['bib_entry_raw']
-
-                                # remove quote characters from bib ref string (they disturb curl API call)
-                                bib_item_ref_string_clean = bib_item_ref_string.replace('"', '').replace("'",
-                                                                                                         "").replace(
-                                    '„', '').replace('“', '').replace('‟', '').replace('”', '').replace('`', '')
-
-                                # check for formula entries and replace with actual (latex) content
-                                match = FORMULA_PATT.search(bib_item_ref_string_clean)
-
-                                if match is not None:
-                                    # at least one formula in title
-                                    match = FORMULA_PATT.finditer(bib_item_ref_string_clean)
-                                    for m in match:
-                                        formula_ref_string = m.group(0)
-                                        formula_ref_key = formula_ref_string.replace("{{formula:", "").replace("}}", "")
-                                        bib_item_ref_string_clean = bib_item_ref_string_clean.replace(
-                                            formula_ref_string,
-                                            json_data['ref_entries'][
-                                                formula_ref_key][
-                                                'latex'])
-
-                                # get title from GROBID API
-                                grobid_bibstruct_xml = find_title_with_grobid_in_string(grobid_host,
-                                                                                        bib_item_ref_string_clean)
-
-                                if grobid_bibstruct_xml:
-                                    grobid_returned_data_xml = BeautifulSoup(grobid_bibstruct_xml, 'lxml')
-                                    grobid_title_results = grobid_returned_data_xml.findAll('title')
-
-                                    for t in grobid_title_results:
-
-                                        if title is None:
-                                            # grobid output marked as title:
-                                            # [<title level="a" type="main">The spectral radius of the Coxeter transformations for a generalized Cartan matrix</title>, <title level="j">Math. Ann</title>]
-                                            # key "type" not always present
-
-                                            try:
-                                                if t['type'] == "main":
-                                                    title = t.get_text(strip=True)
-                                                    grobid_flag = True
-                                                    # print(t['type'], title)
-                                            except KeyError as ke:
-                                                if t.get_text(strip=True) is not None:
-                                                    if len(t.get_text(strip=True)) is not 0:
-                                                        title = t.get_text(strip=True)
-                                                        grobid_flag = True
-                                                pass
-
-                            # no title identifiable for this ref string (is skipped)
-                            if title is None:
-                                bib_item_no_title_error_counter += 1
-
-                            # title is found and now used to check (local) OpenAlex database
-                            if title is not None:
-                                bib_item_title_norm = normalize_title(title)
-                                bib_item_ref_string = json_data['bib_entries'][bib_entry]['bib_entry_raw']
-
-                                # look at "left" 1000 characters in normalized title for lookup using index
-                                openalexdb_title_query = 'SELECT * from openalex WHERE ("left"(normalized_title::text, 1000)) = %s'
-
-                                matching_openalex_pub = match_title_in_openalexdb(openalexdb_title_query,
-                                                                                  bib_item_title_norm,
-                                                                                  bib_item_ref_string, cursor,
-                                                                                  grobid_flag)
-
-                                if matching_openalex_pub is None:
-                                    bib_item_title_not_in_openalex_error_counter += 1
-
-                                    # append empty ids dict.
-                                    json_data['bib_entries'][bib_entry]['ids'] = {}
-                                    json_data['bib_entries'][bib_entry]['ids']['open_alex_id'] = ""
-                                    json_data['bib_entries'][bib_entry]['ids']['sem_open_alex_id'] = ""
-                                    json_data['bib_entries'][bib_entry]['ids']['pubmed_id'] = ""
-                                    json_data['bib_entries'][bib_entry]['ids']['pmc_id'] = ""
-                                    json_data['bib_entries'][bib_entry]['ids']['doi'] = ""
-
-                                elif matching_openalex_pub is not None:
-                                    bib_entry_ids_dict = map_ids_from_openalexdb_match_to_dict(matching_openalex_pub)
-
-                                    # add data from OpenAlex to JSON object of current publication
-                                    json_data['bib_entries'][bib_entry]['ids']['open_alex_id'] = bib_entry_ids_dict[
-                                        'open_alex_id']
-                                    json_data['bib_entries'][bib_entry]['ids']['sem_open_alex_id'] = bib_entry_ids_dict[
-                                        'sem_open_alex_id']
-                                    json_data['bib_entries'][bib_entry]['ids']['pubmed_id'] = bib_entry_ids_dict[
-                                        'pubmed_id']
-                                    json_data['bib_entries'][bib_entry]['ids']['pmc_id'] = bib_entry_ids_dict['pmc_id']
-                                    json_data['bib_entries'][bib_entry]['ids']['doi'] = bib_entry_ids_dict[
-                                        'doi'].replace(
-                                        "https://doi.org/", "").replace("http://doi.org/", "")
-
-                        except Exception as be:
-                            # print(f"## Exception {be} in bib entry \n{bib_entry} \nof current pub. ##")
-                            pass
                 except Exception as ge:
                     print("## General error: " + str(ge) + " ##")
-                    pass
+                    continue
+                if num_done > 0:
+                    num_done -= 1
+                    continue
+                papers.append(json_data)
+                if len(papers) == PAPER_BATCH_SIZE:
+                    match_and_write()
+                    num_papers += len(papers)
+                    papers = []
+            if len(papers) > 0:
+                match_and_write()
+                num_papers += len(papers)
+            # complete output before the log marks the chunk as done
+            output_chunk.close()
+            chunk.close()
 
-                finally:
-                    output_chunk_temp = output_chunk_temp + json.dumps(json_data) + "\n"
-
-            output_chunk.write(output_chunk_temp)
-
-            if bib_item_counter != 0:
-                print(f"Worker done with chunk file {jsonl_file_path}. \nErrors in title determination in bibitems:",
-                      bib_item_no_title_error_counter, "/",
-                      bib_item_counter)
-                print("Success quota (fraction of titles successfully determined) = {:.2f}".format(
-                    100 * ((bib_item_counter - bib_item_no_title_error_counter) / bib_item_counter)))
-
-                print("Error rate for title matching with OpenAlex for bibitems with determined title:",
-                      bib_item_title_not_in_openalex_error_counter, "/",
-                      (bib_item_counter - bib_item_no_title_error_counter),
-                      "\t | Success = {:.2f}".format(
-                          100 * ((bib_item_counter - bib_item_title_not_in_openalex_error_counter -
-                                  bib_item_no_title_error_counter) / (
-                                         bib_item_counter - bib_item_no_title_error_counter))))
-                print("Overall bib_item_matching_success_quota = {:.2f}".format((bib_item_counter -
-                                                                                 bib_item_no_title_error_counter -
-                                                                                 bib_item_title_not_in_openalex_error_counter) / bib_item_counter))
-            else:
-                print("Bib item count is 0! No bibliography items in current publications?")
+    end_time = datetime.now()
+    summary = {
+        'chunk': jsonl_file_path,
+        'paper_range': paper_range,
+        'pid': os.getpid(),
+        'papers': num_papers,
+        'papers_resumed': papers_resumed,
+        'start_time': start_time.timestamp(),
+        'end_time': end_time.timestamp(),
+        'counts': counts,
+        'lookup_cache': cache.stats() if cache is not None else None,
+        'crossref_rate_limit': crossref_rate_limiter.metrics(),
+        'stage_metrics': metrics.to_dict()
+    }
+    if paper_range is None:
+        write_matching_log(
+            output_root_dir, jsonl_file_path, counts, start_time, end_time,
+            summary['lookup_cache'], summary['crossref_rate_limit'],
+            summary['stage_metrics'], papers_resumed
+        )
+    else:
+        with open(output_fp + RANGE_SUMMARY_SUFFIX, 'w') as summary_file:
+            json.dump(summary, summary_file)
 
-                # write log
-            if not os.path.exists(output_root_dir + "logs"):
-                os.makedirs(output_root_dir + "logs")
+    if conn is not None:
+        conn.close()
+    if title_index is not None:
+        title_index.close()
+    meta_db.close()
+    grobid_client.close()
+    crossref_fetcher.close()
+    if cache is not None:
+        cache.close()
+    return summary
 
-            with open(
-                    output_root_dir + "logs/" + jsonl_file_path.split("/")[-1] + "-matching-log.json",
-                    "w") as log_file:
-                end_time = datetime.now()
 
-                if bib_item_counter != 0:
-                    bib_item_matching_success_quota = (bib_item_counter - bib_item_no_title_error_counter -
-                                                       bib_item_title_not_in_openalex_error_counter) / bib_item_counter
-                else:
-                    bib_item_matching_success_quota = 0
+def _range_fp(enriched_chunk_fp, paper_range):
+    return '{}.{}-{}'.format(enriched_chunk_fp, *paper_range)
 
-                d = {'start_time': start_time.ctime(),
-                     'end_time': end_time.ctime(),
-                     'runtime_seconds': (end_time - start_time).total_seconds(),
-                     'bib_items_processed': bib_item_counter,
-                     'bib_items_error_no_title': bib_item_no_title_error_counter,
-                     'bib_items_error_no_match_in_openalex': bib_item_title_not_in_openalex_error_counter,
-                     'bib_item_matching_success_quota': bib_item_matching_success_quota,
-                     'crossref_requests_saved': saved_requests_counter}
 
-                json.dump(d, log_file)
-                log_file.close()
+def _count_lines(fp):
+    with open(fp, 'rb') as f:
+        return sum(1 for _ in f)
 
-            chunk.close()
+
+def merge_chunk_ranges(jsonl_file_path, output_root_dir, summaries):
+    """ Concatenate the range outputs of a split chunk into the chunk's
+        output, write the chunk's matching log and remove the range files.
+    """
+
+    summaries = sorted(summaries, key=lambda s: s['paper_range'][0])
+    enriched_chunk_fp = _enriched_chunk_fp(jsonl_file_path, output_root_dir)
+    with JsonlWriter(enriched_chunk_fp, fsync_every=10000) as output_chunk:
+        for summary in summaries:
+            with open(
+                    _range_fp(enriched_chunk_fp, summary['paper_range']),
+                    'r', encoding='utf-8'
+            ) as range_file:
+                for line in range_file:
+                    output_chunk.write_line(line)
         output_chunk.close()
-    conn.close()
-    connection_arxiv_db.close()
+
+    counts = {}
+    lookup_cache = None
+    metrics = StageMetrics()
+    for summary in summaries:
+        metrics.merge(summary['stage_metrics'])
+        for key, value in summary['counts'].items():
+            counts[key] = counts.get(key, 0) + value
+        if summary['lookup_cache'] is not None:
+            if lookup_cache is None:
+                lookup_cache = {}
+            for namespace, stats in summary['lookup_cache'].items():
+                merged = lookup_cache.setdefault(
+                    namespace, {'hits': 0, 'misses': 0}
+                )
+                merged['hits'] += stats['hits']
+                merged['misses'] += stats['misses']
+    last_summary = max(summaries, key=lambda s: s['end_time'])
+    write_matching_log(
+        output_root_dir, jsonl_file_path, counts,
+        datetime.fromtimestamp(min(s['start_time'] for s in summaries)),
+        datetime.fromtimestamp(last_summary['end_time']),
+        lookup_cache, last_summary['crossref_rate_limit'], metrics.to_dict(),
+        sum(summary.get('papers_resumed', 0) for summary in summaries)
+    )
+    for summary in summaries:
+        range_fp = _range_fp(enriched_chunk_fp, summary['paper_range'])
+        os.remove(range_fp)
+        os.remove(range_fp + RANGE_SUMMARY_SUFFIX)
+
+
+def write_run_metrics(out_dir, metrics, num_papers, seconds, prometheus_fp=None,
+                      papers_resumed=0):
+    """ Write the stage metrics aggregated over all workers of a run to
+        <out_dir>/logs/matching-metrics.json and, if prometheus_fp is given,
+        in the Prometheus text format to prometheus_fp. Both files are
+        replaced atomically, so they can be read while matching runs.
+
+        Metrics and num_papers only cover the papers matched in this run;
+        papers_resumed is the number of papers skipped because an
+        interrupted earlier run had already written them.
+    """
+
+    log_dir = os.path.join(out_dir, 'logs')
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    summary = metrics.to_dict()
+    summary['papers'] = num_papers
+    summary['papers_resumed'] = papers_resumed
+    summary['runtime_seconds'] = seconds
+    summary['papers_per_second'] = num_papers / seconds if seconds else None
+    metrics_fp = os.path.join(log_dir, METRICS_FN)
+    with open(metrics_fp + '.tmp', 'w') as f:
+        json.dump(summary, f, indent=2)
+    os.replace(metrics_fp + '.tmp', metrics_fp)
+    if prometheus_fp is not None:
+        with open(prometheus_fp + '.tmp', 'w') as f:
+            f.write(metrics.to_prometheus(PROMETHEUS_METRIC_PREFIX))
+            f.write('# TYPE {0}_papers_total counter\n'
+                    '{0}_papers_total {1}\n'.format(
+                        PROMETHEUS_METRIC_PREFIX, num_papers
+                    ))
+        os.replace(prometheus_fp + '.tmp', prometheus_fp)
+
+
+def _print_progress(progress_queue, interval):
+    """ Print the throughput of each worker process every interval seconds
+        from the (pid, papers, seconds) tuples workers put into the queue.
+    """
+
+    start = time.perf_counter()
+    last_print = start
+    worker_stats = {}  # pid -> [papers, seconds]
+    while True:
+        try:
+            item = progress_queue.get(timeout=interval)
+        except queue.Empty:
+            item = ()
+        if item is None:
+            return
+        if item:
+            pid, num_papers, seconds = item
+            stats = worker_stats.setdefault(pid, [0, 0.0])
+            stats[0] += num_papers
+            stats[1] += seconds
+        now = time.perf_counter()
+        if now - last_print < interval or not worker_stats:
+            continue
+        last_print = now
+        total_papers = sum(stats[0] for stats in worker_stats.values())
+        print('Matching progress: {} papers, {:.2f} papers/s overall | '
+              'papers/s per worker: {}'.format(
+                  total_papers,
+                  total_papers / (now - start),
+                  ', '.join(
+                      '{}: {:.2f}'.format(pid, papers / max(seconds, 1e-9))
+                      for pid, (papers, seconds) in sorted(worker_stats.items())
+                  )
+              ))
 
 
 def match(
-        in_dir, out_dir, match_db_host, meta_db_uri, grobid_host, num_workers
+        in_dir, out_dir, match_db_host, meta_db_uri, grobid_host, num_workers,
+        cache_fp=None, title_index_fp=None, crossref_url=CROSSREF_API_URL,
+        split_papers=None, prometheus_fp=None
 ):
+    """ Match the references of all JSONL chunks in in_dir that aren't done
+        yet.
+
+        Chunks are handed to the workers one at a time, largest first, so
+        that no worker ends up with a long tail of big chunks. If
+        split_papers is given, chunks with more papers are split into
+        ranges of split_papers papers which are matched in parallel and
+        merged afterwards.
+
+        Stage metrics of all workers are aggregated and written with
+        write_run_metrics() whenever a chunk is done.
+    """
+
     # get list of JSONLs already processed
     matching_log_dir = 'logs'
     matching_log_suffix = '-matching-log.json'
@@ -694,18 +1201,61 @@ def match(
                 fp = os.path.join(path_to_file, fn)
                 todo_fps.append(fp)
 
-    # create work param packaged for individual workers
-    worker_params = []
+    # state of the Crossref rate limit shared by all workers
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    crossref_rate_limit_fp = os.path.join(out_dir, '.crossref_rate_limit')
+    if os.path.exists(crossref_rate_limit_fp):
+        os.remove(crossref_rate_limit_fp)
+
+    # create work param packaged for individual workers, each with the
+    # (estimated) number of bytes it covers
+    sized_params = []
+    # chunk path -> [number of ranges, summaries of the finished ones]
+    split_chunks = {}
     for input_file_path in todo_fps:
-        worker_params.append(
-            (
-                input_file_path,
-                out_dir,
-                match_db_host,
-                meta_db_uri,
-                grobid_host
-            )
-        )
+        size = os.path.getsize(input_file_path)
+        paper_ranges = [None]
+        if split_papers is not None:
+            num_lines = _count_lines(input_file_path)
+            if num_lines > split_papers:
+                paper_ranges = [
+                    (start, min(start + split_papers, num_lines))
+                    for start in range(0, num_lines, split_papers)
+                ]
+                split_chunks[input_file_path] = [len(paper_ranges), []]
+        for paper_range in paper_ranges:
+            if paper_range is not None:
+                range_fp = _range_fp(
+                    _enriched_chunk_fp(input_file_path, out_dir), paper_range
+                )
+                if os.path.exists(range_fp + RANGE_SUMMARY_SUFFIX):
+                    # done in an earlier run
+                    with open(range_fp + RANGE_SUMMARY_SUFFIX) as f:
+                        split_chunks[input_file_path][1].append(json.load(f))
+                    continue
+                range_size = \
+                    size * (paper_range[1] - paper_range[0]) // num_lines
+            else:
+                range_size = size
+            sized_params.append((
+                range_size,
+                (
+                    input_file_path,
+                    out_dir,
+                    match_db_host,
+                    meta_db_uri,
+                    grobid_host,
+                    cache_fp,
+                    title_index_fp,
+                    crossref_url,
+                    crossref_rate_limit_fp,
+                    paper_range
+                )
+            ))
+    # largest first
+    sized_params.sort(key=lambda sized: sized[0], reverse=True)
+    worker_params = [params for _, params in sized_params]
 
     # print((
     #     f'{len(done_fns)} JSONLs already processed'
@@ -714,25 +1264,104 @@ def match(
     # ))
     # sys.exit()
 
-    pool = Pool(num_workers, maxtasksperchild=5)
-    pool.map(extend_parsed_arxiv_chunk, worker_params)
+    def merge_if_complete(input_file_path):
+        num_ranges, summaries = split_chunks[input_file_path]
+        if len(summaries) == num_ranges:
+            merge_chunk_ranges(input_file_path, out_dir, summaries)
+
+    for input_file_path in split_chunks:
+        merge_if_complete(input_file_path)
+
+    progress_queue = multiprocessing.Queue()
+    progress_printer = threading.Thread(
+        target=_print_progress,
+        args=(progress_queue, PROGRESS_INTERVAL_SECONDS),
+        daemon=True
+    )
+    progress_printer.start()
+    pool = Pool(
+        num_workers, maxtasksperchild=5,
+        initializer=_init_matching_worker, initargs=(progress_queue,)
+    )
+    start = time.perf_counter()
+    run_metrics = StageMetrics()
+    num_papers = 0
+    num_papers_resumed = 0
+    for num_done, summary in enumerate(
+            pool.imap_unordered(
+                extend_parsed_arxiv_chunk, worker_params, chunksize=1
+            ),
+            start=1
+    ):
+        seconds = summary['end_time'] - summary['start_time']
+        print('Matched {}{} ({}/{}): {} papers in {:.0f}s by worker {} '
+              '({:.2f} papers/s), {:.0f}s elapsed'.format(
+                  summary['chunk'],
+                  '' if summary['paper_range'] is None else
+                  ' papers {}-{}'.format(*summary['paper_range']),
+                  num_done, len(worker_params), summary['papers'], seconds,
+                  summary['pid'], summary['papers'] / max(seconds, 1e-9),
+                  time.perf_counter() - start
+              ))
+        if summary['paper_range'] is not None:
+            split_chunks[summary['chunk']][1].append(summary)
+            merge_if_complete(summary['chunk'])
+        run_metrics.merge(summary['stage_metrics'])
+        num_papers += summary['papers']
+        num_papers_resumed += summary['papers_resumed']
+        write_run_metrics(
+            out_dir, run_metrics, num_papers, time.perf_counter() - start,
+            prometheus_fp, num_papers_resumed
+        )
     pool.close()
+    pool.join()
+    progress_queue.put(None)
+    progress_printer.join()
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 7:
+    args = sys.argv[1:]
+    flag_values = {
+        '--cache': None, '--title-index': None, '--crossref-url': CROSSREF_API_URL,
+        '--split-papers': None, '--prometheus': None
+    }
+    for flag in flag_values:
+        if flag not in args:
+            continue
+        flag_idx = args.index(flag)
+        try:
+            flag_values[flag] = args[flag_idx+1]
+        except IndexError:
+            args = []
+            break
+        del args[flag_idx:flag_idx+2]
+    cache_fp = flag_values['--cache']
+    title_index_fp = flag_values['--title-index']
+    crossref_url = flag_values['--crossref-url']
+    split_papers = flag_values['--split-papers']
+    if split_papers is not None:
+        split_papers = int(split_papers)
+    prometheus_fp = flag_values['--prometheus']
+    if len(args) != 6 or (args[2] == NO_MATCH_DB and title_index_fp is None):
         print((
             'Usage: python3 match_references_openalex.py <in_dir> <out_dir> '
-            '<match_db_host> <meta_db_uri> <grobid_host> <num_workers>'
+            '<match_db_host> <meta_db_uri> <grobid_host> <num_workers> '
+            '[--cache <cache.sqlite>] [--title-index <title_index_file>] '
+            '[--crossref-url <url>] [--split-papers <N>] '
+            '[--prometheus <metrics.prom>]\n'
+            '       (<match_db_host> can be "-" if a title index is given)'
         ))
         sys.exit()
 
-    in_dir = sys.argv[1]
-    out_dir = sys.argv[2]
-    match_db_host = sys.argv[3]
-    meta_db_uri = sys.argv[4]
-    grobid_host = sys.argv[5]
-    num_workers = int(sys.argv[6])
+    in_dir = args[0]
+    out_dir = args[1]
+    match_db_host = args[2]
+    meta_db_uri = args[3]
+    grobid_host = args[4]
+    num_workers = int(args[5])
     match(
-        in_dir, out_dir, match_db_host, meta_db_uri, grobid_host, num_workers
+        in_dir, out_dir, match_db_host, meta_db_uri, grobid_host, num_workers,
+        cache_fp=cache_fp, title_index_fp=title_index_fp,
+        crossref_url=crossref_url, split_papers=split_papers,
+        prometheus_fp=prometheus_fp
     )
@@ -0,0 +1,105 @@
+""" Access to the arXiv metadata SQLite DB generated by
+    generate_metadata_db.py.
+
+    Two schema versions exist:
+
+    1: table paper(year, month, aid, title, json) with an index on
+       (year, month)
+    2: table paper(aid, year, month, title, title_norm, json) clustered on
+       its primary key aid (WITHOUT ROWID), with indices on (year, month)
+       and title_norm; json is stored zlib compressed. Marked by
+       PRAGMA user_version = 2.
+"""
+
+import sqlite3
+import zlib
+
+SCHEMA_V1 = 1
+SCHEMA_V2 = 2
+
+
+def schema_version(db_cur):
+    """ Schema version of the metadata DB behind the given cursor.
+    """
+
+    user_version = db_cur.execute('pragma user_version').fetchone()[0]
+    if user_version == SCHEMA_V2:
+        return SCHEMA_V2
+    return SCHEMA_V1
+
+
+def compress_json(json_str):
+    return zlib.compress(json_str.encode('utf-8'))
+
+
+def decompress_json(json_val):
+    """ Metadata JSON as str, regardless of whether it is stored
+        compressed (schema v2) or not (schema v1).
+    """
+
+    if isinstance(json_val, bytes):
+        return zlib.decompress(json_val).decode('utf-8')
+    return json_val
+
+
+class MetadataDB:
+    """ Schema version agnostic lookups in the metadata DB.
+    """
+
+    def __init__(self, db_fp):
+        self.conn = sqlite3.connect(db_fp)
+        self.cur = self.conn.cursor()
+        self.schema_version = schema_version(self.cur)
+
+    def close(self):
+        self.conn.close()
+
+    def get_json(self, aid, ppr_year, ppr_month):
+        """ Metadata JSON of a paper as str, or None if there is none.
+        """
+
+        if self.schema_version == SCHEMA_V2:
+            self.cur.execute(
+                'select json from paper where aid=?',
+                (aid,)
+            )
+        else:
+            self.cur.execute(
+                'select json from paper where year=? and month=? and aid=?',
+                (ppr_year, ppr_month, aid)
+            )
+        metadata_tup = self.cur.fetchone()
+        if metadata_tup is None:
+            return None
+        return decompress_json(metadata_tup[0])
+
+    def get_title(self, aid, ppr_year, ppr_month):
+        """ Title of a paper, or None if there is none.
+        """
+
+        if self.schema_version == SCHEMA_V2:
+            self.cur.execute(
+                'select title from paper where aid=?',
+                (aid,)
+            )
+        else:
+            self.cur.execute(
+                'select title from paper where year=? and month=? and aid=?',
+                (ppr_year, ppr_month, aid)
+            )
+        title_tup = self.cur.fetchone()
+        if title_tup is None:
+            return None
+        return title_tup[0]
+
+    def get_month_jsons(self, ppr_year, ppr_month):
+        """ Metadata of all papers of a month as a dict mapping aids to
+            their stored (i.e. possibly compressed) JSON. Use
+            decompress_json() to get the JSON str.
+        """
+
+        self.cur.execute(
+            'select aid, json from paper where year=? and month=?',
+            (ppr_year, ppr_month)
+        )
+        return dict(self.cur.fetchall())
@@ -0,0 +1,185 @@
+""" Replace the random UUIDs of formulas, figures and tables in parsed
+    JSONL files (ref_entries keys, {{formula:...}} style markers and the
+    offsets of ref_spans/cite_spans after them) by the short, reproducible
+    IDs parse_latex_tralics.py assigns now (see REF_ENTRY_IDS there).
+    Bib entries whose raw text contains such markers get the new hash key
+    the parser would give them (and their {{cite:...}} markers and link
+    offsets are updated).
+
+    IDs are numbered in the order of the ref_entries, which is the order
+    in which they are assigned while parsing, so a migrated paper equals a
+    fresh parse. Papers without UUID keys are left as they are. Works on
+    the output of parsing and of all later steps (matched references,
+    grouped sections).
+"""
+
+import json
+import os
+import re
+import sys
+from hashlib import sha1
+from jsonl_io import JsonlWriter
+from parse_latex_tralics import _ref_entry_ids
+from tqdm import tqdm
+
+UUID_PATT = re.compile(
+    r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$'
+)
+# (same as in parse_latex_tralics._get_local_refs())
+MARKER_PATT = re.compile(
+    r'\{\{(cite|formula|figure|table|float):([0-9a-z-]+)\}\}'
+)
+
+
+def _replace_markers(text, id_map):
+    """ Returns the text with the markers of the IDs (ref_entries or
+        bib_entries keys) in id_map replaced, and a function mapping offsets
+        in the old text to the new text (None stays None).
+    """
+
+    shifts = []  # (end of old marker, accumulated length difference)
+    parts = []
+    pos = 0
+    diff = 0
+    for m in MARKER_PATT.finditer(text):
+        new_id = id_map.get(m.group(2))
+        if new_id is None:
+            continue
+        marker = '{{{{{}:{}}}}}'.format(m.group(1), new_id)
+        parts.append(text[pos:m.start()])
+        parts.append(marker)
+        pos = m.end()
+        diff += len(marker) - len(m.group(0))
+        shifts.append((m.end(), diff))
+    if len(shifts) == 0:
+        return text, lambda offset: offset
+    parts.append(text[pos:])
+
+    def new_offset(offset):
+        if offset is None:
+            # (e.g. link text the parser couldn't locate)
+            return None
+        shift = 0
+        for old_end, diff in shifts:
+            if old_end > offset:
+                break
+            shift = diff
+        return offset + shift
+
+    return ''.join(parts), new_offset
+
+
+def _migrate_text_block(block, id_map):
+    """ Migrate a dict with 'text' and (optionally) 'cite_spans' and
+        'ref_spans', such as a body_text paragraph or a grouped section.
+    """
+
+    if not isinstance(block, dict) or \
+            not isinstance(block.get('text'), str):
+        return
+    block['text'], new_offset = _replace_markers(block['text'], id_map)
+    for spans_key in ['cite_spans', 'ref_spans']:
+        for span in block.get(spans_key) or []:
+            span['start'] = new_offset(span['start'])
+            span['end'] = new_offset(span['end'])
+            if span.get('ref_id') in id_map:
+                span['ref_id'] = id_map[span['ref_id']]
+            if isinstance(span.get('text'), str):
+                span['text'], _ = _replace_markers(span['text'], id_map)
+
+
+def migrate_paper(paper):
+    """ Migrate a paper dict in place. Returns True if it was changed.
+    """
+
+    ref_entries = paper.get('ref_entries') or {}
+    id_map = {}
+    ref_ids = _ref_entry_ids(paper['paper_id'])
+    for old_id in ref_entries:
+        if not UUID_PATT.match(old_id):
+            # already migrated (or of unknown form)
+            return False
+        id_map[old_id] = next(ref_ids)
+    if len(id_map) == 0:
+        return False
+    paper['ref_entries'] = {
+        id_map[old_id]: entry for old_id, entry in ref_entries.items()
+    }
+    # bib entries are keyed by a hash of their text, which can contain
+    # formula markers
+    bib_entries = {}
+    for old_key, bib_entry in (paper.get('bib_entries') or {}).items():
+        text = bib_entry.get('bib_entry_raw')
+        if isinstance(text, str):
+            new_text, new_offset = _replace_markers(text, id_map)
+            if new_text != text:
+                bib_entry['bib_entry_raw'] = new_text
+                for key in ['contained_arXiv_ids', 'contained_links']:
+                    for span in bib_entry.get(key) or []:
+                        span['start'] = new_offset(span['start'])
+                        span['end'] = new_offset(span['end'])
+                sha_hash = sha1()
+                for item in [new_text, str(paper['paper_id'])]:
+                    sha_hash.update(item.encode('utf-8'))
+                id_map[old_key] = sha_hash.hexdigest()
+        bib_entries[id_map.get(old_key, old_key)] = bib_entry
+    if 'bib_entries' in paper:
+        paper['bib_entries'] = bib_entries
+    abstract = paper.get('abstract')
+    for block in abstract if isinstance(abstract, list) else [abstract]:
+        _migrate_text_block(block, id_map)
+    for block in paper.get('body_text') or []:
+        _migrate_text_block(block, id_map)
+    for block in (paper.get('sections') or {}).values():
+        _migrate_text_block(block, id_map)
+    return True
+
+
+def migrate_file(in_fp, out_fp):
+    """ Migrate all papers of a JSONL file. Returns a tuple (number of
+        papers, number of changed papers).
+    """
+
+    num_papers = 0
+    num_changed = 0
+    with open(in_fp, encoding='utf-8') as f, JsonlWriter(out_fp) as writer:
+        for line in f:
+            num_papers += 1
+            paper = json.loads(line)
+            if migrate_paper(paper):
+                num_changed += 1
+                writer.write(paper)
+            else:
+                writer.write_line(line.rstrip('\n'))
+    return num_papers, num_changed
+
+
+def migrate(in_path, out_dir):
+    if os.path.isdir(in_path):
+        in_fps = [
+            os.path.join(in_path, fn) for fn in sorted(os.listdir(in_path))
+            if fn.endswith('.jsonl')
+        ]
+    else:
+        in_fps = [in_path]
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    for in_fp in tqdm(in_fps, unit='files'):
+        out_fp = os.path.join(out_dir, os.path.basename(in_fp))
+        if os.path.abspath(out_fp) == os.path.abspath(in_fp):
+            print('not overwriting input file {}'.format(in_fp))
+            continue
+        num_papers, num_changed = migrate_file(in_fp, out_fp)
+        print('{}: {} papers, {} migrated'.format(
+            os.path.basename(in_fp), num_papers, num_changed
+        ))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print((
+            'Usage: python3 migrate_ref_ids.py <jsonl_file_or_dir> '
+            '<out_dir>'
+        ))
+        sys.exit()
+    migrate(sys.argv[1], sys.argv[2])
@@ -0,0 +1,147 @@
+""" Normalization of titles and author names for matching.
+
+    Strings are reduced to lower case ASCII words separated by single
+    spaces. ASCII input takes a fast path through a precompiled translation
+    table, and input that is ASCII apart from punctuation (e.g. typographic
+    quotes) skips NFD normalization and unidecode. Results are memoized,
+    because the same titles and reference strings are normalized many
+    times during matching.
+
+    Run this module on a JSONL file of parsed papers to benchmark it on
+    their bib_entry_raw strings.
+"""
+
+import json
+import re
+import sys
+import time
+import unicodedata
+from functools import lru_cache
+import unidecode
+
+NON_WORD_PATT = re.compile(r'[^\w]')
+WHITESPACE_PATT = re.compile(r'\s+')
+# ASCII non-word characters -> space
+ASCII_NON_WORD_TABLE = str.maketrans({
+    chr(i): ' ' for i in range(128) if NON_WORD_PATT.match(chr(i))
+})
+NORMALIZE_CACHE_SIZE = 1 << 16
+TOKENS_CACHE_SIZE = 1 << 12
+
+
+def _normalize_unicode(string):
+    string_norm = NON_WORD_PATT.sub(' ', string)
+    if string_norm.isascii():
+        # non-ASCII punctuation only (e.g. typographic quotes)
+        return ' '.join(string_norm.split()).lower()
+    string_norm = WHITESPACE_PATT.sub(' ', string_norm)
+    string_norm = unicodedata.normalize('NFD', string_norm)
+    string_norm = unidecode.unidecode(string_norm)
+    return string_norm.strip().lower()
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def _normalize(string):
+    if string.isascii():
+        # NFD and unidecode don't change ASCII
+        return ' '.join(string.translate(ASCII_NON_WORD_TABLE).split()).lower()
+    return _normalize_unicode(string)
+
+
+def _normalize_plain(string):
+    """ Unoptimized pipeline, for comparison in the benchmark.
+    """
+
+    string_norm = re.sub(r'[^\w]', ' ', string)
+    string_norm = re.sub(r'\s+', ' ', string_norm)
+    string_norm = unicodedata.normalize('NFD', string_norm)
+    string_norm = unidecode.unidecode(string_norm)
+    return string_norm.strip().lower()
+
+
+def normalize_title(title_string):
+    return _normalize(title_string)
+
+
+def normalize_author_name(author_string):
+    return _normalize(author_string)
+
+
+@lru_cache(maxsize=TOKENS_CACHE_SIZE)
+def ref_string_tokens(ref_string):
+    """ Frozen set of the tokens of a normalized reference string, shared
+        by all candidates the reference string is checked against.
+    """
+
+    return frozenset(normalize_author_name(ref_string).split(' '))
+
+
+def _benchmark(jsonl_fp, max_ref_strings=100000, num_authors=20):
+    """ Compare the plain normalization pipeline with this module on the
+        bib_entry_raw strings of a JSONL file, simulating author checks
+        against num_authors candidate authors per reference string.
+    """
+
+    ref_strings = []
+    with open(jsonl_fp, encoding='utf-8') as f:
+        for line in f:
+            for bib_entry in json.loads(line).get('bib_entries', {}).values():
+                ref_strings.append(bib_entry['bib_entry_raw'])
+            if len(ref_strings) >= max_ref_strings:
+                break
+    ref_strings = ref_strings[:max_ref_strings]
+    authors = ['author{}'.format(i) for i in range(num_authors)]
+    print('{} reference strings, {:.1f}% ASCII'.format(
+        len(ref_strings),
+        100 * sum(s.isascii() for s in ref_strings) / max(len(ref_strings), 1)
+    ))
+
+    mismatches = sum(
+        _normalize(s) != _normalize_plain(s) for s in ref_strings
+    )
+    print('output differences to the plain pipeline: {}'.format(mismatches))
+    _normalize.cache_clear()
+
+    start = time.perf_counter()
+    for ref_string in ref_strings:
+        for author in authors:
+            author in _normalize_plain(ref_string).split(' ')
+    plain_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for ref_string in ref_strings:
+        for author in authors:
+            author in ref_string_tokens(ref_string)
+    fast_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for ref_string in ref_strings:
+        _normalize_plain(ref_string)
+    plain_single_seconds = time.perf_counter() - start
+    _normalize.cache_clear()
+    start = time.perf_counter()
+    for ref_string in ref_strings:
+        _normalize(ref_string)
+    fast_single_seconds = time.perf_counter() - start
+
+    print('normalize once per string:       plain {:.3f}s, fast {:.3f}s '
+          '({:.1f}x)'.format(
+              plain_single_seconds, fast_single_seconds,
+              plain_single_seconds / max(fast_single_seconds, 1e-9)
+          ))
+    print('author checks ({} per string): plain {:.3f}s, fast {:.3f}s '
+          '({:.1f}x)'.format(
+              num_authors, plain_seconds, fast_seconds,
+              plain_seconds / max(fast_seconds, 1e-9)
+          ))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [2, 3]:
+        print((
+            'Usage: python3 normalization.py <parsed_papers.jsonl> '
+            '[<max_ref_strings>]'
+        ))
+        sys.exit()
+    max_ref_strings = int(sys.argv[2]) if len(sys.argv) == 3 else 100000
+    _benchmark(sys.argv[1], max_ref_strings)
@@ -10,15 +10,17 @@
 
 import chardet
 import gzip
+import io
 import magic
 import os
 import re
-import shutil
 import subprocess
 import sys
 import tarfile
 import tempfile
+from collections import deque
 from hashlib import sha1
+from multiprocessing import Pool
 
 
 MAIN_TEX_PATT = re.compile(r'(\\begin\s*\{\s*document\s*\})', re.I)
@@ -79,7 +81,12 @@ def read_file(path):
 
 
 def read_gzipped_file(path):
-    blob = gzip.open(path, 'rb').read()
+    with open(path, 'rb') as f:
+        return read_gzipped_blob(f.read())
+
+
+def read_gzipped_blob(gz_blob):
+    blob = gzip.decompress(gz_blob)
     m = magic.Magic(mime_encoding=True)
     encoding = m.from_buffer(blob)
     try:
@@ -99,144 +106,239 @@ def remove_math(latex_str):
     return ''.join(parts)
 
 
-def _source_file_hash(fp):
+def _source_blob_hash(blob):
     source_file_hasher = sha1()
-    with open(fp, 'rb') as source_file:
-        buf = source_file.read()
-        source_file_hasher.update(buf)
-        source_file_hash = str(source_file_hasher.hexdigest())
-    return source_file_hash
+    source_file_hasher.update(blob)
+    return str(source_file_hasher.hexdigest())
 
 
-def normalize(in_dir, out_dir, write_logs=True):
-    def log(msg):
-        if write_logs:
-            with open(os.path.join(out_dir, 'log.txt'), 'a') as f:
-                f.write('{}\n'.format(msg))
+def _log(out_dir, write_logs, msg):
+    if write_logs:
+        with open(os.path.join(out_dir, 'log.txt'), 'a') as f:
+            f.write('{}\n'.format(msg))
 
-    if not os.path.isdir(in_dir):
-        print('dump directory does not exist')
-        return False
 
-    if not os.path.isdir(out_dir):
-        os.makedirs(out_dir)
+def _normalize_file(in_dir, out_dir, fn, write_logs=True):
+    """ Normalize a single file of the dump directory.
 
-    source_file_info = dict()
+        Returns a tuple (aid_fn_safe, source file info).
+    """
 
-    for fn in os.listdir(in_dir):
-        path = os.path.join(in_dir, fn)
-        aid_fn_safe, ext = os.path.splitext(fn)
-        source_file_info[aid_fn_safe] = {
-            'name': fn,
-            'hash': _source_file_hash(path)
-        }
-        if PDF_EXT_PATT.match(ext):
-            # copy over pdf file as is
-            dest = os.path.join(out_dir, fn)
-            shutil.copyfile(path, dest)
-        elif GZ_EXT_PATT.match(ext):
-            if tarfile.is_tarfile(path):
-                with tempfile.TemporaryDirectory() as tmp_dir_path:
-                    # extract archive contents
-                    tar = tarfile.open(path)
-                    fnames = tar.getnames()
-                    tar.extractall(path=tmp_dir_path)
-                    # identify main tex file
-                    main_tex_path = None
-                    ignored_names = []
-                    # check .tex files first
-                    for tfn in fnames:
-                        if not TEX_EXT_PATT.match(os.path.splitext(tfn)[1]):
-                            ignored_names.append(tfn)
-                            continue
+    with open(os.path.join(in_dir, fn), 'rb') as f:
+        blob = f.read()
+    return normalize_source(fn, blob, out_dir, write_logs=write_logs)
+
+
+def normalize_source(fn, blob, out_dir, write_logs=True):
+    """ Normalize a single source file of the dump given as bytes (e.g.
+        read directly from the TAR archive of a dump).
+
+        Returns a tuple (aid_fn_safe, source file info).
+    """
+
+    def log(msg):
+        _log(out_dir, write_logs, msg)
+
+    aid_fn_safe, ext = os.path.splitext(fn)
+    source_file_info = {
+        'name': fn,
+        'hash': _source_blob_hash(blob)
+    }
+    if PDF_EXT_PATT.match(ext):
+        # copy over pdf file as is
+        dest = os.path.join(out_dir, fn)
+        with open(dest, 'wb') as f:
+            f.write(blob)
+    elif GZ_EXT_PATT.match(ext):
+        if tarfile.is_tarfile(io.BytesIO(blob)):
+            with tempfile.TemporaryDirectory() as tmp_dir_path:
+                # extract archive contents (except for images and PDFs,
+                # which neither latexpand nor Tralics need)
+                tar = tarfile.open(fileobj=io.BytesIO(blob))
+                members = tar.getmembers()
+                fnames = [member.name for member in members]
+                tar.extractall(
+                    path=tmp_dir_path,
+                    members=[
+                        member for member in members
+                        if not NON_TEXT_PATT.match(
+                            os.path.splitext(member.name)[1]
+                        )
+                    ]
+                )
+                # identify main tex file
+                main_tex_path = None
+                ignored_names = []
+                # check .tex files first
+                for tfn in fnames:
+                    if not TEX_EXT_PATT.match(os.path.splitext(tfn)[1]):
+                        ignored_names.append(tfn)
+                        continue
+                    tmp_file_path = os.path.join(tmp_dir_path, tfn)
+                    if os.path.isdir(tmp_file_path):
+                        continue
+                    try:
+                        cntnt = read_file(tmp_file_path)
+                    except:
+                        continue
+                    if re.search(MAIN_TEX_PATT, cntnt) is not None:
+                        main_tex_path = tmp_file_path
+                # try other files
+                if main_tex_path is None:
+                    for tfn in ignored_names:
                         tmp_file_path = os.path.join(tmp_dir_path, tfn)
-                        if os.path.isdir(tmp_file_path):
+                        if NON_TEXT_PATT.match(os.path.splitext(tfn)[1]):
                             continue
                         try:
                             cntnt = read_file(tmp_file_path)
+                            if re.search(MAIN_TEX_PATT, cntnt) is not None:
+                                main_tex_path = tmp_file_path
                         except:
                             continue
-                        if re.search(MAIN_TEX_PATT, cntnt) is not None:
-                            main_tex_path = tmp_file_path
-                    # try other files
-                    if main_tex_path is None:
-                        for tfn in ignored_names:
-                            tmp_file_path = os.path.join(tmp_dir_path, tfn)
-                            if NON_TEXT_PATT.match(os.path.splitext(tfn)[1]):
-                                continue
-                            try:
-                                cntnt = read_file(tmp_file_path)
-                                if re.search(MAIN_TEX_PATT, cntnt) is not None:
-                                    main_tex_path = tmp_file_path
-                            except:
-                                continue
-                    # give up
-                    if main_tex_path is None:
-                        log(('couldn\'t find main tex file in dump archive {}'
-                             '').format(fn))
-                        continue
-                    # "identify" bbl file
-                    # https://arxiv.org/help/submit_tex#bibtex
-                    main_tex_fn = os.path.normpath(
-                        main_tex_path).split(os.sep)[-1]
-                    fn_base = os.path.splitext(main_tex_path)[0]
-                    bbl_fn = '{}.bbl'.format(fn_base)
-                    if os.path.isfile(os.path.join(tmp_dir_path, bbl_fn)):
-                        latexpand_args = ['latexpand',
-                                          '--expand-bbl',
-                                          bbl_fn,
-                                          main_tex_fn]
-                    else:
-                        latexpand_args = ['latexpand',
-                                          main_tex_fn]
-                    # flatten to single tex file and save
-                    new_tex_fn = '{}.tex'.format(aid_fn_safe)
-                    tmp_dest = os.path.join(tmp_dir_path, new_tex_fn)
-                    out = open(tmp_dest, mode='w')
-                    if write_logs:
-                        err = open(
-                            os.path.join(out_dir, 'log_latexpand.txt'), 'a'
-                            )
-                    else:
-                        err = open(os.devnull, 'w')
-                    err.write('\n------------- {} -------------\n'.format(aid_fn_safe))
-                    err.flush()
-                    subprocess.run(latexpand_args, stdout=out, stderr=err,
-                                   cwd=tmp_dir_path)
-                    out.close()
-                    err.close()
-                    # re-read and write to ensure utf-8 b/c latexpand doesn't
-                    # behave
-                    cntnt = read_file(tmp_dest)
-                    if PRE_FIX_NATBIB:
-                        cntnt = NATBIB_PATT.sub(r'\\cite{\3}', cntnt)
-                    if PRE_FIX_BIBOPT:
-                        cntnt = BIBOPT_PATT.sub(r'\\bibitem', cntnt)
-                    if PRE_FILTER_MATH:
-                        cntnt = remove_math(cntnt)
-                    dest = os.path.join(out_dir, new_tex_fn)
-                    with open(dest, mode='w', encoding='utf-8') as f:
-                        f.write(cntnt)
-            else:
-                # extraxt gzipped tex file
-                cntnt = read_gzipped_file(path)
-                if not cntnt:
-                    continue
-                if re.search(MAIN_TEX_PATT, cntnt) is None:
-                    log('unexpected content in dump archive {}'.format(fn))
-                    continue
-                new_fn = '{}.tex'.format(aid_fn_safe)
+                # give up
+                if main_tex_path is None:
+                    log(('couldn\'t find main tex file in dump archive {}'
+                         '').format(fn))
+                    return aid_fn_safe, source_file_info
+                # "identify" bbl file
+                # https://arxiv.org/help/submit_tex#bibtex
+                main_tex_fn = os.path.normpath(
+                    main_tex_path).split(os.sep)[-1]
+                fn_base = os.path.splitext(main_tex_path)[0]
+                bbl_fn = '{}.bbl'.format(fn_base)
+                if os.path.isfile(os.path.join(tmp_dir_path, bbl_fn)):
+                    latexpand_args = ['latexpand',
+                                      '--expand-bbl',
+                                      bbl_fn,
+                                      main_tex_fn]
+                else:
+                    latexpand_args = ['latexpand',
+                                      main_tex_fn]
+                # flatten to single tex file and save
+                new_tex_fn = '{}.tex'.format(aid_fn_safe)
+                tmp_dest = os.path.join(tmp_dir_path, new_tex_fn)
+                out = open(tmp_dest, mode='w')
+                if write_logs:
+                    err = open(
+                        os.path.join(out_dir, 'log_latexpand.txt'), 'a'
+                        )
+                else:
+                    err = open(os.devnull, 'w')
+                err.write('\n------------- {} -------------\n'.format(aid_fn_safe))
+                err.flush()
+                subprocess.run(latexpand_args, stdout=out, stderr=err,
+                               cwd=tmp_dir_path)
+                out.close()
+                err.close()
+                # re-read and write to ensure utf-8 b/c latexpand doesn't
+                # behave
+                cntnt = read_file(tmp_dest)
                 if PRE_FIX_NATBIB:
                     cntnt = NATBIB_PATT.sub(r'\\cite{\3}', cntnt)
                 if PRE_FIX_BIBOPT:
-                    cntnt = BIBOPT_PATT.sub('\\bibitem', cntnt)
+                    cntnt = BIBOPT_PATT.sub(r'\\bibitem', cntnt)
                 if PRE_FILTER_MATH:
                     cntnt = remove_math(cntnt)
-                dest = os.path.join(out_dir, new_fn)
+                dest = os.path.join(out_dir, new_tex_fn)
                 with open(dest, mode='w', encoding='utf-8') as f:
                     f.write(cntnt)
         else:
-            log('unexpected file {} in dump directory'.format(fn))
+            # extraxt gzipped tex file
+            cntnt = read_gzipped_blob(blob)
+            if not cntnt:
+                return aid_fn_safe, source_file_info
+            if re.search(MAIN_TEX_PATT, cntnt) is None:
+                log('unexpected content in dump archive {}'.format(fn))
+                return aid_fn_safe, source_file_info
+            new_fn = '{}.tex'.format(aid_fn_safe)
+            if PRE_FIX_NATBIB:
+                cntnt = NATBIB_PATT.sub(r'\\cite{\3}', cntnt)
+            if PRE_FIX_BIBOPT:
+                cntnt = BIBOPT_PATT.sub('\\bibitem', cntnt)
+            if PRE_FILTER_MATH:
+                cntnt = remove_math(cntnt)
+            dest = os.path.join(out_dir, new_fn)
+            with open(dest, mode='w', encoding='utf-8') as f:
+                f.write(cntnt)
+    else:
+        log('unexpected file {} in dump directory'.format(fn))
+
+    return aid_fn_safe, source_file_info
+
+
+def _normalize_file_worker(args):
+    return _normalize_file(*args)
+
+
+def normalize(in_dir, out_dir, write_logs=True, num_workers=1):
+    """ Normalize all files in in_dir into out_dir. With num_workers > 1
+        the files are distributed across a process pool.
+    """
+
+    if not os.path.isdir(in_dir):
+        print('dump directory does not exist')
+        return False
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    source_file_info = dict()
+
+    tasks = [(in_dir, out_dir, fn, write_logs) for fn in os.listdir(in_dir)]
+    if num_workers > 1:
+        with Pool(num_workers) as pool:
+            for aid_fn_safe, info in pool.imap_unordered(
+                    _normalize_file_worker, tasks, chunksize=4
+            ):
+                source_file_info[aid_fn_safe] = info
+    else:
+        for task in tasks:
+            aid_fn_safe, info = _normalize_file(*task)
+            source_file_info[aid_fn_safe] = info
+
+    return source_file_info
+
+
+def _normalize_source_worker(args):
+    return normalize_source(*args)
+
+
+def _bounded_imap(pool, func, iterable, max_pending):
+    """ Like pool.imap, but consumes the input iterable lazily so that at
+        most max_pending tasks (and their arguments) are held in memory.
+    """
+
+    pending = deque()
+    for args in iterable:
+        pending.append(pool.apply_async(func, (args,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def normalize_stream(sources, out_dir, write_logs=True, num_workers=1):
+    """ Normalize source files given as an iterable of (file name, bytes)
+        tuples into out_dir. With num_workers > 1 the files are distributed
+        across a process pool.
+    """
+
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    source_file_info = dict()
+
+    tasks = ((fn, blob, out_dir, write_logs) for fn, blob in sources)
+    if num_workers > 1:
+        with Pool(num_workers) as pool:
+            for aid_fn_safe, info in _bounded_imap(
+                    pool, _normalize_source_worker, tasks, num_workers * 4
+            ):
+                source_file_info[aid_fn_safe] = info
+    else:
+        for task in tasks:
+            aid_fn_safe, info = normalize_source(*task)
+            source_file_info[aid_fn_safe] = info
 
     return source_file_info
 
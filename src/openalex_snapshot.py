@@ -0,0 +1,181 @@
+""" Offline lookup of cited_by_count and language in a compact SQLite
+    snapshot built from the OpenAlex works dump
+        https://docs.openalex.org/download-all-data/openalex-snapshot
+
+    The snapshot has a single table work(doi, title_norm, title_clean,
+    cited_by_count, language) with indices on doi and title_norm.
+"""
+
+import gzip
+import json
+import os
+import sqlite3
+import sys
+from multiprocessing import Pool
+from enrich_metadata import normalize_doi, clean_title
+from normalization import normalize_title
+from tqdm import tqdm
+
+# SQLite page cache used while building a snapshot
+BUILD_CACHE_SIZE_KIB = 1024 * 1024
+
+
+def _work_rows(dump_fp):
+    """ Snapshot rows for the works in one gzipped JSONL part file of the
+        OpenAlex dump.
+    """
+
+    rows = []
+    with gzip.open(dump_fp, 'rt', encoding='utf-8') as f:
+        for line in f:
+            try:
+                work = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            doi = work.get('doi')
+            title = work.get('title') or work.get('display_name')
+            if not doi and not title:
+                continue
+            rows.append((
+                normalize_doi(doi) if doi else None,
+                normalize_title(title) if title else None,
+                clean_title(title),
+                work.get('cited_by_count'),
+                work.get('language')
+            ))
+    return rows
+
+
+def build_snapshot(dump_dir, out_fp, num_workers=None):
+    """ Build a snapshot DB from all *.gz part files below dump_dir.
+    """
+
+    dump_fps = sorted(
+        os.path.join(root, fn)
+        for root, _, fns in os.walk(dump_dir)
+        for fn in fns if fn.endswith('.gz')
+    )
+    if os.path.exists(out_fp):
+        print(f"Skipping {out_fp}, snapshot already exists.")
+        return
+    conn = sqlite3.connect(out_fp)
+    db_cur = conn.cursor()
+    db_cur.execute('pragma journal_mode = OFF')
+    db_cur.execute('pragma synchronous = OFF')
+    db_cur.execute('pragma cache_size = {}'.format(-BUILD_CACHE_SIZE_KIB))
+    db_cur.execute("""
+        create table work(
+            'doi' text,
+            'title_norm' text,
+            'title_clean' text,
+            'cited_by_count' integer,
+            'language' text
+        )
+    """)
+    print('filling table')
+    with Pool(num_workers or os.cpu_count()) as pool:
+        for rows in tqdm(
+                pool.imap_unordered(_work_rows, dump_fps),
+                total=len(dump_fps)
+        ):
+            db_cur.executemany(
+                (
+                    "insert into work "
+                    "('doi','title_norm','title_clean','cited_by_count',"
+                    "'language') values(?,?,?,?,?)"
+                ),
+                rows
+            )
+    print('generating index')
+    db_cur.execute("create index doi on work('doi')")
+    db_cur.execute("create index title_norm on work('title_norm')")
+    conn.commit()
+    conn.close()
+
+
+class SnapshotEnricher:
+    """ Drop-in replacement for enrich_metadata.AsyncEnricher that looks up
+        papers in a local snapshot instead of the OpenAlex API.
+
+        As with the API, a DOI match only counts if the titles agree, and
+        papers fall back to a title lookup. Of several works with the same
+        title, the most cited one is used.
+    """
+
+    def __init__(self, snapshot_fp):
+        self.snapshot_fp = snapshot_fp
+        self.conn = None
+        self.cur = None
+
+    def open(self):
+        self.conn = sqlite3.connect(
+            'file:{}?mode=ro'.format(self.snapshot_fp), uri=True
+        )
+        self.cur = self.conn.cursor()
+        return self
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+            self.cur = None
+
+    async def __aenter__(self):
+        return self.open()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def lookup(self, doi, title):
+        """ (cited_by_count, language) of a paper, (None, None) if not
+            found.
+        """
+
+        if not doi and not title:
+            return None, None
+        target_title = clean_title(title)
+        if doi:
+            self.cur.execute(
+                (
+                    'select cited_by_count, language from work '
+                    'where doi=? and title_clean=? '
+                    'order by cited_by_count desc limit 1'
+                ),
+                (normalize_doi(doi), target_title)
+            )
+            match = self.cur.fetchone()
+            if match is not None:
+                return match
+        if title:
+            self.cur.execute(
+                (
+                    'select cited_by_count, language from work '
+                    'where title_norm=? and title_clean=? '
+                    'order by cited_by_count desc limit 1'
+                ),
+                (normalize_title(title), target_title)
+            )
+            match = self.cur.fetchone()
+            if match is not None:
+                return match
+        return None, None
+
+    async def lookup_many(self, items):
+        """ Look up a list of (doi, title) tuples.
+
+            Returns a list of (cited_by_count, language) tuples in the
+            order of items.
+        """
+
+        return [self.lookup(doi, title) for doi, title in items]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [3, 4]:
+        print((
+            'Usage: python3 openalex_snapshot.py <openalex_works_dump_dir> '
+            '<snapshot.sqlite> [<num_workers>]'
+        ))
+        sys.exit()
+    num_workers = int(sys.argv[3]) if len(sys.argv) == 4 else None
+    build_snapshot(sys.argv[1], sys.argv[2], num_workers)
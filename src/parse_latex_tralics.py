@@ -1,19 +1,23 @@
 """ Convert LaTeX files to S2ORC like JSONL output
 """
 
+import io
 import json
 import os
 import re
-import sqlite3
-import subprocess
 import sys
-import tempfile
 import uuid
+from itertools import count
 # import IPython
-from collections import OrderedDict, defaultdict
+from collections import Counter, OrderedDict, defaultdict
 from hashlib import sha1
+from jsonl_io import JsonlWriter
 from lxml import etree
+from meta_db import MetadataDB, decompress_json
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
 from tqdm import tqdm
+from tralics_pool import TralicsPool
 #from SPARQLWrapper import SPARQLWrapper, JSON
 
 PDF_EXT_PATT = re.compile(r'^\.pdf$', re.I)
@@ -23,6 +27,18 @@ ARXIV_URL_PATT = re.compile(
     re.I
 )
 ARXIV_ID_PATT = re.compile(r'^([a-zA-Z-\.]+)?\/?(\d\d)(\d\d)(.*)$')
+PAPER_ID_LINE_PATT = re.compile(r'^\{"paper_id": "([^"\\]*)"')
+# papers a parse() worker process handles before it is replaced
+PARSE_TASKS_PER_CHILD = 500
+# classify the elements of a paper's XML tree in one traversal instead of
+# one XPath query per processing step (same output)
+SINGLE_PASS_TREE_WALK = True
+# IDs of formulas, figures and tables (ref_entries keys and {{formula:...}}
+# style markers): 'short' for '<first 8 hex digits of SHA-1 of the paper
+# ID>-<n>' numbered in order of processing (reproducible across parses),
+# 'uuid' for random UUIDs as in earlier versions of the data set
+REF_ENTRY_IDS = 'short'
+REF_ENTRY_ID_HASH_LENGTH = 8
 
 
 def _write_debug_xml(tree):
@@ -242,32 +258,684 @@ def _filename_to_aid(fn, details=False):
     return aid
 
 
-def _get_paper_metadata(meta_db_cur, aid, ppr_year, ppr_month):
-    """ Retrieve metadata from the given DB cursor.
-    """
-
-    meta_db_cur.execute(
-        '''
-        select json from paper where year=? and month=? and aid=?
-        ''',
-        (ppr_year, ppr_month, aid)
-    )
-    metadata_tup = meta_db_cur.fetchone()
+def _decode_metadata(metadata_json):
     try:
-        metadata = json.loads(metadata_tup[0])
-    except (TypeError, IndexError) as e:
+        metadata = json.loads(metadata_json)
+    except TypeError as e:
         return {}
     return metadata
 
 
-def parse(
-        in_dir, out_dir, tar_fn, source_file_info, meta_db_fp, incremental,
-        write_logs=False
-):
+class _MonthMetadata:
+    """ Metadata of all papers of one month, retrieved with a single query
+        and kept undecoded. Papers of other months are looked up
+        individually.
+    """
+
+    def __init__(self, meta_db, ppr_year, ppr_month):
+        self.meta_db = meta_db
+        self.ppr_year = ppr_year
+        self.ppr_month = ppr_month
+        self._metadata_jsons = meta_db.get_month_jsons(ppr_year, ppr_month)
+
+    def pop_json(self, aid, ppr_year, ppr_month):
+        """ Return (and forget) the metadata JSON of a paper, or None if
+            there is none.
+        """
+
+        if ppr_year == self.ppr_year and ppr_month == self.ppr_month:
+            metadata_json = self._metadata_jsons.pop(aid, None)
+            if metadata_json is None:
+                return None
+            return decompress_json(metadata_json)
+        return self.meta_db.get_json(aid, ppr_year, ppr_month)
+
+
+def _logger(out_dir, write_logs):
     def log(msg):
         if write_logs:
             with open(os.path.join(out_dir, 'log.txt'), 'a') as f:
                 f.write('{}\n'.format(msg))
+    return log
+
+
+def _ref_entry_ids(aid):
+    """ Iterator over the IDs of the ref_entries of a paper (see
+        REF_ENTRY_IDS).
+    """
+
+    if REF_ENTRY_IDS == 'uuid':
+        while True:
+            yield str(uuid.uuid4())
+    prefix = sha1(str(aid).encode('utf-8')).hexdigest()[
+        :REF_ENTRY_ID_HASH_LENGTH
+    ]
+    for n in count():
+        yield '{}-{}'.format(prefix, n)
+
+
+def _process_float_node(xtag, paper_dict, ref_ids):
+    """ Replace a figure, table or float element by a marker in its tail
+        and add its caption to the ref_entries of the paper dict. Its ID is
+        taken from the iterator ref_ids.
+    """
+
+    if xtag.tag in ['figure', 'table']:
+        treat_as_type = xtag.tag
+    else:
+        assert xtag.tag == 'float'
+        if xtag.get('type') in ['figure', 'table']:
+            treat_as_type = xtag.get('type')
+        else:
+            return
+
+    caption_text = ''
+    try:
+        # (the last non-empty one, skipping e.g. table cells in lxml)
+        for element in xtag.iter('head', 'caption'):
+            elem_text = etree.tostring(
+                element,
+                encoding='unicode',
+                method='text',
+                with_tail=False
+            )
+            if len(elem_text) > 0:
+                caption_text = elem_text
+    except TypeError:
+        # can get a "NoneType cannot be serialized" in rare
+        # cases
+        return
+    if len(caption_text) < 1:
+        caption_text = 'NO_CAPTION'
+    # (only IDs of actual ref_entries are taken, so they are numbered
+    # consecutively)
+    elem_id = next(ref_ids)
+
+    xtag.tail = '{{{{{}:{}}}}}'.format(treat_as_type, elem_id)
+
+    if treat_as_type == 'figure':
+        paper_dict['ref_entries'][elem_id] = {
+            'caption': ''.join(caption_text.splitlines()),
+            'type': 'figure'}
+
+    elif treat_as_type == 'table':
+        paper_dict['ref_entries'][elem_id] = {
+            'caption': ''.join(caption_text.splitlines()),
+            'type': 'table'}
+
+
+def _process_formula_node(ftag, paper_dict, ref_ids):
+    """ Put a marker for a formula element into its tail and add its LaTeX
+        content to the ref_entries of the paper dict. Its ID is taken from
+        the iterator ref_ids.
+    """
+
+    formula_id = next(ref_ids)
+    # Tralics puts texmath first
+    texmath = ftag[0] if len(ftag) > 0 else None
+    if texmath is None or texmath.tag != 'texmath':
+        texmath = ftag.find('texmath')
+    try:
+        if texmath is not None and len(texmath) == 0:
+            # plain LaTeX string (the usual case), no need to serialize
+            latex_content = texmath.text or ''
+        else:
+            latex_content = etree.tostring(
+                texmath,
+                encoding='unicode',
+                method='text',
+                with_tail=False
+            )
+    except TypeError:
+        # very rare case where Tralics creates an XML that uses
+        # Texmath tags instead of texmath
+        # kown for:
+        # - 1308.0481
+        # - 1901.06986
+        try:
+            latex_content = etree.tostring(
+                ftag.find('Texmath'),
+                encoding='unicode',
+                method='text',
+                with_tail=False
+            )
+        except:
+            latex_content = 'NO_LATEX_CONTENT'
+    if ftag.tail:
+        new_tail = ' {}'.format(ftag.tail)
+    else:
+        new_tail = ''
+    ftag.tail = '{{{{formula:{}}}}}{}'.format(
+        formula_id,
+        new_tail
+    )
+
+    paper_dict['ref_entries'][formula_id] = {
+        'latex': ''.join(latex_content.splitlines()),
+        'type': 'formula'}
+
+
+def _process_bibitem_node(bi, aid, paper_dict, bibkey_map):
+    """ Add the bib entry of a bibitem element (the text of its containing
+        paragraph) to the bib_entries of the paper dict.
+    """
+
+    containing_p = bi.getparent()
+    try:
+        while containing_p.tag != 'p':
+            # sometimes the bibitem element
+            # is not the direct child of
+            # the containing p item we want
+            containing_p = containing_p.getparent()
+    except AttributeError:
+        # getparent() might return None
+        return
+    for child in containing_p.getchildren():
+        if child.text:
+            child.text = '{}'.format(child.text)
+    text = etree.tostring(
+        containing_p,
+        encoding='unicode',
+        method='text'
+    )
+
+    text = re.sub(r'\s+', ' ', text).strip()
+    # NOTE: commented out lines below b/c it removes information
+    # # replace the uuid of formulas in reference string
+    # text = re.sub(r'(^{{formula:)(.*)', '', text)
+    sha_hash = sha1()
+    items = [text.encode('utf-8'), str(aid).encode('utf-8')]
+    for item in items:
+        sha_hash.update(item)
+    sha_hash_string = str(sha_hash.hexdigest())
+    local_key = bi.get('id')
+    bibkey_map[local_key] = sha_hash_string
+
+    paper_dict['bib_entries'][sha_hash_string] = {
+        'bib_entry_raw': text
+    }
+
+    contained_arXiv_ids_list = []
+    contained_links_list = []
+
+    for xref in containing_p.findall('xref'):
+        link = xref.get('url')
+        link_text_raw = etree.tostring(
+            xref,
+            encoding='unicode',
+            method='text'
+        )
+        # clean link plain text for matching with
+        # bib entry plain text
+        link_text = re.sub(
+            r'\s+',
+            ' ',
+            link_text_raw
+        ).strip()
+
+        aurl_match = ARXIV_URL_PATT.search(link)
+        if aurl_match:
+            id_part = aurl_match.group(1)
+            if len(link_text) != 0:
+                try:
+                    location_offset_start = text.index(link_text)
+                    location_offset_end = text.index(link_text) + \
+                        len(link_text)
+                except ValueError as e:
+                    # treat error if link text is not in
+                    # bib entry text
+                    location_offset_start = None
+                    location_offset_end = None
+
+            else:
+                # if there are links included in source file
+                # without corresponding visible text
+                link_text = None
+                location_offset_start = None
+                location_offset_end = None
+
+            arXiv_item_local_temp_dict = {
+                'id': id_part,
+                'text': link_text,
+                'start': location_offset_start,
+                'end': location_offset_end
+            }
+            contained_arXiv_ids_list.append(
+                arXiv_item_local_temp_dict
+            )
+
+        else:
+            if len(link_text) != 0:
+                try:
+                    location_offset_start = text.index(link_text)
+                    location_offset_end = text.index(link_text) + \
+                        len(link_text)
+                except ValueError as e:
+                    location_offset_start = None
+                    location_offset_end = None
+
+            else:
+                link_text = None
+                location_offset_start = None
+                location_offset_end = None
+
+            link_item_local_temp_dict = {
+                'url': link,
+                'text': link_text,
+                'start': location_offset_start,
+                'end': location_offset_end
+            }
+            contained_links_list.append(link_item_local_temp_dict)
+
+    paper_dict['bib_entries'][sha_hash_string][
+        'contained_arXiv_ids'
+    ] = contained_arXiv_ids_list
+    paper_dict['bib_entries'][sha_hash_string][
+        'contained_links'
+    ] = contained_links_list
+
+
+def _process_cit_node(cit, aid, bibkey_map, log):
+    """ Put a citation marker for a cit element into its tail.
+
+        Returns False if the cited bibliography key is unknown.
+    """
+
+    elem = cit.find('ref')
+    if elem is None:
+        log(('WARNING: cite element in {} contains no ref element'
+             '').format(aid))
+        return True
+    ref = elem.get('target')
+    replace_text = ''
+    found = True
+    if ref in bibkey_map:
+        marker = '{{{{cite:{}}}}}'.format(bibkey_map[ref])
+        replace_text += marker
+    else:
+        log(('WARNING: unmatched bibliography key {} for doc {}'
+             '').format(ref, aid))
+        found = False
+    if cit.tail:
+        cit.tail = replace_text + cit.tail
+    else:
+        cit.tail = replace_text
+    return found
+
+
+def _mark_non_citation_ref(rtag):
+    # FIXME: should resolve section refs here
+    if rtag.tail:
+        rtag.tail = '{} {}'.format('REF', rtag.tail)
+    else:
+        rtag.tail = ' {}'.format('REF')
+
+
+def _body_paragraphs(top_level_sections, content_nodes):
+    """ Paragraph dicts of the body text, taken from the given div0
+        elements or, if there are none, from the given content elements.
+    """
+
+    paragraphs = []
+    curr_sec = {
+        'head': '',
+        'num': '-1',
+        'type': ''
+    }
+    if len(top_level_sections) == 0:
+        # if there are no div0 tags, we give up on sections and just
+        # use paragraphs, lists, proofs, and listings and hope we
+        # cover all content with those
+        paragraphs = [
+            _process_content_node(p, curr_sec)
+            for p in content_nodes
+        ]
+    for sec in top_level_sections:
+        paragraphs.extend(
+            _process_section_node(sec, curr_sec)
+        )
+    return paragraphs
+
+
+# elements removed from the tree during _process_tree(), in the order of
+# the processing steps
+FLOAT_TAGS = ('figure', 'table', 'float')
+# formulas, and title and authors (works only in a few papers)
+INLINE_STRIP_TAGS = ('formula', 'title', 'author', 'date', 'thanks')
+BIBLIOGRAPHY_TAGS = ('Bibliography', 'bibitem', 'cit')
+BODY_CONTENT_TAGS = ('p', 'list', 'proof', 'listing')
+CLASSIFIED_TAGS = (
+    FLOAT_TAGS + INLINE_STRIP_TAGS + BIBLIOGRAPHY_TAGS + BODY_CONTENT_TAGS +
+    ('unexpected', 'ref', 'div0')
+)
+
+
+def _classify_nodes(tree):
+    """ Collect the elements _process_tree() rewrites in a single
+        traversal, each list in document order.
+
+        Elements are only collected where the separate XPath queries of
+        _process_tree_xpath() would still find them, i.e. not inside
+        elements stripped by an earlier processing step (the root element
+        is never stripped).
+    """
+
+    nodes = {
+        'floats': {tag: [] for tag in FLOAT_TAGS},
+        'formula': [],
+        'unexpected': [],
+        'ref': [],
+        'bibitem': [],
+        'cit': [],
+        'div0': [],
+        'content': []
+    }
+    floats = nodes['floats']
+    refs = nodes['ref']
+    formulas = nodes['formula']
+    inline_nodes = {
+        tag: nodes[tag] for tag in ['unexpected', 'bibitem', 'cit']
+    }
+    content_nodes = nodes['content']
+    div0s = nodes['div0']
+    float_tags = frozenset(FLOAT_TAGS)
+    inline_strip_tags = frozenset(INLINE_STRIP_TAGS)
+    bibliography_tags = frozenset(BIBLIOGRAPHY_TAGS)
+    body_content_tags = frozenset(BODY_CONTENT_TAGS)
+    # number of open ancestors stripped at each processing step
+    in_float = 0
+    in_inline = 0
+    in_bibliography = 0
+    root = tree.getroot()
+    # only elements with these tags are reported (filtered by lxml)
+    walk = etree.iterwalk(
+        root, events=('start', 'end'), tag=CLASSIFIED_TAGS
+    )
+    for event, elem in walk:
+        tag = elem.tag
+        if event == 'end':
+            if elem is root:
+                continue
+            if tag in float_tags:
+                in_float -= 1
+            elif tag in inline_strip_tags:
+                in_inline -= 1
+            elif tag in bibliography_tags:
+                in_bibliography -= 1
+            continue
+        if tag in float_tags:
+            floats[tag].append(elem)
+        elif tag == 'ref':
+            target = elem.get('target')
+            if target is not None and target.startswith('uid'):
+                refs.append(elem)
+        elif in_float != 0:
+            pass
+        elif tag == 'formula':
+            formulas.append(elem)
+        elif in_inline != 0:
+            pass
+        elif tag in inline_nodes:
+            inline_nodes[tag].append(elem)
+        elif in_bibliography != 0:
+            pass
+        elif tag == 'div0':
+            div0s.append(elem)
+        elif tag in body_content_tags:
+            content_nodes.append(elem)
+        if elem is root:
+            continue
+        if tag in float_tags:
+            in_float += 1
+        elif tag in inline_strip_tags:
+            in_inline += 1
+        elif tag in bibliography_tags:
+            in_bibliography += 1
+    return nodes
+
+
+def _process_tree(tree, aid, paper_dict, log):
+    """ Fill ref_entries, bib_entries and body_text of the given paper dict
+        from a Tralics XML tree.
+
+        Returns a tuple (number of citations, number of unmatched citations).
+    """
+
+    if not SINGLE_PASS_TREE_WALK:
+        return _process_tree_xpath(tree, aid, paper_dict, log)
+
+    num_citations = 0
+    num_citations_notfound = 0
+
+    # tags things that could be treated specially
+    # - <Metadata>
+    #     - <title>
+    #     - <authors><author>
+    # - <head>
+    # - <proof>
+    # - <abstract>
+    # - <maketitle>
+    # - <list> (might be used for larger chunks of text like
+    #           related work)
+    #
+    # tags *NOT* to touch
+    # - <unknown>: can surround whole content
+
+    nodes = _classify_nodes(tree)
+
+    # figures and tables
+    paper_dict['ref_entries'] = {}
+    ref_ids = _ref_entry_ids(aid)
+    for tag in FLOAT_TAGS:
+        for xtag in nodes['floats'][tag]:
+            _process_float_node(xtag, paper_dict, ref_ids)
+
+    # math notation
+    for ftag in nodes['formula']:
+        _process_formula_node(ftag, paper_dict, ref_ids)
+
+    # remove all figure/table/float and formula tags, as well as title
+    # and authors from XML file
+    etree.strip_elements(
+        tree, *(FLOAT_TAGS + INLINE_STRIP_TAGS), with_tail=False
+    )
+    # remove what is most likely noise
+    for mn in nodes['unexpected']:
+        if len(mn.getchildren()) == 0:
+            mn.getparent().remove(mn)
+    # replace non citation references with REF
+    for rtag in nodes['ref']:
+        _mark_non_citation_ref(rtag)
+
+    # processing of citation markers
+    bibkey_map = {}
+    paper_dict['bib_entries'] = {}
+    for bi in nodes['bibitem']:
+        _process_bibitem_node(bi, aid, paper_dict, bibkey_map)
+
+    for cit in nodes['cit']:
+        num_citations += 1
+        if not _process_cit_node(cit, aid, bibkey_map, log):
+            num_citations_notfound += 1
+    # /processing of citation markers
+    etree.strip_elements(tree, *BIBLIOGRAPHY_TAGS, with_tail=False)
+
+    # process document structure
+    # div0 tag can appear on different levels of the XML hierarchy,
+    # such as /std/div0 or /unknown/frontmatter/div0
+    # we therefore take div0s from anywhere and assume they always
+    # are the lowest level containers of the main textual contents
+    paper_dict['body_text'] = _body_paragraphs(
+        nodes['div0'], nodes['content']
+    )
+
+    return num_citations, num_citations_notfound
+
+
+def _process_tree_xpath(tree, aid, paper_dict, log):
+    """ _process_tree() with one XPath query per processing step instead
+        of a single tree walk (the original way of collecting the nodes,
+        kept for comparison).
+    """
+
+    num_citations = 0
+    num_citations_notfound = 0
+
+    # figures and tables
+    paper_dict['ref_entries'] = {}
+    ref_ids = _ref_entry_ids(aid)
+    for tag in FLOAT_TAGS:
+        for xtag in tree.xpath('//{}'.format(tag)):
+            _process_float_node(xtag, paper_dict, ref_ids)
+    etree.strip_elements(tree, *FLOAT_TAGS, with_tail=False)
+
+    # math notation
+    for ftag in tree.xpath('//formula'):
+        _process_formula_node(ftag, paper_dict, ref_ids)
+    etree.strip_elements(tree, *INLINE_STRIP_TAGS, with_tail=False)
+
+    # remove what is most likely noise
+    for mn in tree.xpath('//unexpected'):
+        if len(mn.getchildren()) == 0:
+            mn.getparent().remove(mn)
+    # replace non citation references with REF
+    for rtag in tree.xpath('//ref[starts-with(@target, "uid")]'):
+        _mark_non_citation_ref(rtag)
+
+    # processing of citation markers
+    bibkey_map = {}
+    paper_dict['bib_entries'] = {}
+    for bi in tree.xpath('//bibitem'):
+        _process_bibitem_node(bi, aid, paper_dict, bibkey_map)
+
+    for cit in tree.xpath('//cit'):
+        num_citations += 1
+        if not _process_cit_node(cit, aid, bibkey_map, log):
+            num_citations_notfound += 1
+    # /processing of citation markers
+    etree.strip_elements(tree, *BIBLIOGRAPHY_TAGS, with_tail=False)
+
+    # process document structure
+    top_level_sections = tree.xpath('//div0')
+    content_nodes = []
+    if len(top_level_sections) == 0:
+        content_nodes = tree.xpath((
+            '//*[self::p or self::list or self::proof or '
+            'self::listing]'
+        ))
+    paper_dict['body_text'] = _body_paragraphs(
+        top_level_sections, content_nodes
+    )
+
+    return num_citations, num_citations_notfound
+
+
+def _parse_xml(
+        xml, error, aid, metadata_json, source_info, out_dir, write_logs
+):
+    """ Build the paper dict from the Tralics output of a single paper.
+
+        Returns a tuple (paper dict, number of citations, number of
+        unmatched citations). The paper dict is None if the conversion
+        failed.
+    """
+
+    log = _logger(out_dir, write_logs)
+    # check if smth went wrong with converting latex to xml
+    if xml is None:
+        # print('FAILED {}. skipping'.format(aid))
+        log('\n--- {} ---\n{}\n----------\n'.format(aid, error))
+        return None, 0, 0
+    # get plain text from tralics output
+    parser = etree.XMLParser()
+    try:
+        # get tree of XML hierarchy
+        tree = etree.parse(io.BytesIO(xml), parser)
+    # catch exception to faulty XML file
+    except (etree.XMLSyntaxError, UnicodeDecodeError) as e:
+        # print('FAILED {}. skipping'.format(aid))
+        log('\n--- {} ---\n{}\n----------\n'.format(aid, e))
+        return None, 0, 0
+
+    # start building paper dict
+    paper_dict = OrderedDict({
+        'paper_id': aid,
+        '_pdf_hash': None,
+        '_source_hash': None,
+        '_source_name': None,
+        'metadata': None,
+        'abstract': [],
+        'body_text': [],
+        'bib_entries': {},
+        'ref_entries': {}
+    })
+
+    paper_dict['_source_hash'] = source_info['hash']
+    paper_dict['_source_name'] = source_info['name']
+
+    # get paper metadata
+    metadata = _decode_metadata(metadata_json)
+    paper_dict['metadata'] = metadata
+    abstract_text = metadata.get('abstract', '')
+    abstract = {
+        'section': 'Abstract',
+        'text': abstract_text,
+        'cite_spans': [],
+        'ref_spans': []
+    }
+    paper_dict['abstract'] = abstract
+    title = paper_dict['metadata']['title']
+    #paper_dict['git_url'] = get_git_url(title)
+    #paper_dict['tasks'] = get_task_list(title)
+
+    num_citations, num_citations_notfound = _process_tree(
+        tree, aid, paper_dict, log
+    )
+    return paper_dict, num_citations, num_citations_notfound
+
+
+def _paper_id_from_line(line):
+    """ Get the paper ID of a JSONL output line without decoding the whole
+        paper (the paper ID is always serialized first).
+    """
+
+    paper_id_m = PAPER_ID_LINE_PATT.match(line)
+    if paper_id_m is not None:
+        return paper_id_m.group(1)
+    return json.loads(line)['paper_id']
+
+
+# per process state of parse() workers
+_worker_tralics_pool = None
+
+
+def _init_parse_worker(tralics_log_path):
+    global _worker_tralics_pool
+    _worker_tralics_pool = TralicsPool(size=1, log_path=tralics_log_path)
+    Finalize(_worker_tralics_pool, _worker_tralics_pool.close,
+             exitpriority=10)
+
+
+def _parse_file_worker(task):
+    path, aid = task[:2]
+    xml, error = _worker_tralics_pool.convert(path, aid)
+    return _parse_xml(xml, error, *task[1:])
+
+
+def parse(
+        in_dir, out_dir, tar_fn, source_file_info, meta_db_fp, incremental,
+        write_logs=False, num_workers=1
+):
+    """ Convert all normalized LaTeX files in in_dir into a single JSONL
+        file named after tar_fn. With num_workers > 1 the papers are
+        distributed across a process pool.
+
+        Papers are written as soon as they are converted. With incremental
+        set, an existing output is left untouched and a partially written
+        one is resumed after its last complete line.
+    """
+
+    log = _logger(out_dir, write_logs)
 
     if not os.path.isdir(in_dir):
         print('input directory does not exist')
@@ -276,432 +944,117 @@ def parse(
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
 
-    # prepare metadata DB connection
-    meta_db_conn = sqlite3.connect(meta_db_fp)
-    meta_db_cur = meta_db_conn.cursor()
+    tar_fn_base, ext = os.path.splitext(tar_fn)
+    out_json_path = os.path.join(
+        out_dir,
+        '{}.jsonl'.format(tar_fn_base)
+    )
+    if incremental and os.path.isfile(out_json_path):
+        log('skipping {} (already parsed)'.format(tar_fn))
+        return True
 
     num_citations = 0
     num_citations_notfound = 0
-    file_iterator = 0
-    paper_dicts_list = []
 
-    # iterate over each file in input directory
-    fns = os.listdir(in_dir)
-    for fn in tqdm(fns, total=len(fns), unit='papers'):
+    # persist output in JSONL (one JSON line per paper)
+    writer = JsonlWriter(out_json_path, resume=incremental)
+    done_aids = set(
+        _paper_id_from_line(line) for line in writer.resumed_lines()
+    )
+    if len(done_aids) > 0:
+        log('resuming {} after {} papers'.format(tar_fn, len(done_aids)))
+
+    # collect each file in input directory
+    paper_files = []
+    for fn in os.listdir(in_dir):
         path = os.path.join(in_dir, fn)  # absolute path to current file
         if fn in ['log.txt', 'log_latexpand.txt']:
             continue
         aid, ppr_year, ppr_month, ext = _filename_to_aid(fn, details=True)
-        aid_fn_safe = aid.replace('/', '')
         if PDF_EXT_PATT.match(ext):  # Skip pdf files
             log('skipping file {} (PDF)'.format(fn))
             continue
-        # write latex contents in a temporary xml file
-        with tempfile.TemporaryDirectory() as tmp_dir_path:
-            tmp_xml_path = os.path.join(tmp_dir_path, '{}.xml'.format(aid_fn_safe))
-            # run tralics
-            tralics_args = ['tralics',
-                            '-silent',
-                            '-noxmlerror',
-                            '-utf8',
-                            '-oe8',
-                            '-entnames=false',
-                            '-nomathml',
-                            '-output_dir={}'.format(tmp_dir_path),
-                            path]
-
-            if write_logs:
-                out = open(os.path.join(out_dir, 'log_tralics.txt'), 'a')
-            else:
-                out = open(os.devnull, 'w')
-            err = open(os.path.join(tmp_dir_path, 'tralics_out.txt'), mode='w')
-            out.write('\n------------- {} -------------\n'.format(aid))
-            out.flush()
-
-            try:
-                subprocess.run(tralics_args, stdout=out, stderr=err, timeout=5)
-            except subprocess.TimeoutExpired as e:
-                # print('FAILED {}. skipping'.format(aid))
-                log('\n--- {} ---\n{}\n----------\n'.format(aid, e))
-                continue
-            out.close()
-            err.close()
+        if aid in done_aids:
+            continue
+        paper_files.append((path, aid, ppr_year, ppr_month))
 
-            # get plain text from tralics output
-            parser = etree.XMLParser()
+    # prefetch metadata of the month (nearly) all papers of the TAR archive
+    # are from
+    meta_db = MetadataDB(meta_db_fp)
+    month_counts = Counter(
+        (ppr_year, ppr_month) for _, _, ppr_year, ppr_month in paper_files
+    )
+    if len(month_counts) > 0:
+        tar_year, tar_month = month_counts.most_common(1)[0][0]
+    else:
+        tar_year, tar_month = None, None
+    month_metadata = _MonthMetadata(meta_db, tar_year, tar_month)
+    tasks = []
+    for path, aid, ppr_year, ppr_month in paper_files:
+        aid_fn_safe = aid.replace('/', '')
+        tasks.append((
+            path,
+            aid,
+            month_metadata.pop_json(aid, ppr_year, ppr_month),
+            source_file_info[aid_fn_safe],
+            out_dir,
+            write_logs
+        ))
+    del month_metadata
+    meta_db.close()
+
+    if write_logs:
+        tralics_log_path = os.path.join(out_dir, 'log_tralics.txt')
+    else:
+        tralics_log_path = None
+    pool = None
+    tralics_pool = None
+    if num_workers > 1:
+        # recycle workers regularly to keep their memory footprint bounded
+        pool = Pool(
+            num_workers,
+            initializer=_init_parse_worker,
+            initargs=(tralics_log_path,),
+            maxtasksperchild=PARSE_TASKS_PER_CHILD
+        )
+        results = pool.imap_unordered(_parse_file_worker, tasks)
+    else:
+        # let Tralics convert the next paper while the current one is
+        # processed (a single Tralics process, so that no more CPUs are
+        # used than num_workers asks for)
+        tralics_pool = TralicsPool(size=1, log_path=tralics_log_path)
+        tasks_by_aid = {task[1]: task for task in tasks}
+        results = (
+            _parse_xml(xml, error, *tasks_by_aid[aid][1:])
+            for aid, xml, error in tralics_pool.convert_many(
+                (task[1], task[0]) for task in tasks
+            )
+        )
 
-            # check if smth went wrong with parsing latex to temporary xml file
-            if not os.path.isfile(tmp_xml_path):
-                # print('FAILED {}. skipping'.format(aid))
-                log(('\n--- {} ---\n{}\n----------\n'
-                     '').format(aid, 'no tralics output'))
+    try:
+        for paper_dict, ppr_citations, ppr_citations_notfound in tqdm(
+                results, total=len(tasks), unit='papers'
+        ):
+            num_citations += ppr_citations
+            num_citations_notfound += ppr_citations_notfound
+            if paper_dict is None:
                 continue
-            with open(tmp_xml_path) as f:
-                try:
-                    tree = etree.parse(f, parser)  # get tree of XML hierarchy
-                    file_iterator += 1
-                # catch exception to faulty XML file
-                except (etree.XMLSyntaxError, UnicodeDecodeError) as e:
-                    # print('FAILED {}. skipping'.format(aid))
-                    log('\n--- {} ---\n{}\n----------\n'.format(aid, e))
-                    continue
-
-            # start building paper dict
-            paper_dict = OrderedDict({
-                'paper_id': aid,
-                '_pdf_hash': None,
-                '_source_hash': None,
-                '_source_name': None,
-                'metadata': None,
-                'abstract': [],
-                'body_text': [],
-                'bib_entries': {},
-                'ref_entries': {}
-            })
-
-            paper_dict['_source_hash'] = source_file_info[aid_fn_safe]['hash']
-            paper_dict['_source_name'] = source_file_info[aid_fn_safe]['name']
-
-            # get paper metadata
-            metadata = _get_paper_metadata(meta_db_cur, aid, ppr_year, ppr_month)
-            paper_dict['metadata'] = metadata
-            abstract_text = metadata.get('abstract', '')
-            abstract = {
-                'section': 'Abstract',
-                'text': abstract_text,
-                'cite_spans': [],
-                'ref_spans': []
-            }
-            paper_dict['abstract'] = abstract
-            title = paper_dict['metadata']['title']
-            #paper_dict['git_url'] = get_git_url(title)
-            #paper_dict['tasks'] = get_task_list(title)
-            # parse XML
-
-            # tags things that could be treated specially
-            # - <Metadata>
-            #     - <title>
-            #     - <authors><author>
-            # - <head>
-            # - <proof>
-            # - <abstract>
-            # - <maketitle>
-            # - <list> (might be used for larger chunks of text like
-            #           related work)
-            #
-            # tags *NOT* to touch
-            # - <unknown>: can surround whole content
-
-            # figures and tables
-            # # come in the follwoing forms:
-            # # - <figure/table><head>caption text ...
-            # # - <figure/table><caption>caption text ...
-            # # - <float type="figure/table"><caption>caption text ...
-
-            ftags = tree.xpath('//{}'.format('figure'))
-            ttags = tree.xpath('//{}'.format('table'))
-            fltags = tree.xpath('//{}'.format('float'))
-
-            paper_dict['ref_entries'] = {}
-
-            for xtag in ftags + ttags + fltags:
-                if xtag.tag in ['figure', 'table']:
-                    treat_as_type = xtag.tag
-                else:
-                    assert xtag.tag == 'float'
-                    if xtag.get('type') in ['figure', 'table']:
-                        treat_as_type = xtag.get('type')
-                    else:
-                        continue
-                elem_uuid = uuid.uuid4()  # create uuid for each fig/tbl
-
-                caption_text = ''
-                try:
-                    for element in xtag.iter():
-                            if element.tag in ['head', 'caption']:
-                                elem_text = etree.tostring(
-                                    element,
-                                    encoding='unicode',
-                                    method='text',
-                                    with_tail=False
-                                )
-                                if len(elem_text) > 0:
-                                    caption_text = elem_text
-                except TypeError:
-                    # can get a "NoneType cannot be serialized" in rare
-                    # cases
-                    continue
-                if len(caption_text) < 1:
-                    caption_text = 'NO_CAPTION'
-
-                xtag.tail = '{{{{{}:{}}}}}'.format(treat_as_type, elem_uuid)
-
-                if treat_as_type == 'figure':
-                    paper_dict['ref_entries'][str(elem_uuid)] = {
-                        'caption': ''.join(caption_text.splitlines()),
-                        'type': 'figure'}
-
-                elif treat_as_type == 'table':
-                    paper_dict['ref_entries'][str(elem_uuid)] = {
-                        'caption': ''.join(caption_text.splitlines()),
-                        'type': 'table'}
-
-            # remove all figure/table/float tags from xml file
-            etree.strip_elements(tree, 'figure', with_tail=False)
-            etree.strip_elements(tree, 'table', with_tail=False)
-            etree.strip_elements(tree, 'float', with_tail=False)
-
-            # math notation
-            for ftag in tree.xpath('//{}'.format('formula')):
-                # uuid
-                formula_uuid = uuid.uuid4()
-                try:
-                    latex_content = etree.tostring(
-                        ftag.find('texmath'),
-                        encoding='unicode',
-                        method='text',
-                        with_tail=False
-                    )
-                except TypeError:
-                    # very rare case where Tralics creates an XML that uses
-                    # Texmath tags instead of texmath
-                    # kown for:
-                    # - 1308.0481
-                    # - 1901.06986
-                    try:
-                        latex_content = etree.tostring(
-                            ftag.find('Texmath'),
-                            encoding='unicode',
-                            method='text',
-                            with_tail=False
-                        )
-                    except:
-                        latex_content = 'NO_LATEX_CONTENT'
-                if ftag.tail:
-                    new_tail = ' {}'.format(ftag.tail)
-                else:
-                    new_tail = ''
-                ftag.tail = '{{{{formula:{}}}}}{}'.format(
-                    formula_uuid,
-                    new_tail
-                )
-
-                paper_dict['ref_entries'][str(formula_uuid)] = {
-                    'latex': ''.join(latex_content.splitlines()),
-                    'type': 'formula'}
-
-            # remove all formula tags from XML file
-            etree.strip_elements(tree, 'formula', with_tail=False)
-
-            # remove title and authors (works only in a few papers)
-            attributes = ['title', 'author', 'date', 'thanks']  # keywords
-            for attribute in attributes:
-                etree.strip_elements(tree, attribute, with_tail=False)
-            # remove what is most likely noise
-            mby_noise = tree.xpath('//unexpected')
-            for mn in mby_noise:
-                if len(mn.getchildren()) == 0:
-                    mn.getparent().remove(mn)
-            # replace non citation references with REF
-            for rtag in tree.xpath('//ref[starts-with(@target, "uid")]'):
-                # FIXME: should resolve section refs here
-                if rtag.tail:
-                    rtag.tail = '{} {}'.format('REF', rtag.tail)
-                else:
-                    rtag.tail = ' {}'.format('REF')
-
-            # processing of citation markers
-            bibitems = tree.xpath('//bibitem')
-            bibkey_map = {}
-
-            paper_dict['bib_entries'] = {}
-
-            for bi in bibitems:
-                containing_p = bi.getparent()
-                try:
-                    while containing_p.tag != 'p':
-                        # sometimes the bibitem element
-                        # is not the direct child of
-                        # the containing p item we want
-                        containing_p = containing_p.getparent()
-                except AttributeError:
-                    # getparent() might return None
-                    continue
-                for child in containing_p.getchildren():
-                    if child.text:
-                        child.text = '{}'.format(child.text)
-                text = etree.tostring(
-                    containing_p,
-                    encoding='unicode',
-                    method='text'
-                )
-
-                text = re.sub(r'\s+', ' ', text).strip()
-                # NOTE: commented out lines below b/c it removes information
-                # # replace the uuid of formulas in reference string
-                # text = re.sub(r'(^{{formula:)(.*)', '', text)
-                sha_hash = sha1()
-                items = [text.encode('utf-8'), str(aid).encode('utf-8')]
-                for item in items:
-                    sha_hash.update(item)
-                sha_hash_string = str(sha_hash.hexdigest())
-                local_key = bi.get('id')
-                bibkey_map[local_key] = sha_hash_string
-
-                paper_dict['bib_entries'][sha_hash_string] = {
-                    'bib_entry_raw': text
-                }
-
-                contained_arXiv_ids_list = []
-                contained_links_list = []
-
-                for xref in containing_p.findall('xref'):
-                    link = xref.get('url')
-                    link_text_raw = etree.tostring(
-                        xref,
-                        encoding='unicode',
-                        method='text'
-                    )
-                    # clean link plain text for matching with
-                    # bib entry plain text
-                    link_text = re.sub(
-                        r'\s+',
-                        ' ',
-                        link_text_raw
-                    ).strip()
-
-                    aurl_match = ARXIV_URL_PATT.search(link)
-                    if aurl_match:
-                        id_part = aurl_match.group(1)
-                        if len(link_text) != 0:
-                            try:
-                                location_offset_start = text.index(link_text)
-                                location_offset_end = text.index(link_text) + \
-                                    len(link_text)
-                            except ValueError as e:
-                                # treat error if link text is not in
-                                # bib entry text
-                                location_offset_start = None
-                                location_offset_end = None
-
-                        else:
-                            # if there are links included in source file
-                            # without corresponding visible text
-                            link_text = None
-                            location_offset_start = None
-                            location_offset_end = None
-
-                        arXiv_item_local_temp_dict = {
-                            'id': id_part,
-                            'text': link_text,
-                            'start': location_offset_start,
-                            'end': location_offset_end
-                        }
-                        contained_arXiv_ids_list.append(
-                            arXiv_item_local_temp_dict
-                        )
-
-                    else:
-                        if len(link_text) != 0:
-                            try:
-                                location_offset_start = text.index(link_text)
-                                location_offset_end = text.index(link_text) + \
-                                    len(link_text)
-                            except ValueError as e:
-                                location_offset_start = None
-                                location_offset_end = None
-
-                        else:
-                            link_text = None
-                            location_offset_start = None
-                            location_offset_end = None
-
-                        link_item_local_temp_dict = {
-                            'url': link,
-                            'text': link_text,
-                            'start': location_offset_start,
-                            'end': location_offset_end
-                        }
-                        contained_links_list.append(link_item_local_temp_dict)
-
-                paper_dict['bib_entries'][sha_hash_string][
-                    'contained_arXiv_ids'
-                ] = contained_arXiv_ids_list
-                paper_dict['bib_entries'][sha_hash_string][
-                    'contained_links'
-                ] = contained_links_list
-
-            citations = tree.xpath('//cit')
-            for cit in citations:
-                num_citations += 1
-                elem = cit.find('ref')
-                if elem is None:
-                    log(('WARNING: cite element in {} contains no ref element'
-                         '').format(aid))
-                    continue
-                ref = elem.get('target')
-                replace_text = ''
-                if ref in bibkey_map:
-                    marker = '{{{{cite:{}}}}}'.format(bibkey_map[ref])
-                    replace_text += marker
-                else:
-                    log(('WARNING: unmatched bibliography key {} for doc {}'
-                         '').format(ref, aid))
-                    num_citations_notfound += 1
-                if cit.tail:
-                    cit.tail = replace_text + cit.tail
-                else:
-                    cit.tail = replace_text
-            # /processing of citation markers
-            etree.strip_elements(tree, 'Bibliography', with_tail=False)
-            etree.strip_elements(tree, 'bibitem', with_tail=False)
-            etree.strip_elements(tree, 'cit', with_tail=False)
-
-            # _write_debug_xml(tree)
-
-            # process document structure
-            paragraphs = []
-            curr_sec = {
-                'head': '',
-                'num': '-1',
-                'type': ''
-            }
-            # div0 tag can appear on different levels of the XML hierarchy,
-            # such as /std/div0 or /unknown/frontmatter/div0
-            # we therefore take div0s from anywhere and assume they always
-            # are the lowest level containers of the main textual contents
-            top_level_sections = tree.xpath('//div0')
-            if len(top_level_sections) == 0:
-                # if there are no div0 tags, we give up on sections and just
-                # use paragraphs, lists, proofs, and listings and hope we
-                # cover all content with those
-                paragraphs = [
-                    _process_content_node(p, curr_sec)
-                    for p in tree.xpath((
-                        '//*[self::p or self::list or self::proof or '
-                        'self::listing]'
-                    ))
-                ]
-            for sec in top_level_sections:
-                paragraphs.extend(
-                    _process_section_node(sec, curr_sec)
-                )
-
-            paper_dict['body_text'] = paragraphs
-
-        # bundle paper dicts for presisting as JSONL (one JSON line per paper)
-        paper_dicts_list.append(paper_dict)
-
-    # persist output in JSONL
-    tar_fn_base, ext = os.path.splitext(tar_fn)
-    out_json_path = os.path.join(
-        out_dir,
-        '{}.jsonl'.format(tar_fn_base)
-    )
-    with open(out_json_path, 'w') as f:
-        for ppr in paper_dicts_list:
-            line = '{}\n'.format(json.dumps(ppr))
-            f.write(line)
+            writer.write(paper_dict)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if tralics_pool is not None:
+            log('Tralics: {}'.format(json.dumps(tralics_pool.stats())))
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        raise
+    finally:
+        if tralics_pool is not None:
+            tralics_pool.close()
+
+    writer.close()
 
     log(('Citations: {} (not unique)\nUnmatched citations: {}'
          '').format(num_citations, num_citations_notfound))
@@ -7,11 +7,128 @@ import sys
 import tarfile
 import tempfile
 import time
-from normalize_arxiv_dump import normalize
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from normalize_arxiv_dump import normalize_stream
 from parse_latex_tralics import parse
 
 
-def prepare(in_dir, out_dir, meta_db, tar_fn_patt, write_logs=False):
+def _iter_tar_sources(tar, counts):
+    """ Yield (file name, bytes) tuples of the source files in an arXiv
+        source TAR archive, reading members sequentially via TarFile.next()
+        and without writing anything to disk. PDF members are skipped.
+
+        The number of files and PDFs seen is tracked in counts.
+    """
+
+    while True:
+        member = tar.next()
+        if member is None:
+            break
+        if not member.isfile():
+            continue
+        fn = os.path.basename(member.name)
+        counts['files'] += 1
+        if os.path.splitext(fn)[-1] == '.pdf':
+            counts['pdf'] += 1
+            continue
+        yield fn, tar.extractfile(member).read()
+
+
+def _prepare_tar(in_dir, tar_fn, out_dir, meta_db, write_logs=False,
+                 num_workers=1, incremental=False):
+    """ Normalize and parse a single TAR archive into <tar>.jsonl.
+
+        Returns a tuple (number of files, number of PDFs), or None if the
+        archive was skipped.
+    """
+
+    tar_path = os.path.join(in_dir, tar_fn)
+    if incremental:
+        out_json_path = os.path.join(
+            out_dir,
+            '{}.jsonl'.format(os.path.splitext(tar_fn)[0])
+        )
+        if os.path.isfile(out_json_path):
+            print('{} done in a previous run. skipping'.format(tar_fn))
+            return None
+    # check if file can be skipped
+    skip_file = False
+    # "gracefully" handle input file access (currently a network mount)
+    num_tries = 1
+    while True:
+        # try file access
+        try:
+            # try tar
+            is_tar = False
+            try:
+                is_tar = tarfile.is_tarfile(tar_path)
+            except IsADirectoryError:
+                print(('unexpected directory "{}" in {}. skipping'
+                       '').format(tar_fn, in_dir))
+                skip_file = True
+            if not is_tar:
+                print(('"{}" is not a TAR archive. skipping'
+                       '').format(tar_fn))
+                skip_file = True
+            break  # not remote access problems
+        except IOError as err:
+            print(('[{}] IO error when trying check tar file: {}'
+                   '').format(num_tries, err))
+            num_tries += 1
+            time.sleep(60)
+    if skip_file:
+        return None
+    with tempfile.TemporaryDirectory() as tmp_dir_path:
+        # prepare folder for intermediate results
+        tmp_dir_norm = os.path.join(tmp_dir_path, 'normalized')
+        # stream source files out of the archive and normalize them
+        # "gracefully" handle input file access (currently a network mount)
+        num_tries = 1
+        while True:
+            counts = {'files': 0, 'pdf': 0}
+            if os.path.isdir(tmp_dir_norm):
+                shutil.rmtree(tmp_dir_norm)
+            os.mkdir(tmp_dir_norm)
+            try:
+                with tarfile.open(tar_path, mode='r|') as tar:
+                    source_file_info = normalize_stream(
+                        _iter_tar_sources(tar, counts),
+                        tmp_dir_norm,
+                        write_logs=write_logs,
+                        num_workers=num_workers
+                    )
+                break
+            except IOError as err:
+                print(('[{}] IO error when trying read tar file: {}'
+                       '').format(num_tries, err))
+                num_tries += 1
+                time.sleep(60)
+        parse(
+            tmp_dir_norm,
+            out_dir,
+            tar_fn,
+            source_file_info,
+            meta_db,
+            incremental=incremental,
+            write_logs=write_logs,
+            num_workers=num_workers
+        )
+    return counts['files'], counts['pdf']
+
+
+def prepare(in_dir, out_dir, meta_db, tar_fn_patt, write_logs=False,
+            num_workers=1, incremental=False):
+    """ Normalize and parse all TAR archives in in_dir.
+
+        With num_workers > 1 the TAR archives are distributed across a
+        process pool (one archive per worker at a time, which bounds the
+        memory and temporary disk use of each worker). Workers not needed
+        for archives are used to process the papers within an archive.
+
+        With incremental set, archives with an existing output are skipped
+        and partially written outputs are resumed.
+    """
+
     if not os.path.isdir(in_dir):
         print('input directory does not exist')
         return False
@@ -34,105 +151,96 @@ def prepare(in_dir, out_dir, meta_db, tar_fn_patt, write_logs=False):
     tar_total = len(tar_fns)
     num_pdf_total = 0
     num_files_total = 0
+    todo_tar_fns = []
     for tar_idx, tar_fn in enumerate(tar_fns):
-        # for each tar archive
-        print('{}/{} ({})'.format(tar_idx+1, tar_total, tar_fn))
         if tar_fn in done_tars:
+            print('{}/{} ({})'.format(tar_idx+1, tar_total, tar_fn))
             print('done in a previous run. skipping')
             continue
-        tar_path = os.path.join(in_dir, tar_fn)
-        # check if file can be skipped
-        skip_file = False
-        # "gracefully" handle input file access (currently a network mount)
-        num_tries = 1
-        while True:
-            # try file access
-            try:
-                # try tar
-                is_tar = False
-                try:
-                    is_tar = tarfile.is_tarfile(tar_path)
-                except IsADirectoryError:
-                    print(('unexpected directory "{}" in {}. skipping'
-                           '').format(tar_fn, in_dir))
-                    skip_file = True
-                if not is_tar:
-                    print(('"{}" is not a TAR archive. skipping'
-                           '').format(tar_fn))
-                    skip_file = True
-                break  # not remote access problems
-            except IOError as err:
-                print(('[{}] IO error when trying check tar file: {}'
-                       '').format(num_tries, err))
-                num_tries += 1
-                time.sleep(60)
-        if skip_file:
-            continue
-        with tempfile.TemporaryDirectory() as tmp_dir_path:
-            # prepare folders for intermediate results
-            tmp_dir_gz = os.path.join(tmp_dir_path, 'flattened')
-            os.mkdir(tmp_dir_gz)
-            tmp_dir_norm = os.path.join(tmp_dir_path, 'normalized')
-            os.mkdir(tmp_dir_norm)
-            # extraxt
-            # "gracefully" handle input file access (currently a network mount)
-            num_tries = 1
-            while True:
-                try:
-                    tar = tarfile.open(tar_path)
-                    tar.extractall(path=tmp_dir_gz)
-                    break
-                except IOError as err:
-                    print(('[{}] IO error when trying exract tar file: {}'
-                           '').format(num_tries, err))
-                    num_tries += 1
-                    time.sleep(60)
-            containing_dir = os.listdir(tmp_dir_gz)[0]
-            containing_path = os.path.join(tmp_dir_gz,
-                                           containing_dir)
-            for gz_fn in os.listdir(containing_path):
-                num_files_total += 1
-                gz_path_tmp = os.path.join(containing_path, gz_fn)
-                if os.path.splitext(gz_fn)[-1] == '.pdf':
-                    num_pdf_total += 1
-                    os.remove(gz_path_tmp)
+        todo_tar_fns.append(tar_fn)
+
+    if num_workers > 1 and len(todo_tar_fns) > 1:
+        tar_workers = min(num_workers, len(todo_tar_fns))
+        paper_workers = max(1, num_workers // tar_workers)
+        # replace each worker process after one archive so that memory
+        # doesn't accumulate over a run
+        with ProcessPoolExecutor(
+                max_workers=tar_workers,
+                max_tasks_per_child=1
+        ) as executor:
+            futures = {
+                executor.submit(
+                    _prepare_tar,
+                    in_dir,
+                    tar_fn,
+                    out_dir,
+                    meta_db,
+                    write_logs,
+                    paper_workers,
+                    incremental
+                ): tar_fn
+                for tar_fn in todo_tar_fns
+            }
+            for tar_idx, future in enumerate(as_completed(futures)):
+                print('{}/{} ({}) done'.format(
+                    tar_idx+1, len(todo_tar_fns), futures[future]
+                ))
+                counts = future.result()
+                if counts is None:
                     continue
-                gz_path_new = os.path.join(tmp_dir_gz, gz_fn)
-                shutil.move(gz_path_tmp, gz_path_new)
-            os.rmdir(containing_path)
-            # adjust in_dir
-            source_file_info = normalize(
-                tmp_dir_gz,
-                tmp_dir_norm,
-                write_logs=write_logs
-            )
-            parse(
-                tmp_dir_norm,
-                out_dir,
+                num_files_total += counts[0]
+                num_pdf_total += counts[1]
+    else:
+        for tar_idx, tar_fn in enumerate(todo_tar_fns):
+            # for each tar archive
+            print('{}/{} ({})'.format(tar_idx+1, len(todo_tar_fns), tar_fn))
+            counts = _prepare_tar(
+                in_dir,
                 tar_fn,
-                source_file_info,
+                out_dir,
                 meta_db,
-                incremental=False,
-                write_logs=write_logs
+                write_logs=write_logs,
+                num_workers=num_workers,
+                incremental=incremental
             )
-        #with open(done_log_path, 'a') as f:
-        #    f.write('{}\n'.format(tar_fn))
+            if counts is None:
+                continue
+            num_files_total += counts[0]
+            num_pdf_total += counts[1]
+            #with open(done_log_path, 'a') as f:
+            #    f.write('{}\n'.format(tar_fn))
     print('{} files'.format(num_files_total))
     print('{} PDFs'.format(num_pdf_total))
 
 
 if __name__ == '__main__':
-    if len(sys.argv) not in [4, 5]:
+    args = sys.argv[1:]
+    num_workers = 1
+    incremental = False
+    if '--incremental' in args:
+        incremental = True
+        args.remove('--incremental')
+    if '--workers' in args:
+        workers_idx = args.index('--workers')
+        try:
+            num_workers = int(args[workers_idx+1])
+        except (IndexError, ValueError):
+            args = []
+        else:
+            del args[workers_idx:workers_idx+2]
+    if len(args) not in [3, 4]:
         print((
             'usage: python3 prepare.py </path/to/in/dir> </path/to/out/dir> '
-            '</path/to/metadata.db> [<tar_fn_patt>]'
+            '</path/to/metadata.db> [<tar_fn_patt>] [--workers <N>] '
+            '[--incremental]'
         ))
         sys.exit()
-    in_dir = sys.argv[1]
-    out_dir_dir = sys.argv[2]
-    meta_db = sys.argv[3]
-    if len(sys.argv) == 5:
-        tar_fn_patt = sys.argv[4]
+    in_dir = args[0]
+    out_dir_dir = args[1]
+    meta_db = args[2]
+    if len(args) == 4:
+        tar_fn_patt = args[3]
     else:
         tar_fn_patt = '.tar'
-    ret = prepare(in_dir, out_dir_dir, meta_db, tar_fn_patt, write_logs=False)
+    ret = prepare(in_dir, out_dir_dir, meta_db, tar_fn_patt, write_logs=False,
+                  num_workers=num_workers, incremental=incremental)
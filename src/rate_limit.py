@@ -0,0 +1,215 @@
+""" Rate limiting for requests to external APIs.
+"""
+
+import asyncio
+import fcntl
+import json
+import time
+from email.utils import parsedate_to_datetime
+
+
+class AsyncTokenBucket:
+    """ Token bucket limiting the rate of requests started within an event
+        loop.
+    """
+
+    def __init__(self, requests_per_second):
+        self.rate = requests_per_second
+        self.tokens = 1.0
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate is None:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    max(self.rate, 1.0),
+                    self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class FileTokenBucket:
+    """ Token bucket shared by all processes using the same state file.
+
+        The bucket state (tokens, current rate, back-off, number of waiting
+        callers and throughput) is kept as JSON in state_fp and only read
+        and written while holding an exclusive lock on that file, so that
+        all worker processes together start at most `max_rate` requests
+        per second, evenly spaced.
+
+        The rate can be lowered (but never raised above max_rate) by the
+        server's X-Rate-Limit-Limit/-Interval headers, and a Retry-After
+        header pauses all callers (for at most max_retry_after seconds).
+    """
+
+    def __init__(self, state_fp, max_rate, max_retry_after=300):
+        self.state_fp = state_fp
+        self.max_rate = max_rate
+        self.max_retry_after = max_retry_after
+        # make sure the state file exists
+        with open(self.state_fp, 'a'):
+            pass
+
+    def _update_state(self, update):
+        """ Apply update(state, now) to the shared state under the lock and
+            return update's return value.
+        """
+
+        with open(self.state_fp, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                content = f.read()
+                now = time.time()
+                state = json.loads(content) if content else {}
+                if not state:
+                    state = {
+                        'rate': self.max_rate,
+                        'tokens': 1.0,
+                        'last': now,
+                        'blocked_until': 0.0,
+                        'waiting': 0,
+                        'window_start': now,
+                        'window_count': 0,
+                        'observed_rate': 0.0
+                    }
+                ret = update(state, now)
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return ret
+
+    def _try_acquire(self, waiting):
+        """ Take a token if possible. Returns the time to wait before
+            trying again, or 0 if a token was taken.
+        """
+
+        def update(state, now):
+            rate = state['rate']
+            # no bursts: requests are spaced by at least 1/rate seconds,
+            # also after a back-off
+            refill_from = max(state['last'], state['blocked_until'])
+            state['tokens'] = min(
+                1.0,
+                state['tokens'] + max(0, now - refill_from) * rate
+            )
+            state['last'] = now
+            if now >= state['blocked_until'] and state['tokens'] >= 1:
+                state['tokens'] -= 1
+                if waiting:
+                    state['waiting'] = max(0, state['waiting'] - 1)
+                # throughput over windows of 10 seconds
+                if now - state['window_start'] >= 10:
+                    state['observed_rate'] = (
+                        state['window_count'] / (now - state['window_start'])
+                    )
+                    state['window_start'] = now
+                    state['window_count'] = 0
+                state['window_count'] += 1
+                return 0
+            if not waiting:
+                state['waiting'] += 1
+            return max(
+                state['blocked_until'] - now,
+                (1 - state['tokens']) / rate
+            )
+
+        return self._update_state(update)
+
+    def acquire(self):
+        """ Block until a request may be started.
+        """
+
+        waiting = False
+        while True:
+            wait = self._try_acquire(waiting)
+            if wait == 0:
+                return
+            waiting = True
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """ Same as acquire(), but waits without blocking the event loop.
+        """
+
+        waiting = False
+        while True:
+            wait = self._try_acquire(waiting)
+            if wait == 0:
+                return
+            waiting = True
+            await asyncio.sleep(wait)
+
+    def update_from_response(self, status, headers):
+        """ Adjust to the rate limit headers of a response.
+        """
+
+        rate = None
+        try:
+            limit = float(headers.get('X-Rate-Limit-Limit', ''))
+            interval = float(
+                headers.get('X-Rate-Limit-Interval', '1s').rstrip('s')
+            )
+            if limit > 0 and interval > 0:
+                rate = min(self.max_rate, limit / interval)
+        except ValueError:
+            pass
+        retry_after = None
+        if status in [429, 503] and headers.get('Retry-After'):
+            retry_after = retry_after_seconds(headers['Retry-After'])
+            if retry_after is not None:
+                retry_after = min(retry_after, self.max_retry_after)
+        if rate is None and retry_after is None:
+            return
+
+        def update(state, now):
+            if rate is not None:
+                state['rate'] = rate
+            if retry_after is not None:
+                state['blocked_until'] = max(
+                    state['blocked_until'], now + retry_after
+                )
+
+        self._update_state(update)
+
+    def metrics(self):
+        """ Current rate limit, observed request rate (requests per second
+            over the last full 10 second window), number of callers waiting
+            for a token and remaining back-off in seconds.
+        """
+
+        def update(state, now):
+            return {
+                'rate_limit': state['rate'],
+                'observed_rate': round(state['observed_rate'], 3),
+                'queue_depth': state['waiting'],
+                'blocked_for': round(max(0, state['blocked_until'] - now), 3)
+            }
+
+        return self._update_state(update)
+
+
+def retry_after_seconds(value):
+    """ Seconds to wait according to a Retry-After header value (delay in
+        seconds or HTTP date), or None if it can't be parsed.
+    """
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
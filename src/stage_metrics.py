@@ -0,0 +1,171 @@
+""" Latency histograms and counters for the stages of a pipeline, which can
+    be merged across worker processes and exported as JSON or in the
+    Prometheus text format.
+"""
+
+import math
+import time
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60, 300, math.inf
+)
+
+
+class StageMetrics:
+    """ Per-stage latency histograms and named counters.
+
+        Usage:
+            metrics = StageMetrics()
+            with metrics.timer('grobid', items=len(ref_strings)):
+                ...
+            metrics.count('resolved_doi')
+            summary = metrics.to_dict()  # JSON serializable
+
+        Summaries of several processes are combined with merge().
+    """
+
+    def __init__(self):
+        # stage -> {'calls', 'items', 'seconds', 'buckets'}
+        self.stages = {}
+        self.counters = {}
+
+    @contextmanager
+    def timer(self, stage, items=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, items)
+
+    def observe(self, stage, seconds, items=1):
+        """ Record a call of a stage that took the given number of seconds
+            and handled the given number of items.
+        """
+
+        stats = self.stages.get(stage)
+        if stats is None:
+            stats = {
+                'calls': 0,
+                'items': 0,
+                'seconds': 0.0,
+                'buckets': [0] * len(LATENCY_BUCKETS)
+            }
+            self.stages[stage] = stats
+        stats['calls'] += 1
+        stats['items'] += items
+        stats['seconds'] += seconds
+        for idx, upper_bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= upper_bound:
+                stats['buckets'][idx] += 1
+                break
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, summary):
+        """ Add a summary returned by to_dict() (e.g. of another process).
+        """
+
+        for stage, summary_stats in summary['stages'].items():
+            stats = self.stages.setdefault(stage, {
+                'calls': 0,
+                'items': 0,
+                'seconds': 0.0,
+                'buckets': [0] * len(LATENCY_BUCKETS)
+            })
+            stats['calls'] += summary_stats['calls']
+            stats['items'] += summary_stats['items']
+            stats['seconds'] += summary_stats['seconds']
+            for idx, num in enumerate(summary_stats['buckets']):
+                stats['buckets'][idx] += num
+        for name, n in summary['counters'].items():
+            self.count(name, n)
+
+    @staticmethod
+    def _quantile(buckets, calls, q):
+        """ Upper bound of the bucket containing the q-quantile.
+        """
+
+        rank = q * calls
+        cumulative = 0
+        for upper_bound, num in zip(LATENCY_BUCKETS, buckets):
+            cumulative += num
+            if cumulative >= rank:
+                return None if math.isinf(upper_bound) else upper_bound
+        return None
+
+    def to_dict(self):
+        """ JSON serializable summary. Per stage, the bucket counts are
+            given per bucket (not cumulative), with the bounds in
+            'bucket_bounds' (the last one being infinite, given as null),
+            and p50/p90/p99 as bucket upper bounds.
+        """
+
+        stages = {}
+        for stage, stats in sorted(self.stages.items()):
+            calls = stats['calls']
+            stages[stage] = {
+                'calls': calls,
+                'items': stats['items'],
+                'seconds': stats['seconds'],
+                'mean_seconds': stats['seconds'] / calls if calls else None,
+                'p50_seconds': self._quantile(stats['buckets'], calls, 0.5),
+                'p90_seconds': self._quantile(stats['buckets'], calls, 0.9),
+                'p99_seconds': self._quantile(stats['buckets'], calls, 0.99),
+                'buckets': list(stats['buckets'])
+            }
+        return {
+            'bucket_bounds': [
+                None if math.isinf(b) else b for b in LATENCY_BUCKETS
+            ],
+            'stages': stages,
+            'counters': dict(sorted(self.counters.items()))
+        }
+
+    def to_prometheus(self, prefix):
+        """ Metrics in the Prometheus text exposition format, with metric
+            names starting with prefix.
+        """
+
+        lines = [
+            '# HELP {}_stage_seconds Latency of pipeline stages.'.format(
+                prefix
+            ),
+            '# TYPE {}_stage_seconds histogram'.format(prefix)
+        ]
+        for stage, stats in sorted(self.stages.items()):
+            cumulative = 0
+            for upper_bound, num in zip(LATENCY_BUCKETS, stats['buckets']):
+                cumulative += num
+                lines.append(
+                    '{}_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(
+                        prefix, stage,
+                        '+Inf' if math.isinf(upper_bound) else upper_bound,
+                        cumulative
+                    )
+                )
+            lines.append('{}_stage_seconds_sum{{stage="{}"}} {}'.format(
+                prefix, stage, stats['seconds']
+            ))
+            lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(
+                prefix, stage, stats['calls']
+            ))
+        lines.append(
+            '# HELP {}_stage_items_total Items handled by pipeline '
+            'stages.'.format(prefix)
+        )
+        lines.append('# TYPE {}_stage_items_total counter'.format(prefix))
+        for stage, stats in sorted(self.stages.items()):
+            lines.append('{}_stage_items_total{{stage="{}"}} {}'.format(
+                prefix, stage, stats['items']
+            ))
+        lines.append('# HELP {}_events_total Counted events.'.format(prefix))
+        lines.append('# TYPE {}_events_total counter'.format(prefix))
+        for name, n in sorted(self.counters.items()):
+            lines.append('{}_events_total{{event="{}"}} {}'.format(
+                prefix, name, n
+            ))
+        return '\n'.join(lines) + '\n'
@@ -1,12 +1,16 @@
 import os
 import glob
-import json
 from datetime import datetime
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 from concurrent.futures import ProcessPoolExecutor, as_completed
 import multiprocessing
+import sys
+
+# jsonl_io lives in src/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from jsonl_io import lazy_metadata
 
 # --- CONFIGURATION ---
 DATA_DIR = "/data/horse/ws/inbe405h-unarxive/processed_unarxive_extended_data"
@@ -20,8 +24,8 @@ def parse_jsonl_file(filepath):
         with open(filepath, "r", encoding="utf-8") as f:
             for line in f:
                 try:
-                    obj = json.loads(line)
-                    metadata = obj.get("metadata", {})
+                    # (decodes the metadata only)
+                    metadata = lazy_metadata(line) or {}
                     date_str = metadata.get("update_date")
                     disc = metadata.get("discipline")
                     results.append({
@@ -0,0 +1,120 @@
+""" Extraction of bibliographic fields from the TEI biblStruct XML returned
+    by GROBID (/api/processCitation and /api/processCitationList).
+
+    Elements are matched in any namespace ({*}), so biblStructs with and
+    without the TEI namespace declaration are handled alike.
+"""
+
+import re
+from lxml import etree
+
+YEAR_PATT = re.compile(r'\d{4}')
+
+_parser = etree.XMLParser(recover=True, resolve_entities=False)
+
+
+def parse_bibl_struct(bibl_struct_xml):
+    """ Root element of a biblStruct given as XML str or bytes, or None if
+        it can't be parsed.
+    """
+
+    if isinstance(bibl_struct_xml, str):
+        bibl_struct_xml = bibl_struct_xml.encode('utf-8')
+    try:
+        return etree.fromstring(bibl_struct_xml, _parser)
+    except etree.XMLSyntaxError:
+        return None
+
+
+def _text(element):
+    """ Stripped text of an element including its descendants (e.g.
+        <hi> markup within titles).
+    """
+
+    return ''.join(element.itertext()).strip()
+
+
+def title(root):
+    """ Title of the referenced work: the first title element marked as
+        main title, unless an untyped, non-empty title element comes first.
+    """
+
+    for title_elem in root.iter('{*}title'):
+        title_type = title_elem.get('type')
+        if title_type is None:
+            text = _text(title_elem)
+            if len(text) != 0:
+                return text
+        elif title_type == 'main':
+            return _text(title_elem)
+    return None
+
+
+def authors(root):
+    """ Authors of the referenced work (of the analytic level if there is
+        one, otherwise of the monograph) as a list of dicts with keys
+        'forenames' (list) and 'surname'.
+    """
+
+    level = next(root.iter('{*}analytic'), None)
+    if level is None or next(level.iter('{*}author'), None) is None:
+        level = next(root.iter('{*}monogr'), None)
+    if level is None:
+        return []
+    author_list = []
+    for author in level.iterchildren('{*}author'):
+        pers_name = next(author.iter('{*}persName'), None)
+        if pers_name is None:
+            continue
+        surname = next(pers_name.iter('{*}surname'), None)
+        author_list.append({
+            'forenames': [
+                _text(forename) for forename in pers_name.iter('{*}forename')
+            ],
+            'surname': _text(surname) if surname is not None else ''
+        })
+    return author_list
+
+
+def year(root):
+    """ Publication year as int, or None.
+    """
+
+    for date in root.iter('{*}date'):
+        for value in (date.get('when'), _text(date)):
+            if value:
+                year_m = YEAR_PATT.search(value)
+                if year_m:
+                    return int(year_m.group(0))
+    return None
+
+
+def venue(root):
+    """ Journal, proceedings or book title the work appeared in, or None.
+    """
+
+    monogr = next(root.iter('{*}monogr'), None)
+    if monogr is None or next(root.iter('{*}analytic'), None) is None:
+        # no separate venue for a monograph itself
+        return None
+    for title_elem in monogr.iterchildren('{*}title'):
+        text = _text(title_elem)
+        if len(text) != 0:
+            return text
+    return None
+
+
+def extract(bibl_struct_xml):
+    """ Dict with the title, authors, year and venue of a biblStruct, or
+        None if it can't be parsed.
+    """
+
+    root = parse_bibl_struct(bibl_struct_xml)
+    if root is None:
+        return None
+    return {
+        'title': title(root),
+        'authors': authors(root),
+        'year': year(root),
+        'venue': venue(root)
+    }
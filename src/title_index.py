@@ -0,0 +1,263 @@
+""" Embedded, memory-mapped title index for matching references against
+    OpenAlex without a PostgreSQL DB.
+
+    The index is built once from the OpenAlex works dump
+        https://docs.openalex.org/download-all-data/openalex-snapshot
+    and keyed by normalize_title() output. File layout:
+
+        header   magic (8 bytes), number of keys n, records offset
+                 (little endian)
+        keys     n sorted unsigned 64 bit title hashes
+        offsets  n+1 unsigned 64 bit offsets into the records section
+        records  per key a JSON list of
+                 [title_norm, author last names, cited_by_count, ids]
+                 with ids being [oa_id, pmid, pmcid, doi]
+
+    Keys and offsets are stored in native byte order, so an index has to
+    be read on a machine with the byte order it was built on.
+
+    Lookups bisect the keys and only decode the records of the matching
+    key, so workers can share one index read-only through mmap.
+"""
+
+import gzip
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import tempfile
+from array import array
+from bisect import bisect_left
+from hashlib import blake2b
+from multiprocessing import Pool
+from normalization import normalize_author_name, normalize_title
+from tqdm import tqdm
+
+MAGIC = b'UATIDX01'
+HEADER = struct.Struct('<8sQQ')
+# keys and offsets buffered in memory while writing an index
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+def title_hash(title_norm):
+    """ 63 bit hash of a normalized title (fits into an SQLite integer).
+    """
+
+    digest = blake2b(title_norm.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') >> 1
+
+
+def _strip_prefix(value, prefix):
+    if not value:
+        return ''
+    if value.startswith(prefix):
+        return value[len(prefix):]
+    return value
+
+
+def _index_rows(dump_fp):
+    """ (title hash, record JSON) tuples for the works in one gzipped JSONL
+        part file of the OpenAlex dump.
+    """
+
+    rows = []
+    with gzip.open(dump_fp, 'rt', encoding='utf-8') as f:
+        for line in f:
+            try:
+                work = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            title = work.get('title')
+            if not title:
+                continue
+            title_norm = normalize_title(title)
+            last_names = []
+            for authorship in work.get('authorships') or []:
+                name = (authorship.get('author') or {}).get('display_name')
+                if name:
+                    last_names.append(
+                        normalize_author_name(name).split(' ')[-1]
+                    )
+            ids = work.get('ids') or {}
+            record = [
+                title_norm,
+                last_names,
+                work.get('cited_by_count'),
+                [
+                    _strip_prefix(work.get('id'), 'https://openalex.org/'),
+                    ids.get('pmid') or '',
+                    ids.get('pmcid') or '',
+                    work.get('doi') or ''
+                ]
+            ]
+            rows.append((
+                title_hash(title_norm),
+                json.dumps(record, ensure_ascii=False)
+            ))
+    return rows
+
+
+def build_title_index(dump_dir, out_fp, num_workers=None):
+    """ Build a title index from all *.gz part files below dump_dir.
+
+        Records are sorted by title hash in a temporary SQLite DB, so the
+        dump doesn't need to fit into memory.
+    """
+
+    dump_fps = sorted(
+        os.path.join(root, fn)
+        for root, _, fns in os.walk(dump_dir)
+        for fn in fns if fn.endswith('.gz')
+    )
+    tmp_dir = tempfile.TemporaryDirectory(
+        dir=os.path.dirname(os.path.abspath(out_fp))
+    )
+    conn = sqlite3.connect(os.path.join(tmp_dir.name, 'sort.sqlite'))
+    db_cur = conn.cursor()
+    db_cur.execute('pragma journal_mode = OFF')
+    db_cur.execute('pragma synchronous = OFF')
+    db_cur.execute("create table record('hash' integer, 'record' text)")
+    print('collecting records')
+    with Pool(num_workers or os.cpu_count()) as pool:
+        for rows in tqdm(
+                pool.imap_unordered(_index_rows, dump_fps),
+                total=len(dump_fps)
+        ):
+            db_cur.executemany(
+                "insert into record ('hash','record') values(?,?)", rows
+            )
+    conn.commit()
+    num_keys = db_cur.execute(
+        'select count(distinct hash) from record'
+    ).fetchone()[0]
+
+    print('writing index')
+    keys_offset = HEADER.size
+    offsets_offset = keys_offset + 8 * num_keys
+    records_offset = offsets_offset + 8 * (num_keys + 1)
+    part_fp = '{}.part'.format(out_fp)
+    with open(part_fp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, num_keys, records_offset))
+        f.truncate(records_offset)
+        # (position in file, buffered values) for keys and offsets
+        arrays = {
+            'keys': [keys_offset, array('Q')],
+            'offsets': [offsets_offset, array('Q', [0])]
+        }
+        records_pos = records_offset
+
+        def flush_arrays():
+            for name in arrays:
+                pos, values = arrays[name]
+                f.seek(pos)
+                values.tofile(f)
+                arrays[name] = [pos + 8 * len(values), array('Q')]
+            f.seek(records_pos)
+
+        def write_group(group_hash, group):
+            nonlocal records_pos
+            data = '[{}]'.format(','.join(group)).encode('utf-8')
+            f.seek(records_pos)
+            f.write(data)
+            records_pos += len(data)
+            arrays['keys'][1].append(group_hash)
+            arrays['offsets'][1].append(records_pos - records_offset)
+            if len(arrays['keys'][1]) >= WRITE_BUFFER_SIZE:
+                flush_arrays()
+
+        group_hash = None
+        group = []
+        db_cur.execute('select hash, record from record order by hash')
+        for row_hash, record in tqdm(db_cur, unit='records'):
+            if row_hash != group_hash and group:
+                write_group(group_hash, group)
+                group = []
+            group_hash = row_hash
+            group.append(record)
+        if group:
+            write_group(group_hash, group)
+        flush_arrays()
+    os.replace(part_fp, out_fp)
+    conn.close()
+    tmp_dir.cleanup()
+
+
+class TitleIndex:
+    """ Read-only access to a title index built with build_title_index().
+
+        Lookup results have the same shape as the candidates returned by
+        match_references_openalex.fetch_openalex_candidates(), i.e.
+        (authors, cited_by_count, ids) tuples, where the authors are
+        given by their last name.
+    """
+
+    def __init__(self, index_fp):
+        self._f = open(index_fp, 'rb')
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, num_keys, records_offset = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a title index'.format(index_fp))
+        self.num_keys = num_keys
+        self._records_offset = records_offset
+        self._buf = memoryview(self._mm)
+        keys_offset = HEADER.size
+        offsets_offset = keys_offset + 8 * num_keys
+        self._keys = self._buf[keys_offset:offsets_offset].cast('Q')
+        self._offsets = self._buf[offsets_offset:records_offset].cast('Q')
+
+    def close(self):
+        self._keys.release()
+        self._offsets.release()
+        self._buf.release()
+        self._mm.close()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def lookup(self, title_norm):
+        """ List of (authors, cited_by_count, ids) tuples of the works with
+            the given normalized title.
+        """
+
+        key = title_hash(title_norm)
+        idx = bisect_left(self._keys, key)
+        if idx == self.num_keys or self._keys[idx] != key:
+            return []
+        start = self._records_offset + self._offsets[idx]
+        end = self._records_offset + self._offsets[idx+1]
+        records = json.loads(self._mm[start:end].decode('utf-8'))
+        return [
+            (last_names, cited_by_count, ids)
+            for record_title_norm, last_names, cited_by_count, ids in records
+            # skip hash collisions
+            if record_title_norm == title_norm
+        ]
+
+    def candidates(self, title_norms):
+        """ Dict mapping each of the given normalized titles that is in the
+            index to its lookup() result.
+        """
+
+        candidates = {}
+        for title_norm in title_norms:
+            matches = self.lookup(title_norm)
+            if matches:
+                candidates[title_norm] = matches
+        return candidates
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [3, 4]:
+        print((
+            'Usage: python3 title_index.py <openalex_works_dump_dir> '
+            '<title_index_file> [<num_workers>]'
+        ))
+        sys.exit()
+    num_workers = int(sys.argv[3]) if len(sys.argv) == 4 else None
+    build_title_index(sys.argv[1], sys.argv[2], num_workers)
@@ -0,0 +1,187 @@
+""" Reusable pool for converting normalized LaTeX files to XML with Tralics.
+"""
+
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+
+TRALICS_ARGS = [
+    'tralics',
+    '-silent',
+    '-noxmlerror',
+    '-utf8',
+    '-oe8',
+    '-entnames=false',
+    '-nomathml'
+]
+
+
+class TralicsPool:
+    """ Converts LaTeX files to XML using a fixed number of concurrently
+        running Tralics processes.
+
+        Tralics converts exactly one document per invocation, so every
+        document still gets its own process and timeout (a hanging or
+        crashing document only affects itself). What is shared across
+        documents are the worker slots: each one keeps a scratch directory
+        for its whole lifetime, and the Tralics output log is kept open
+        once for the pool instead of being reopened per document.
+
+        Usage:
+            with TralicsPool(size=4) as pool:
+                for doc_id, xml, error in pool.convert_many(docs):
+                    ...
+    """
+
+    def __init__(self, size=1, timeout=5, log_path=None):
+        self.size = size
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=size)
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix='tralics_pool_')
+        self._slots = Queue()
+        for slot_idx in range(size):
+            scratch_dir = os.path.join(self._tmp_dir.name, str(slot_idx))
+            os.mkdir(scratch_dir)
+            self._slots.put(scratch_dir)
+        self._log_lock = threading.Lock()
+        if log_path is not None:
+            self._log = open(log_path, 'a')
+        else:
+            self._log = None
+        # throughput counters
+        self._stats_lock = threading.Lock()
+        self._start_time = time.monotonic()
+        self.num_submitted = 0
+        self.num_converted = 0
+        self.num_failed = 0
+        self.num_timed_out = 0
+        self.busy_seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        self._tmp_dir.cleanup()
+
+    def convert(self, tex_path, doc_id=None):
+        """ Convert a single LaTeX file.
+
+            Returns a tuple (XML bytes, error message). The XML bytes are
+            None if the conversion failed.
+        """
+
+        with self._stats_lock:
+            self.num_submitted += 1
+        scratch_dir = self._slots.get()
+        try:
+            return self._convert_in(scratch_dir, tex_path, doc_id)
+        finally:
+            self._slots.put(scratch_dir)
+
+    def convert_many(self, docs):
+        """ Convert an iterable of (doc_id, tex_path) tuples.
+
+            Yields (doc_id, XML bytes, error message) tuples in input
+            order, so results are reproducible across runs. At most twice
+            the pool size of documents are in flight at any time.
+        """
+
+        pending = deque()
+        for doc_id, tex_path in docs:
+            pending.append((
+                doc_id,
+                self._executor.submit(self.convert, tex_path, doc_id)
+            ))
+            if len(pending) >= 2 * self.size:
+                doc_id, future = pending.popleft()
+                yield (doc_id,) + future.result()
+        while pending:
+            doc_id, future = pending.popleft()
+            yield (doc_id,) + future.result()
+
+    def stats(self):
+        """ Current throughput counters as a dict.
+        """
+
+        with self._stats_lock:
+            elapsed = time.monotonic() - self._start_time
+            num_done = (
+                self.num_converted + self.num_failed + self.num_timed_out
+            )
+            return {
+                'pool_size': self.size,
+                'submitted': self.num_submitted,
+                'converted': self.num_converted,
+                'failed': self.num_failed,
+                'timed_out': self.num_timed_out,
+                'busy_seconds': round(self.busy_seconds, 3),
+                'elapsed_seconds': round(elapsed, 3),
+                'docs_per_second': (
+                    round(num_done / elapsed, 3) if elapsed > 0 else 0
+                )
+            }
+
+    def _count(self, counter, start_time):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            self.busy_seconds += time.monotonic() - start_time
+
+    def _write_log(self, doc_id, output):
+        if self._log is None:
+            return
+        with self._log_lock:
+            self._log.write(
+                '\n------------- {} -------------\n'.format(doc_id)
+            )
+            self._log.write(output.decode('utf-8', errors='replace'))
+            self._log.flush()
+
+    def _clear_scratch_dir(self, scratch_dir):
+        for entry in os.scandir(scratch_dir):
+            os.remove(entry.path)
+
+    def _convert_in(self, scratch_dir, tex_path, doc_id):
+        start_time = time.monotonic()
+        fn_base = os.path.splitext(os.path.basename(tex_path))[0]
+        xml_path = os.path.join(scratch_dir, '{}.xml'.format(fn_base))
+        tralics_args = TRALICS_ARGS + [
+            '-output_dir={}'.format(scratch_dir),
+            tex_path
+        ]
+        try:
+            proc = subprocess.run(
+                tralics_args,
+                stdout=(
+                    subprocess.PIPE if self._log is not None
+                    else subprocess.DEVNULL
+                ),
+                stderr=subprocess.DEVNULL,
+                timeout=self.timeout
+            )
+            if proc.stdout:
+                self._write_log(doc_id, proc.stdout)
+            # check if smth went wrong with parsing latex to xml file
+            if not os.path.isfile(xml_path):
+                self._count('num_failed', start_time)
+                return None, 'no tralics output'
+            with open(xml_path, 'rb') as f:
+                xml = f.read()
+        except subprocess.TimeoutExpired as e:
+            self._count('num_timed_out', start_time)
+            return None, str(e)
+        finally:
+            self._clear_scratch_dir(scratch_dir)
+        self._count('num_converted', start_time)
+        return xml, None
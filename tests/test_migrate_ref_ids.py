@@ -0,0 +1,66 @@
+import os
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+)
+
+from migrate_ref_ids import migrate_paper
+from parse_latex_tralics import _ref_entry_ids
+
+FORMULA_UUID = '0b9a3e0e-5b0a-4c8e-9d7e-3f2a9c1b0c11'
+
+
+def _paper(link_start, link_end):
+    raw = 'A. Author, {{{{formula:{}}}}} theory, doi'.format(FORMULA_UUID)
+    return {
+        'paper_id': '2101.00001',
+        'body_text': [{
+            'text': 'see {{{{formula:{}}}}} here'.format(FORMULA_UUID),
+            'cite_spans': [{
+                'start': None, 'end': None, 'text': '', 'ref_id': 'x'
+            }],
+            'ref_spans': [{
+                'start': 4,
+                'end': 4 + len('{{formula:}}') + len(FORMULA_UUID),
+                'text': '{{{{formula:{}}}}}'.format(FORMULA_UUID),
+                'ref_id': FORMULA_UUID
+            }]
+        }],
+        'bib_entries': {
+            'oldkey': {
+                'bib_entry_raw': raw,
+                'contained_arXiv_ids': [],
+                'contained_links': [{
+                    'url': 'https://doi.org/10.1/1', 'text': 'doi',
+                    'start': link_start, 'end': link_end
+                }]
+            }
+        },
+        'ref_entries': {FORMULA_UUID: {'latex': 'x', 'type': 'formula'}}
+    }
+
+
+def test_none_offsets_are_kept():
+    paper = _paper(None, None)
+    assert migrate_paper(paper)
+    bib_entry, = paper['bib_entries'].values()
+    assert bib_entry['contained_links'][0]['start'] is None
+    assert bib_entry['contained_links'][0]['end'] is None
+    paragraph = paper['body_text'][0]
+    assert paragraph['cite_spans'][0]['start'] is None
+    new_id = next(_ref_entry_ids('2101.00001'))
+    assert paragraph['text'] == 'see {{{{formula:{}}}}} here'.format(new_id)
+    ref_span = paragraph['ref_spans'][0]
+    assert paragraph['text'][ref_span['start']:ref_span['end']] == \
+        ref_span['text']
+
+
+def test_offsets_after_markers_are_shifted():
+    raw = _paper(None, None)['bib_entries']['oldkey']['bib_entry_raw']
+    start = raw.index('doi')
+    paper = _paper(start, start + 3)
+    migrate_paper(paper)
+    bib_entry, = paper['bib_entries'].values()
+    link = bib_entry['contained_links'][0]
+    assert bib_entry['bib_entry_raw'][link['start']:link['end']] == 'doi'